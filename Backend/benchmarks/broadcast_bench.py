@@ -0,0 +1,108 @@
+"""Benchmark de difusión WebSocket con clientes simulados.
+
+Uso (desde Backend/):
+    python -m benchmarks.broadcast_bench --clients 10000 --ticks 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from services.broadcast import BroadcastChannel, BroadcastConnection
+
+
+class FakeWebSocket:
+    """WebSocket simulado; los clientes lentos tardan más que un tick en enviar"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.received = 0
+        self.closed_code = None
+
+    async def send_text(self, message: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code: int = 1000):
+        self.closed_code = code
+
+
+def team_payload(tick: int) -> dict:
+    # Tamaño similar a TeamStats con un roster grande
+    return {
+        "team": "Thunder Gaming",
+        "total_players": 50,
+        "avg_team_heart_rate": round(80 + random.random() * 10, 1),
+        "avg_team_oxygen": round(96 + random.random(), 1),
+        "players_status": {f"Player {i}": random.choice(["normal", "fatigue", "risk"]) for i in range(50)},
+        "tick": tick,
+    }
+
+
+async def run_broadcast(clients: int, ticks: int, interval: float, slow_ratio: float):
+    state = {"tick": 0}
+
+    def producer():
+        state["tick"] += 1
+        return team_payload(state["tick"])
+
+    # interval enorme: los ticks se disparan a mano para medir solo el fan-out
+    channel = BroadcastChannel("team:bench", producer, interval=3600, max_lag=5)
+    sockets, tasks = [], []
+    for i in range(clients):
+        websocket = FakeWebSocket(delay=interval * 20 if random.random() < slow_ratio else 0)
+        connection = BroadcastConnection(websocket, channel.max_lag)
+        channel.connections.add(connection)
+        sockets.append(websocket)
+        tasks.append(asyncio.create_task(connection.run()))
+
+    fan_out_times = []
+    started = time.perf_counter()
+    for _ in range(ticks):
+        t0 = time.perf_counter()
+        await channel.tick()
+        fan_out_times.append(time.perf_counter() - t0)
+        await asyncio.sleep(interval)
+    elapsed = time.perf_counter() - started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    delivered = sum(ws.received for ws in sockets)
+    fan_out_times.sort()
+    print(f"[broadcast] clientes={clients} ticks={ticks} tiempo={elapsed:.2f}s")
+    print(f"  serializaciones: {channel.ticks}")
+    print(f"  fan-out p50={fan_out_times[len(fan_out_times) // 2] * 1000:.2f}ms "
+          f"max={fan_out_times[-1] * 1000:.2f}ms")
+    print(f"  mensajes entregados: {delivered}  descartados por lentitud: {channel.dropped}")
+
+
+def run_naive(clients: int, ticks: int):
+    """Referencia: serializar el payload una vez por conexión"""
+    started = time.perf_counter()
+    for tick in range(ticks):
+        payload = team_payload(tick)
+        for _ in range(clients):
+            json.dumps(payload, default=str)
+    elapsed = time.perf_counter() - started
+    print(f"[naive] serializaciones: {clients * ticks}  tiempo={elapsed:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--slow-ratio", type=float, default=0.01)
+    args = parser.parse_args()
+
+    random.seed(42)
+    asyncio.run(run_broadcast(args.clients, args.ticks, args.interval, args.slow_ratio))
+    run_naive(args.clients, args.ticks)
+
+
+if __name__ == "__main__":
+    main()
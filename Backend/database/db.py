@@ -1,15 +1,18 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from datetime import datetime, timedelta
 import random
 import os
 
+from services.instrumentation import TimedQueuePool
+
 # SQLite para desarrollo
 SQLALCHEMY_DATABASE_URL = "sqlite:///./esports_health.db"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, 
-    connect_args={"check_same_thread": False}  # Necesario para SQLite
+    connect_args={"check_same_thread": False},  # Necesario para SQLite
+    poolclass=TimedQueuePool  # Mide la espera de checkout para /metrics/prometheus
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -36,6 +39,198 @@ class MetricDB(Base):
     player_id = Column(Integer, ForeignKey("players.id"))
     
     player = relationship("PlayerDB", back_populates="metrics")
+    # Solo existe si el filtro de calidad marcó la lectura (services.quality)
+    quality = relationship("MetricQualityDB", uselist=False, lazy="selectin")
+
+    @property
+    def quality_flags(self) -> int:
+        return self.quality.flags if self.quality is not None else 0
+
+    # Índice compuesto para paginación keyset y consultas por ventana de tiempo
+    __table_args__ = (
+        Index("ix_metrics_player_timestamp_id", "player_id", "timestamp", "id"),
+    )
+
+class MetricQualityDB(Base):
+    __tablename__ = "metric_quality"
+    
+    metric_id = Column(Integer, ForeignKey("metrics.id"), primary_key=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    timestamp = Column(DateTime)  # Copia del de la lectura, para reprocesar por ventana
+    flags = Column(Integer)  # Máscara de bits de services.quality
+
+    __table_args__ = (
+        Index("ix_metric_quality_player_timestamp", "player_id", "timestamp"),
+    )
+
+class AlertDB(Base):
+    __tablename__ = "alerts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    metric_id = Column(Integer, ForeignKey("metrics.id"))
+    kind = Column(String)  # status, sudden_change
+    level = Column(String)  # Nivel alcanzado (normal = recuperación)
+    previous_level = Column(String)
+    value = Column(Integer)  # Variación en BPM de los cambios bruscos
+    message = Column(String)
+    reading_timestamp = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_alerts_player_id_desc", "player_id", "id"),
+        Index("ix_alerts_created_at", "created_at"),
+    )
+
+class AnomalyEventDB(Base):
+    __tablename__ = "anomaly_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    metric_id = Column(Integer, ForeignKey("metrics.id"))
+    type = Column(String)  # heart_rate_peak, low_oxygen, sudden_change
+    timestamp = Column(DateTime)  # Lectura que dispara el evento
+    magnitude = Column(Integer)  # BPM, % de SpO2 o variación en BPM
+    score = Column(Float)  # Estadístico de los detectores (z, CUSUM); nulo en los de umbral
+    window_start = Column(DateTime)  # Primera lectura implicada
+    window_end = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_anomaly_events_player_timestamp", "player_id", "timestamp"),
+    )
+
+class DetectorStateDB(Base):
+    __tablename__ = "detector_states"
+    
+    player_id = Column(Integer, ForeignKey("players.id"), primary_key=True)
+    state = Column(String)  # Snapshot JSON de services.detectors
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class QuantileSketchDB(Base):
+    __tablename__ = "quantile_sketches"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    metric = Column(String)  # heart_rate, oxygen_saturation
+    bucket_start = Column(DateTime)  # Inicio de la hora
+    sketch = Column(String)  # DDSketch serializado (services.sketches)
+    count = Column(Integer)
+
+    __table_args__ = (
+        Index("ix_quantile_sketches_player_metric_bucket", "player_id", "metric", "bucket_start", unique=True),
+    )
+
+class MatchEventDB(Base):
+    __tablename__ = "match_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    match_id = Column(String)  # Partida o sesión a la que pertenece el evento
+    type = Column(String)  # fight, death, objective...
+    timestamp = Column(DateTime)  # Inicio del evento
+    end_timestamp = Column(DateTime)  # Fin (igual al inicio en eventos puntuales)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Índice de intervalos: eventos de un jugador que solapan un rango de tiempo
+    __table_args__ = (
+        Index("ix_match_events_player_interval", "player_id", "timestamp", "end_timestamp"),
+        Index("ix_match_events_match_timestamp", "match_id", "timestamp"),
+    )
+
+class MatchDB(Base):
+    __tablename__ = "matches"
+    
+    id = Column(String, primary_key=True)  # Mismo identificador que match_events.match_id
+    name = Column(String)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)  # Nulo mientras la partida está abierta
+    status = Column(String, default="open")  # open, closed, aggregated
+    aggregated_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    players = relationship("MatchPlayerDB", cascade="all, delete-orphan")
+
+    # Índice de intervalos: partidas que solapan un instante o rango
+    __table_args__ = (
+        Index("ix_matches_interval", "start_time", "end_time"),
+    )
+
+class MatchPlayerDB(Base):
+    __tablename__ = "match_players"
+    
+    match_id = Column(String, ForeignKey("matches.id"), primary_key=True)
+    player_id = Column(Integer, ForeignKey("players.id"), primary_key=True)
+
+    __table_args__ = (
+        Index("ix_match_players_player", "player_id", "match_id"),
+    )
+
+class MatchAggregateDB(Base):
+    __tablename__ = "match_aggregates"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    match_id = Column(String, ForeignKey("matches.id"))
+    scope = Column(String)  # player, team
+    player_id = Column(Integer)  # Solo en scope player
+    team = Column(String)
+    count = Column(Integer)
+    avg_heart_rate = Column(Float)
+    std_heart_rate = Column(Float)
+    min_heart_rate = Column(Integer)
+    max_heart_rate = Column(Integer)
+    avg_oxygen_saturation = Column(Float)
+    std_oxygen_saturation = Column(Float)
+    min_oxygen_saturation = Column(Integer)
+    max_oxygen_saturation = Column(Integer)
+    readings_by_level = Column(String)  # JSON {estado: lecturas}
+    computed_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_match_aggregates_match_scope", "match_id", "scope"),
+    )
+
+class RRChunkDB(Base):
+    __tablename__ = "rr_chunks"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    start_time = Column(DateTime)  # Latido con el que empieza el primer intervalo
+    end_time = Column(DateTime)  # Último latido
+    count = Column(Integer)
+    intervals = Column(LargeBinary)  # Intervalos RR en ms, uint16 little-endian empaquetados
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Índice de intervalos: bloques de un jugador que solapan un rango
+    __table_args__ = (
+        Index("ix_rr_chunks_player_interval", "player_id", "start_time", "end_time"),
+    )
+
+class ChannelDB(Base):
+    __tablename__ = "channels"
+    
+    name = Column(String, primary_key=True)  # skin_temperature, eda, accelerometer...
+    unit = Column(String)
+    dtype = Column(String)  # int16, uint16, int32, float32
+    sample_rate = Column(Float)  # Hz; nulo en canales irregulares (instante propio por muestra)
+    components = Column(Integer, default=1)  # Ejes por muestra (3 en el acelerómetro)
+    description = Column(String)
+
+class ChannelChunkDB(Base):
+    __tablename__ = "channel_chunks"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, ForeignKey("players.id"))
+    channel = Column(String, ForeignKey("channels.name"))
+    start_time = Column(DateTime)  # Primera muestra; las demás cada 1/sample_rate
+    end_time = Column(DateTime)  # Instante siguiente a la última muestra
+    count = Column(Integer)
+    data = Column(LargeBinary)  # Muestras empaquetadas (count × components) en el dtype del canal
+    offsets = Column(LargeBinary)  # Solo canales irregulares: µs desde start_time de cada muestra (int64)
+
+    # Índice de intervalos por (jugador, canal)
+    __table_args__ = (
+        Index("ix_channel_chunks_player_channel_interval", "player_id", "channel", "start_time", "end_time"),
+    )
 
 # Crear tablas y datos de ejemplo
 def init_db():
@@ -43,6 +238,11 @@ def init_db():
         # Crear todas las tablas
         Base.metadata.create_all(bind=engine)
         
+        # create_all no añade índices nuevos a tablas ya existentes
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        
         db = SessionLocal()
         
         # Verificar si ya existen datos
@@ -1,12 +1,49 @@
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Request, Response, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy import or_, and_, func
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from pydantic import TypeAdapter
+from typing import List, Optional, Union
 from datetime import datetime, timedelta
-import statistics
+import asyncio
+import json
+import time
 
-from database.db import get_db, init_db, PlayerDB, MetricDB
-from models.models import Player, PlayerCreate, Metric, MetricCreate, PlayerMetrics, AnalyticsResponse, TeamStats
+from database.db import get_db, init_db, engine, Base, SessionLocal, PlayerDB, MetricDB, MetricQualityDB, AlertDB, AnomalyEventDB, MatchEventDB, MatchDB, MatchPlayerDB
+from models.models import (
+    Player, PlayerCreate, Metric, MetricCreate, PlayerMetrics, AnalyticsResponse, TeamStats,
+    ProfilingConfig, ProfileInfo, RosterAnalytics, Alert, AnomalyEvent, QualityReport, PercentileBucket, PercentilesResponse,
+    LeaderboardResponse, ZonesResponse, MatchEvent, MatchEventCreate, EventResponseAnalysis,
+    Match, MatchCreate, MatchClose, MatchAnalytics, SynchronyResponse,
+    RRBatch, RRChunk, HRVResponse, TeamHRVResponse,
+    ChannelDefinition, ChannelBatch, ChannelWrite, ChannelRange, ChannelRollup, AlignedSeries, naive_utc
+)
+from services.realtime import hub, player_topic, team_topic
+from services.broadcast import broadcaster
+from services.cache import (
+    versions, response_cache, conditional_response, make_etag, window_now, NO_CACHE, SHORT_LIVED
+)
+from services.singleflight import flight, coalesce
+from services.instrumentation import (
+    registry, PrometheusMiddleware, install_sqlalchemy, install_serialization_timer, timed_serialization
+)
+from services import querydebug
+from services.profiling import profiler, ProfiledRoute, ProfilingMiddleware
+from services.analytics import (
+    load_window, clean_readings, compute_analytics, compute_nested_windows, build_responses, classify, EXCLUDE_FLAGGED
+)
+from services.quality import quality, report as quality_report
+from services import anomalies
+from services.detectors import detectors
+from services.aggregation import tree, DIMENSIONS as AGGREGATION_DIMENSIONS, WINDOW_HOURS as AGGREGATION_HOURS
+from services.hrv import hrv
+from services.leaderboard import leaderboard, METRICS as LEADERBOARD_METRICS
+from services import zones, events as match_events, matches, synchrony, channels, alignment
+from services.sketches import sketches, merge as merge_sketches, RELATIVE_ACCURACY, FLUSH_SECONDS
+from services.rules import rules
+from services.alerts import alerts, alerts_topic
+import numpy as np
 
 # Inicializar la aplicación FastAPI
 app = FastAPI(
@@ -14,6 +51,8 @@ app = FastAPI(
     description="API para monitoreo de métricas biométricas de jugadores profesionales",
     version="1.0.0"
 )
+# Todas las rutas se pueden perfilar bajo demanda (ver /admin/profiling)
+app.router.route_class = ProfiledRoute
 
 # Configurar CORS para permitir requests del frontend
 app.add_middleware(
@@ -22,27 +61,110 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", querydebug.HEADER],
 )
 
+# Instrumentación para Prometheus (latencias, sentencias SQL, filas ORM)
+app.add_middleware(PrometheusMiddleware)
+install_sqlalchemy(engine, Base)
+install_serialization_timer()
+
+app.add_middleware(ProfilingMiddleware)
+
+# Detector de consultas lentas y N+1 (solo desarrollo/staging, QUERY_DEBUG=1)
+if querydebug.ENABLED:
+    app.add_middleware(querydebug.QueryDebugMiddleware)
+    querydebug.install(engine)
+
 # Inicializar base de datos al iniciar
 @app.on_event("startup")
 def startup_event():
     init_db()
+    
+    # Eventos de anomalía de las lecturas que no llegaron por /metrics
+    with SessionLocal() as db:
+        channels.registry.load(db)
+        players = db.query(PlayerDB).all()
+        start_time = datetime.utcnow() - timedelta(hours=anomalies.BACKFILL_HOURS)
+        # Marcas de calidad primero: todo lo demás se calcula sin las lecturas marcadas
+        quality.reprocess(db, players, start_time)
+        anomalies.backfill(db, players, start_time)
+        
+        # Detectores: último checkpoint y, encima, las lecturas posteriores
+        detectors.load(db)
+        detectors.backfill(db, players, start_time)
+        
+        sketches.backfill(db, players, start_time)
+        
+        tree.rebuild(db, players)
+        leaderboard.rebuild(db, players)
+        
+        # Partidas cerradas cuya agregación no llegó a ejecutarse
+        matches.aggregate_pending(db)
+
+@app.on_event("shutdown")
+def shutdown_event():
+    with SessionLocal() as db:
+        detectors.checkpoint(db)
+        sketches.flush(db)
+
+# Utilidades de paginación keyset
+def encode_metric_cursor(metric: MetricDB) -> str:
+    """Cursor opaco para la posición (timestamp, id) de una métrica"""
+    return f"{metric.timestamp.isoformat()}_{metric.id}"
+
+players_adapter = TypeAdapter(List[Player])
+metrics_adapter = TypeAdapter(List[Metric])
+
+def decode_metric_cursor(cursor: str):
+    """Convertir un cursor de métricas en su par (timestamp, id)"""
+    try:
+        timestamp, metric_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), int(metric_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
 
 # Endpoints de Jugadores
 @app.get("/players", response_model=List[Player])
-def get_players(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def get_players(
+    request: Request,
+    skip: int = Query(0, ge=0, description="Desplazamiento (obsoleto, usar after_id)"),
+    limit: int = Query(100, ge=1, le=1000, description="Tamaño de página"),
+    after_id: Optional[int] = Query(None, description="Cursor: último id recibido"),
+    db: Session = Depends(get_db)
+):
     """Obtener lista de todos los jugadores"""
-    players = db.query(PlayerDB).offset(skip).limit(limit).all()
-    return players
+    def build():
+        query = db.query(PlayerDB).order_by(PlayerDB.id)
+        if after_id is not None:
+            query = query.filter(PlayerDB.id > after_id)
+        elif skip:
+            query = query.offset(skip)
+        
+        players = query.limit(limit).all()
+        
+        # Solo hay siguiente página si la actual vino completa
+        headers = {"X-Next-Cursor": str(players[-1].id)} if len(players) == limit else {}
+        with timed_serialization():
+            body = players_adapter.dump_json(players_adapter.validate_python(players))
+        return body, headers
+    
+    etag = make_etag("players", versions.roster(), skip, limit, after_id)
+    return conditional_response(request, etag, NO_CACHE, build)
 
 @app.get("/players/{player_id}", response_model=Player)
-def get_player(player_id: int, db: Session = Depends(get_db)):
+def get_player(player_id: int, request: Request, db: Session = Depends(get_db)):
     """Obtener información de un jugador específico"""
-    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Jugador no encontrado")
-    return player
+    def build():
+        player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+        if not player:
+            raise HTTPException(status_code=404, detail="Jugador no encontrado")
+        with timed_serialization():
+            body = Player.model_validate(player).model_dump_json().encode()
+        return body, {}
+    
+    etag = make_etag("player", player_id, versions.roster())
+    return conditional_response(request, etag, NO_CACHE, build)
 
 @app.post("/players", response_model=Player)
 def create_player(player: PlayerCreate, db: Session = Depends(get_db)):
@@ -51,12 +173,16 @@ def create_player(player: PlayerCreate, db: Session = Depends(get_db)):
     db.add(db_player)
     db.commit()
     db.refresh(db_player)
+    
+    versions.bump_roster(db_player.id, db_player.team)
+    tree.register(db_player)
     return db_player
 
 # Endpoints de Métricas
 @app.post("/metrics", response_model=Metric)
 def create_metric(metric: MetricCreate, db: Session = Depends(get_db)):
     """Registrar nuevas métricas para un jugador"""
+    received = time.perf_counter()
     # Verificar que el jugador existe
     player = db.query(PlayerDB).filter(PlayerDB.id == metric.player_id).first()
     if not player:
@@ -64,30 +190,142 @@ def create_metric(metric: MetricCreate, db: Session = Depends(get_db)):
     
     db_metric = MetricDB(**metric.dict())
     db.add(db_metric)
+    db.flush()
+    
+    # Las lecturas con artefactos se guardan con sus marcas, pero no alimentan alertas ni análisis
+    flags = quality.check(db, db_metric)
+    if flags:
+        db_metric.quality = MetricQualityDB(player_id=player.id, timestamp=db_metric.timestamp, flags=flags)
+    clean = not (flags and EXCLUDE_FLAGGED)
+    
+    # Alertas y eventos de anomalía se guardan en la misma transacción que la lectura
+    raised = []
+    if clean:
+        raised = alerts.evaluate(db, player, db_metric)
+        db.add_all(raised)
+        db.add_all(anomalies.detect_reading(db, player, db_metric))
+        db.add_all(detectors.update(db_metric))
+        sketches.add(db, db_metric)
     db.commit()
     db.refresh(db_metric)
+    
+    versions.bump_player(player.id, player.team)
+    sketches.flush(db, max_age=FLUSH_SECONDS)
+    if clean:
+        tree.add(player, db_metric, rules.compile_player(player).reading_status(player.id, {
+            "heart_rate": db_metric.heart_rate, "oxygen_saturation": db_metric.oxygen_saturation
+        }))
+        leaderboard.update(player, db_metric)
+    if raised:
+        alerts.publish(player, raised, received)
+    publish_reading(db, player, db_metric)
     return db_metric
 
+def publish_reading(db: Session, player: PlayerDB, metric: MetricDB):
+    """Difundir una lectura nueva y el estado actualizado a los feeds en vivo"""
+    topics = (player_topic(player.id), team_topic(player.team))
+    if not hub.has_subscribers(*topics):
+        return
+    
+    # Estado sobre la misma ventana de 4 horas que usan las estadísticas de equipo
+    start_time = datetime.utcnow() - timedelta(hours=4)
+    max_hr, min_hr, max_o2, min_o2 = clean_readings(db.query(
+        func.max(MetricDB.heart_rate), func.min(MetricDB.heart_rate),
+        func.max(MetricDB.oxygen_saturation), func.min(MetricDB.oxygen_saturation)
+    )).filter(
+        MetricDB.player_id == player.id,
+        MetricDB.timestamp >= start_time
+    ).one()
+    
+    status = "normal"
+    if max_hr is not None:
+        status = str(classify(
+            rules.compile([player]), np.array([player.id]),
+            np.array([max_hr]), np.array([min_hr]), np.array([max_o2]), np.array([min_o2])
+        )["status"][0])
+    
+    payload = {
+        "player_id": player.id,
+        "player": player.name,
+        "team": player.team,
+        "status": status,
+        "reading": Metric.model_validate(metric).model_dump(mode="json"),
+    }
+    for topic in topics:
+        hub.publish(topic, player.id, payload)
+
 @app.get("/players/{player_id}/metrics", response_model=List[Metric])
 def get_player_metrics(
     player_id: int,
+    request: Request,
     hours: int = Query(24, description="Horas hacia atrás para obtener métricas"),
+    since: Optional[datetime] = Query(None, description="Solo lecturas posteriores a este instante"),
+    until: Optional[datetime] = Query(None, description="Fin de la ventana (por defecto, ahora)"),
+    cursor: Optional[str] = Query(None, description="Cursor (timestamp_id) de la página anterior"),
+    limit: int = Query(1000, ge=1, le=5000, description="Tamaño de página"),
+    order: str = Query("desc", pattern="^(asc|desc)$", description="Orden temporal"),
     db: Session = Depends(get_db)
 ):
     """Obtener métricas de un jugador en un período específico"""
-    # Verificar que el jugador existe
-    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    now = window_now()
+    until, since = naive_utc(until), naive_utc(since)
+    end_time = min(until, now) if until is not None else None
+    start_time = (end_time or now) - timedelta(hours=hours)
+    cursor_key = decode_metric_cursor(cursor) if cursor is not None else None
     
-    start_time = datetime.utcnow() - timedelta(hours=hours)
+    def build():
+        # Verificar que el jugador existe
+        player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+        if not player:
+            raise HTTPException(status_code=404, detail="Jugador no encontrado")
+        
+        query = db.query(MetricDB).filter(
+            MetricDB.player_id == player_id,
+            MetricDB.timestamp >= start_time
+        )
+        if end_time is not None:
+            query = query.filter(MetricDB.timestamp < end_time)
+        
+        # Sincronización incremental: solo lo que el cliente aún no ha visto
+        if since is not None:
+            query = query.filter(MetricDB.timestamp > since)
+        
+        # Paginación keyset sobre el par (timestamp, id)
+        if cursor_key is not None:
+            cursor_ts, cursor_id = cursor_key
+            if order == "asc":
+                query = query.filter(or_(
+                    MetricDB.timestamp > cursor_ts,
+                    and_(MetricDB.timestamp == cursor_ts, MetricDB.id > cursor_id)
+                ))
+            else:
+                query = query.filter(or_(
+                    MetricDB.timestamp < cursor_ts,
+                    and_(MetricDB.timestamp == cursor_ts, MetricDB.id < cursor_id)
+                ))
+        
+        if order == "asc":
+            query = query.order_by(MetricDB.timestamp.asc(), MetricDB.id.asc())
+        else:
+            query = query.order_by(MetricDB.timestamp.desc(), MetricDB.id.desc())
+        
+        metrics = query.limit(limit).all()
+        
+        headers = {"X-Next-Cursor": encode_metric_cursor(metrics[-1])} if len(metrics) == limit else {}
+        with timed_serialization():
+            body = metrics_adapter.dump_json(metrics_adapter.validate_python(metrics))
+        return body, headers
     
-    metrics = db.query(MetricDB).filter(
-        MetricDB.player_id == player_id,
-        MetricDB.timestamp >= start_time
-    ).order_by(MetricDB.timestamp.desc()).all()
+    params = (player_id, start_time, end_time, since, cursor, limit, order)
+    if end_time is not None and end_time < now:
+        # Ventana cerrada: las lecturas nuevas siempre llevan la hora actual, así
+        # que solo cambia si se reprocesa el histórico (marcas de calidad). No es
+        # inmutable: caducidad corta y revalidación por ETag (304)
+        etag = make_etag("metrics", versions.roster(), versions.history(), *params)
+        return conditional_response(request, etag, SHORT_LIVED, build)
     
-    return metrics
+    etag = make_etag("metrics", versions.roster(), versions.player(player_id), *params)
+    return conditional_response(request, etag, NO_CACHE, build)
 
 @app.get("/players/{player_id}/metrics/latest", response_model=Metric)
 def get_latest_metric(player_id: int, db: Session = Depends(get_db)):
@@ -101,11 +339,114 @@ def get_latest_metric(player_id: int, db: Session = Depends(get_db)):
     
     return metric
 
+# Feeds en vivo (Server-Sent Events)
+SSE_HEARTBEAT_SECONDS = 15
+
+async def sse_events(request: Request, topics, max_rate: float, max_pending: int, event: str = "reading"):
+    """Generador SSE: lotes coalescidos al ritmo máximo pedido por el cliente"""
+    subscription = hub.subscribe(topics, max_rate, asyncio.get_running_loop(), max_pending)
+    try:
+        yield "retry: 3000\n\n"
+        while not await request.is_disconnected():
+            batch = await subscription.next_batch(timeout=SSE_HEARTBEAT_SECONDS)
+            if not batch:
+                # Comentario SSE para mantener viva la conexión
+                yield ": keep-alive\n\n"
+                continue
+            for payload in batch:
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+            await asyncio.sleep(subscription.interval)
+    finally:
+        subscription.close()
+
+@app.get("/players/{player_id}/stream")
+async def stream_player(
+    player_id: int,
+    request: Request,
+    max_rate: float = Query(2.0, gt=0, le=50, description="Máximo de lotes por segundo")
+):
+    """Feed en vivo de lecturas y estado de un jugador"""
+    # Sesión propia: no se retiene una conexión durante toda la vida del stream
+    with SessionLocal() as db:
+        player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    
+    return StreamingResponse(
+        sse_events(request, [player_topic(player_id)], max_rate, max_pending=1),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/teams/{team_name}/stream")
+async def stream_team(
+    team_name: str,
+    request: Request,
+    max_rate: float = Query(1.0, gt=0, le=50, description="Máximo de lotes por segundo")
+):
+    """Feed en vivo de lecturas y estado de todos los jugadores de un equipo"""
+    with SessionLocal() as db:
+        total_players = db.query(PlayerDB).filter(PlayerDB.team == team_name).count()
+    if not total_players:
+        raise HTTPException(status_code=404, detail="Equipo no encontrado")
+    
+    return StreamingResponse(
+        sse_events(request, [team_topic(team_name)], max_rate, max_pending=max(total_players, 1) * 2),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Alertas generadas en la ingesta
+@app.get("/alerts", response_model=List[Alert])
+def get_alerts(
+    player_id: Optional[int] = Query(None, description="Solo alertas de este jugador"),
+    team: Optional[str] = Query(None, description="Solo alertas de este equipo"),
+    kind: Optional[str] = Query(None, pattern="^(status|sudden_change)$"),
+    since: Optional[datetime] = Query(None, description="Solo alertas posteriores a este instante"),
+    before_id: Optional[int] = Query(None, description="Cursor: último id recibido"),
+    limit: int = Query(100, ge=1, le=1000, description="Tamaño de página"),
+    db: Session = Depends(get_db)
+):
+    """Historial de alertas, de la más reciente a la más antigua"""
+    query = db.query(AlertDB)
+    if player_id is not None:
+        query = query.filter(AlertDB.player_id == player_id)
+    if team is not None:
+        query = query.join(PlayerDB, PlayerDB.id == AlertDB.player_id).filter(PlayerDB.team == team)
+    if kind is not None:
+        query = query.filter(AlertDB.kind == kind)
+    if since is not None:
+        query = query.filter(AlertDB.created_at > since)
+    if before_id is not None:
+        query = query.filter(AlertDB.id < before_id)
+    return query.order_by(AlertDB.id.desc()).limit(limit).all()
+
+@app.get("/alerts/stream")
+async def stream_alerts(
+    request: Request,
+    player_id: Optional[int] = Query(None, description="Solo alertas de este jugador"),
+    team: Optional[str] = Query(None, description="Solo alertas de este equipo"),
+    max_rate: float = Query(2.0, gt=0, le=50, description="Máximo de lotes por segundo")
+):
+    """Feed en vivo de alertas (todas, de un equipo o de un jugador)"""
+    topic = alerts_topic(player_id=player_id, team=team)
+    # Cada alerta tiene su propia clave: no se coalescen, solo se acota el buffer
+    return StreamingResponse(
+        sse_events(request, [topic], max_rate, max_pending=256, event="alert"),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/alerts/stats")
+def get_alert_stats():
+    return alerts.stats()
+
 # Endpoints de Analytics
-@app.get("/players/{player_id}/analytics", response_model=AnalyticsResponse)
+@app.get("/players/{player_id}/analytics", response_model=Union[AnalyticsResponse, List[Optional[AnalyticsResponse]]])
+@coalesce(flight)
 def get_player_analytics(
     player_id: int,
-    hours: int = Query(8, description="Período de análisis en horas"),
+    hours: List[int] = Query([8], description="Período(s) de análisis en horas; varios valores devuelven una lista en el mismo orden (null si la ventana no tiene lecturas)"),
     db: Session = Depends(get_db)
 ):
     """Obtener análisis completo de las métricas de un jugador"""
@@ -114,79 +455,656 @@ def get_player_analytics(
     if not player:
         raise HTTPException(status_code=404, detail="Jugador no encontrado")
     
+    # Se lee una sola vez la ventana más larga; las demás son sufijos de ella
+    windows = sorted(set(hours), reverse=True)
+    now = datetime.utcnow()
+    arrays = load_window(db, [player_id], now - timedelta(hours=windows[0]))
+    
+    if not len(arrays):
+        if len(hours) > 1:
+            return [None] * len(hours)
+        raise HTTPException(status_code=404, detail="No hay métricas en el período especificado")
+    
+    compiled = rules.compile([player])
+    starts = [now - timedelta(hours=h) for h in windows]
+    anomalies.ensure_backfilled(db, [player], starts[0])
+    events = anomalies.load_events(db, [player_id], starts[0])
+    if len(hours) == 1:
+        stats = compute_analytics(arrays, compiled)
+        return build_responses(stats, f"{hours[0]}h", anomalies.window_messages(events, [player_id], starts))[0]
+    
+    stats = compute_nested_windows(arrays, starts, compiled)
+    rows = stats["window"].tolist()
+    messages = anomalies.window_messages(events, [player_id] * len(rows), [starts[w] for w in rows])
+    by_hours = dict(zip([windows[w] for w in rows], build_responses(stats, [f"{windows[w]}h" for w in rows], messages)))
+    # Una entrada por valor pedido y en su orden; las ventanas vacías van como null
+    return [by_hours.get(h) for h in hours]
+
+@app.get("/analytics", response_model=RosterAnalytics)
+@coalesce(flight)
+def get_roster_analytics(
+    team: Optional[str] = Query(None, description="Equipo a analizar"),
+    player_ids: Optional[List[int]] = Query(None, description="Jugadores a analizar"),
+    hours: int = Query(8, description="Período de análisis en horas"),
+    db: Session = Depends(get_db)
+):
+    """Análisis de todo un roster con una sola consulta y un único pase vectorizado"""
+    if team is None and not player_ids:
+        raise HTTPException(status_code=400, detail="Indique un equipo o una lista de jugadores")
+    
+    query = db.query(PlayerDB)
+    if team is not None:
+        query = query.filter(PlayerDB.team == team)
+    if player_ids:
+        query = query.filter(PlayerDB.id.in_(player_ids))
+    players = query.order_by(PlayerDB.id).all()
+    if not players:
+        raise HTTPException(status_code=404, detail="No se encontraron jugadores")
+    roster = [p.id for p in players]
+    
     start_time = datetime.utcnow() - timedelta(hours=hours)
+    stats = compute_analytics(load_window(db, roster, start_time), rules.compile(players))
+    analysed = stats["player_id"].tolist()
+    anomalies.ensure_backfilled(db, [p for p in players if p.id in set(analysed)], start_time)
+    messages = anomalies.window_messages(
+        anomalies.load_events(db, analysed, start_time), analysed, [start_time] * len(analysed)
+    )
+    results = build_responses(stats, f"{hours}h", messages)
     
-    metrics = db.query(MetricDB).filter(
-        MetricDB.player_id == player_id,
-        MetricDB.timestamp >= start_time
-    ).all()
+    analysed = set(analysed)
+    return RosterAnalytics(
+        period=f"{hours}h",
+        team=team,
+        results=results,
+        players_without_metrics=[pid for pid in roster if pid not in analysed]
+    )
+
+@app.get("/players/{player_id}/anomalies", response_model=List[AnomalyEvent])
+def get_player_anomalies(
+    player_id: int,
+    hours: int = Query(24, description="Horas hacia atrás"),
+    until: Optional[datetime] = Query(None, description="Fin de la ventana (por defecto, ahora)"),
+    type: Optional[List[str]] = Query(None, description="Tipos: heart_rate_peak, low_oxygen, sudden_change o un detector (ewma_heart_rate...)"),
+    min_magnitude: Optional[int] = Query(None, description="Magnitud mínima del evento"),
+    limit: int = Query(500, ge=1, le=5000, description="Máximo de eventos"),
+    db: Session = Depends(get_db)
+):
+    """Eventos de anomalía detectados para un jugador, del más reciente al más antiguo"""
+    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    if type and not set(type) <= set(anomalies.EVENT_TYPES + detectors.event_types):
+        raise HTTPException(status_code=400, detail="Tipo de anomalía desconocido")
     
-    if not metrics:
-        raise HTTPException(status_code=404, detail="No hay métricas en el período especificado")
+    end_time = naive_utc(until) or datetime.utcnow()
+    anomalies.ensure_backfilled(db, [player], end_time - timedelta(hours=hours))
+    query = db.query(AnomalyEventDB).filter(
+        AnomalyEventDB.player_id == player_id,
+        AnomalyEventDB.timestamp >= end_time - timedelta(hours=hours),
+        AnomalyEventDB.timestamp <= end_time
+    )
+    if type:
+        query = query.filter(AnomalyEventDB.type.in_(type))
+    if min_magnitude is not None:
+        query = query.filter(AnomalyEventDB.magnitude >= min_magnitude)
+    return query.order_by(AnomalyEventDB.timestamp.desc(), AnomalyEventDB.id.desc()).limit(limit).all()
+
+# Percentiles a partir de sketches horarios fusionables
+def percentile_key(q: float) -> str:
+    return f"p{q * 100:g}"
+
+def percentile_bucket(sketch, qs: List[float], start: Optional[datetime] = None) -> PercentileBucket:
+    return PercentileBucket(
+        start=start,
+        count=sketch.count,
+        min=sketch.min if sketch.count else None,
+        max=sketch.max if sketch.count else None,
+        percentiles={percentile_key(q): value for q, value in zip(qs, sketch.quantiles(qs))}
+    )
+
+def percentiles_response(db: Session, player_ids: List[int], metric: str, hours: int,
+                         until: Optional[datetime], q: List[float], by: str) -> dict:
+    end_time = until or datetime.utcnow()
+    rows = sketches.query(db, player_ids, metric, end_time - timedelta(hours=hours), end_time)
+    
+    # Cada cubeta de la respuesta es la fusión de las horas (y jugadores) que agrupa
+    groups = {}
+    for _, start, sketch in rows:
+        if by == "day":
+            start = start.replace(hour=0)
+        groups.setdefault(start, []).append(sketch)
+    
+    buckets = [] if by == "none" else [
+        percentile_bucket(merge_sketches(group), q, start) for start, group in sorted(groups.items())
+    ]
+    return {
+        "metric": metric,
+        "relative_accuracy": RELATIVE_ACCURACY,
+        "overall": percentile_bucket(merge_sketches(s for _, _, s in rows), q),
+        "buckets": buckets,
+    }
+
+PERCENTILE_METRIC = Query("heart_rate", pattern="^(heart_rate|oxygen_saturation)$")
+PERCENTILE_BY = Query("hour", pattern="^(hour|day|none)$", description="Agrupación de las cubetas")
+
+def validate_quantiles(q: List[float]) -> List[float]:
+    if any(not 0 <= value <= 1 for value in q):
+        raise HTTPException(status_code=400, detail="Los cuantiles deben estar entre 0 y 1")
+    return q
+
+@app.get("/players/{player_id}/percentiles", response_model=PercentilesResponse)
+def get_player_percentiles(
+    player_id: int,
+    metric: str = PERCENTILE_METRIC,
+    hours: int = Query(24, ge=1, description="Horas hacia atrás"),
+    until: Optional[datetime] = Query(None, description="Fin del rango (por defecto, ahora)"),
+    q: List[float] = Query([0.5, 0.9, 0.99], description="Cuantiles"),
+    by: str = PERCENTILE_BY,
+    db: Session = Depends(get_db)
+):
+    """Percentiles aproximados (error relativo del 1%) de HR o SpO2 de un jugador"""
+    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    
+    response = percentiles_response(db, [player_id], metric, hours, until, validate_quantiles(q), by)
+    return PercentilesResponse(player_id=player_id, **response)
+
+@app.get("/teams/{team_name}/percentiles", response_model=PercentilesResponse)
+def get_team_percentiles(
+    team_name: str,
+    metric: str = PERCENTILE_METRIC,
+    hours: int = Query(24, ge=1, description="Horas hacia atrás"),
+    until: Optional[datetime] = Query(None, description="Fin del rango (por defecto, ahora)"),
+    q: List[float] = Query([0.5, 0.9, 0.99], description="Cuantiles"),
+    by: str = PERCENTILE_BY,
+    db: Session = Depends(get_db)
+):
+    """Percentiles del equipo: fusión de los sketches de todos sus jugadores"""
+    player_ids = [pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.team == team_name).all()]
+    if not player_ids:
+        raise HTTPException(status_code=404, detail="Equipo no encontrado")
+    
+    response = percentiles_response(db, player_ids, metric, hours, until, validate_quantiles(q), by)
+    return PercentilesResponse(team=team_name, **response)
+
+def zones_response(db: Session, player_ids: List[int], hours: int, hr_edges: List[float],
+                   o2_edges: List[float]) -> dict:
+    """Tiempo en zona de cada jugador y del conjunto, sobre la ventana terminada en window_now()"""
+    try:
+        edges = {"heart_rate": zones.validate_edges(hr_edges), "oxygen_saturation": zones.validate_edges(o2_edges)}
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    
+    end_time = window_now()
+    start_time = end_time - timedelta(hours=hours)
+    arrays = load_window(db, player_ids, start_time, end_time)
+    histograms = zones.zone_histograms(arrays, player_ids, end_time, edges)
+    
+    def response(per_metric: dict, **extra) -> dict:
+        return {"start": start_time, "end": end_time, **extra, **{
+            metric: zones.histogram_response(metric, edges[metric], h["seconds"], h["readings"])
+            for metric, h in per_metric.items()
+        }}
+    
+    players = [response(histograms[pid], player_id=pid) for pid in player_ids]
+    totals = {metric: {key: sum(histograms[pid][metric][key] for pid in player_ids) for key in ("seconds", "readings")}
+              for metric in edges}
+    return {"totals": response(totals), "players": players}
+
+HR_ZONE_EDGES = Query(zones.HEART_RATE_EDGES, description="Bordes de las zonas de HR (BPM)")
+O2_ZONE_EDGES = Query(zones.OXYGEN_EDGES, description="Bordes de las bandas de SpO2 (%)")
+
+@app.get("/players/{player_id}/zones", response_model=ZonesResponse)
+def get_player_zones(
+    player_id: int,
+    request: Request,
+    hours: int = Query(8, ge=1, le=24 * 30),
+    hr_edges: List[float] = HR_ZONE_EDGES,
+    o2_edges: List[float] = O2_ZONE_EDGES,
+    db: Session = Depends(get_db)
+):
+    """Minutos en cada zona de HR y banda de SpO2, ponderados por el intervalo entre lecturas"""
+    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    
+    etag = make_etag("zones", player_id, versions.player(player_id), hours, hr_edges, o2_edges, window_now())
+
+    def build():
+        response = zones_response(db, [player_id], hours, hr_edges, o2_edges)["players"][0]
+        with timed_serialization():
+            return ZonesResponse(**response).model_dump_json().encode(), {}
+    return conditional_response(request, etag, SHORT_LIVED, build)
+
+@app.get("/teams/{team_name}/zones", response_model=ZonesResponse)
+def get_team_zones(
+    team_name: str,
+    request: Request,
+    hours: int = Query(8, ge=1, le=24 * 30),
+    hr_edges: List[float] = HR_ZONE_EDGES,
+    o2_edges: List[float] = O2_ZONE_EDGES,
+    db: Session = Depends(get_db)
+):
+    """Tiempo en zona sumado del equipo, con el desglose de cada jugador"""
+    player_ids = sorted(pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.team == team_name).all())
+    if not player_ids:
+        raise HTTPException(status_code=404, detail="Equipo no encontrado")
     
-    # Cálculos estadísticos
-    heart_rates = [m.heart_rate for m in metrics]
-    oxygen_levels = [m.oxygen_saturation for m in metrics]
+    etag = make_etag("team-zones", team_name, versions.roster(), versions.team(team_name),
+                     hours, hr_edges, o2_edges, window_now())
+    
+    def build():
+        response = zones_response(db, player_ids, hours, hr_edges, o2_edges)
+        with timed_serialization():
+            return ZonesResponse(team=team_name, players=response["players"], **response["totals"]).model_dump_json().encode(), {}
+    return conditional_response(request, etag, SHORT_LIVED, build)
+
+# Endpoints de eventos de partida
+@app.post("/events", response_model=List[MatchEvent])
+def create_match_events(events: List[MatchEventCreate], db: Session = Depends(get_db)):
+    """Registrar un lote de eventos de partida (peleas, muertes, objetivos...)"""
+    player_ids = {event.player_id for event in events}
+    existing = {pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.id.in_(player_ids)).all()}
+    if player_ids - existing:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    
+    now = datetime.utcnow()
+    db_events = []
+    for event in events:
+        start = event.timestamp or now
+        end = event.end_timestamp or start
+        if end < start:
+            raise HTTPException(status_code=400, detail="end_timestamp anterior a timestamp")
+        db_events.append(MatchEventDB(**{**event.dict(), "timestamp": start, "end_timestamp": end}))
+    db.add_all(db_events)
+    db.commit()
+    for event in db_events:
+        db.refresh(event)
+    return db_events
+
+@app.get("/events", response_model=List[MatchEvent])
+def get_match_events(
+    match_id: Optional[str] = None,
+    player_id: Optional[int] = None,
+    type: Optional[List[str]] = Query(None, description="Tipos de evento"),
+    start: Optional[datetime] = Query(None, description="Eventos que terminan a partir de este instante"),
+    end: Optional[datetime] = Query(None, description="Eventos que empiezan antes de este instante"),
+    db: Session = Depends(get_db)
+):
+    """Eventos de partida que solapan el rango pedido"""
+    player_ids = [player_id] if player_id is not None else None
+    return match_events.load_events(db, player_ids, match_id, type, start, end)
+
+@app.get("/events/response", response_model=EventResponseAnalysis)
+def get_event_response(
+    type: Optional[List[str]] = Query(None, description="Tipos de evento (por defecto, todos)"),
+    match_id: Optional[str] = None,
+    player_id: Optional[int] = None,
+    team: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    before: float = Query(30, ge=0, description="Segundos antes del evento"),
+    after: float = Query(60, ge=0, description="Segundos después del evento"),
+    step: float = Query(5, gt=0, description="Resolución de la traza en segundos"),
+    max_gap: float = Query(match_events.MAX_GAP_SECONDS, gt=0, description="Hueco máximo entre lecturas a interpolar"),
+    db: Session = Depends(get_db)
+):
+    """Respuesta de HR promediada sobre todos los eventos, alineada en el instante de cada uno"""
+    player_ids = [player_id] if player_id is not None else None
+    if team is not None:
+        team_ids = [pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.team == team).all()]
+        player_ids = [pid for pid in team_ids if player_ids is None or pid in player_ids]
     
-    avg_heart_rate = sum(heart_rates) / len(heart_rates)
-    avg_oxygen = sum(oxygen_levels) / len(oxygen_levels)
+    events = match_events.load_events(db, player_ids, match_id, type, start, end)
+    try:
+        return match_events.event_locked(db, events, before, after, step, max_gap)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+# Endpoints de partidas (sesiones)
+def get_match_or_404(db: Session, match_id: str) -> MatchDB:
+    match = db.query(MatchDB).filter(MatchDB.id == match_id).first()
+    if not match:
+        raise HTTPException(status_code=404, detail="Partida no encontrada")
+    return match
+
+@app.post("/matches", response_model=Match)
+def create_match(match: MatchCreate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Crear una partida; si ya trae fin, se agrega en segundo plano"""
+    player_ids = set(match.player_ids)
+    existing = {pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.id.in_(player_ids)).all()}
+    if player_ids - existing:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    if match.id is not None and db.query(MatchDB).filter(MatchDB.id == match.id).first():
+        raise HTTPException(status_code=409, detail="La partida ya existe")
     
-    max_heart_rate = max(heart_rates)
-    min_heart_rate = min(heart_rates)
-    max_oxygen = max(oxygen_levels)
-    min_oxygen = min(oxygen_levels)
+    now = datetime.utcnow()
+    start_time = match.start_time or now
+    if match.end_time is not None and not start_time <= match.end_time <= now:
+        raise HTTPException(status_code=400, detail="end_time debe estar entre start_time y ahora")
     
-    # Calcular HRV (Variabilidad del Ritmo Cardíaco)
-    if len(heart_rates) > 1:
-        hrv = statistics.stdev(heart_rates)
+    db_match = MatchDB(
+        id=match.id or matches.new_match_id(), name=match.name, start_time=start_time, end_time=match.end_time,
+        status=matches.OPEN if match.end_time is None else matches.CLOSED,
+        players=[MatchPlayerDB(player_id=pid) for pid in sorted(player_ids)]
+    )
+    db.add(db_match)
+    db.commit()
+    db.refresh(db_match)
+    if db_match.status == matches.CLOSED:
+        background_tasks.add_task(matches.aggregate_match, db_match.id)
+    return matches.match_dict(db_match)
+
+@app.post("/matches/{match_id}/close", response_model=Match)
+def close_match(match_id: str, close: MatchClose, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Cerrar una partida y encolar el cálculo de sus agregados"""
+    match = get_match_or_404(db, match_id)
+    if match.status != matches.OPEN:
+        raise HTTPException(status_code=409, detail="La partida ya está cerrada")
+    
+    end_time = close.end_time or datetime.utcnow()
+    if not match.start_time <= end_time <= datetime.utcnow():
+        raise HTTPException(status_code=400, detail="end_time debe estar entre start_time y ahora")
+    match.end_time = end_time
+    match.status = matches.CLOSED
+    db.commit()
+    db.refresh(match)
+    background_tasks.add_task(matches.aggregate_match, match.id)
+    return matches.match_dict(match)
+
+@app.get("/matches", response_model=List[Match])
+def get_matches(
+    start: Optional[datetime] = Query(None, description="Partidas que terminan a partir de este instante"),
+    end: Optional[datetime] = Query(None, description="Partidas que empiezan antes de este instante"),
+    player_id: Optional[int] = None,
+    status: Optional[str] = Query(None, pattern="^(open|closed|aggregated)$"),
+    db: Session = Depends(get_db)
+):
+    """Partidas que solapan el rango pedido (índice de intervalos)"""
+    return [matches.match_dict(m) for m in matches.find_matches(db, start, end, player_id, status)]
+
+@app.get("/matches/{match_id}", response_model=Match)
+def get_match(match_id: str, db: Session = Depends(get_db)):
+    return matches.match_dict(get_match_or_404(db, match_id))
+
+@app.get("/matches/{match_id}/analytics", response_model=MatchAnalytics)
+def get_match_analytics(match_id: str, db: Session = Depends(get_db)):
+    """Agregados por jugador y equipo: precalculados si la partida ya se agregó"""
+    match = get_match_or_404(db, match_id)
+    final = match.status == matches.AGGREGATED
+    aggregates = matches.load_aggregates(db, match_id) if final else matches.compute_aggregates(db, match)
+    return {"match": matches.match_dict(match), "final": final, **matches.split_scopes(aggregates)}
+
+@app.post("/admin/matches/{match_id}/aggregate", response_model=Match)
+def recompute_match(match_id: str, db: Session = Depends(get_db)):
+    """Recalcular los agregados de una partida cerrada (p.ej. tras cambiar las reglas)"""
+    match = get_match_or_404(db, match_id)
+    if match.status == matches.OPEN:
+        raise HTTPException(status_code=409, detail="La partida sigue abierta")
+    matches.store_aggregates(db, match)
+    db.refresh(match)
+    return matches.match_dict(match)
+
+@app.get("/teams/{team_name}/synchrony", response_model=SynchronyResponse)
+def get_team_synchrony(
+    team_name: str,
+    match_id: Optional[str] = Query(None, description="Partida a analizar (por defecto, las últimas horas)"),
+    hours: float = Query(1, gt=0, le=24),
+    step: float = Query(5, gt=0, description="Paso de la rejilla común en segundos"),
+    max_lag: float = Query(60, ge=0, description="Desfase máximo en segundos"),
+    max_gap: float = Query(match_events.MAX_GAP_SECONDS, gt=0, description="Hueco máximo entre lecturas a interpolar"),
+    db: Session = Depends(get_db)
+):
+    """Sincronía de HR entre los jugadores del equipo: correlación cruzada por FFT"""
+    player_ids = sorted(pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.team == team_name).all())
+    if not player_ids:
+        raise HTTPException(status_code=404, detail="Equipo no encontrado")
+    
+    if match_id is not None:
+        match = get_match_or_404(db, match_id)
+        participants = {p.player_id for p in match.players}
+        player_ids = [pid for pid in player_ids if pid in participants]
+        start_time, end_time = match.start_time, match.end_time or datetime.utcnow()
     else:
-        hrv = 0
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
     
-    # Determinar estado del jugador
-    status = "normal"
-    anomalies = []
-    
-    if max_heart_rate > 110 or min_oxygen < 95:
-        status = "fatigue"
-    if max_heart_rate > 120 or min_oxygen < 94:
-        status = "risk"
-    
-    # Detectar anomalías
-    if max_heart_rate > 110:
-        anomalies.append(f"Pico de ritmo cardíaco elevado: {max_heart_rate} BPM")
-    if min_oxygen < 95:
-        anomalies.append(f"Oxigenación baja detectada: {min_oxygen}%")
-    
-    # Detectar cambios bruscos en HR
-    for i in range(1, len(heart_rates)):
-        change = abs(heart_rates[i] - heart_rates[i-1])
-        if change > 20:
-            anomalies.append(f"Cambio brusco en HR: {change} BPM")
-            break
-    
-    # Calcular tendencias (últimas 4 lecturas vs primeras 4)
-    recent_hr = heart_rates[-4:] if len(heart_rates) >= 4 else heart_rates
-    recent_o2 = oxygen_levels[-4:] if len(oxygen_levels) >= 4 else oxygen_levels
-    older_hr = heart_rates[:4] if len(heart_rates) >= 4 else heart_rates
-    older_o2 = oxygen_levels[:4] if len(oxygen_levels) >= 4 else oxygen_levels
-    
-    trend_hr = (sum(recent_hr)/len(recent_hr) - sum(older_hr)/len(older_hr)) if older_hr else 0
-    trend_o2 = (sum(recent_o2)/len(recent_o2) - sum(older_o2)/len(older_o2)) if older_o2 else 0
-    
-    return AnalyticsResponse(
-        player_id=player_id,
-        period=f"{hours}h",
-        avg_heart_rate=round(avg_heart_rate, 1),
-        avg_oxygen_saturation=round(avg_oxygen, 1),
-        max_heart_rate=max_heart_rate,
-        min_heart_rate=min_heart_rate,
-        max_oxygen=max_oxygen,
-        min_oxygen=min_oxygen,
-        hrv=round(hrv, 1),
-        status=status,
-        anomalies=anomalies,
-        trend_heart_rate=round(trend_hr, 1),
-        trend_oxygen=round(trend_o2, 1)
+    try:
+        series = synchrony.resample(db, player_ids, start_time, end_time, step, max_gap)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return SynchronyResponse(
+        team=team_name, match_id=match_id, start=start_time, end=end_time, step=step, max_lag=max_lag,
+        player_ids=player_ids, **synchrony.synchrony(series, step, max_lag)
+    )
+
+# Endpoints del canal RR y HRV
+@app.post("/players/{player_id}/rr", response_model=RRChunk)
+def create_rr_batch(player_id: int, batch: RRBatch, db: Session = Depends(get_db)):
+    """Registrar un lote de intervalos RR (latido a latido) de la banda pectoral"""
+    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    try:
+        return hrv.ingest(db, player_id, batch.intervals_ms, batch.start_time)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+HRV_WINDOW = Query(300, ge=30, le=3600, description="Longitud de cada ventana en segundos")
+HRV_STEP = Query(60, ge=5, description="Desplazamiento entre ventanas en segundos")
+
+def hrv_windows(db: Session, player_ids: List[int], hours: float, window: float, step: float):
+    end_time = datetime.utcnow()
+    try:
+        return hrv.windows(db, player_ids, end_time - timedelta(hours=hours), end_time, window, step)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@app.get("/players/{player_id}/hrv", response_model=HRVResponse)
+def get_player_hrv(
+    player_id: int,
+    hours: float = Query(1, gt=0, le=24),
+    window: float = HRV_WINDOW,
+    step: float = HRV_STEP,
+    db: Session = Depends(get_db)
+):
+    """HRV real (RMSSD, SDNN, pNN50, LF/HF) por ventanas deslizantes del canal RR"""
+    player = db.query(PlayerDB).filter(PlayerDB.id == player_id).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    windows = hrv_windows(db, [player_id], hours, window, step)
+    return HRVResponse(player_id=player_id, window=window, step=step, windows=windows[player_id])
+
+@app.get("/teams/{team_name}/hrv", response_model=TeamHRVResponse)
+def get_team_hrv(
+    team_name: str,
+    hours: float = Query(1, gt=0, le=24),
+    window: float = HRV_WINDOW,
+    step: float = HRV_STEP,
+    db: Session = Depends(get_db)
+):
+    """HRV de todos los jugadores del equipo, calculada en un solo lote"""
+    player_ids = sorted(pid for (pid,) in db.query(PlayerDB.id).filter(PlayerDB.team == team_name).all())
+    if not player_ids:
+        raise HTTPException(status_code=404, detail="Equipo no encontrado")
+    windows = hrv_windows(db, player_ids, hours, window, step)
+    return TeamHRVResponse(team=team_name, window=window, step=step, players=[
+        HRVResponse(player_id=pid, window=window, step=step, windows=windows[pid]) for pid in player_ids
+    ])
+
+# Endpoints de canales de sensores
+def get_channel_or_404(name: str) -> dict:
+    channel = channels.registry.get(name)
+    if channel is None:
+        raise HTTPException(status_code=404, detail="Canal no encontrado")
+    return channel
+
+def channel_window(start: Optional[datetime], end: Optional[datetime], minutes: float):
+    start, end = naive_utc(start), naive_utc(end)
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(minutes=minutes)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start debe ser anterior a end")
+    return start, end
+
+@app.get("/channels", response_model=List[ChannelDefinition])
+def get_channels():
+    """Canales de sensores registrados"""
+    return channels.registry.all()
+
+@app.post("/admin/channels", response_model=ChannelDefinition)
+def create_channel(definition: ChannelDefinition, db: Session = Depends(get_db)):
+    """Registrar un canal nuevo (sin cambios de esquema)"""
+    try:
+        return channels.registry.register(db, definition.dict())
+    except channels.ChannelError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@app.post("/players/{player_id}/channels/{channel_name}", response_model=ChannelWrite)
+def create_channel_samples(player_id: int, channel_name: str, batch: ChannelBatch, db: Session = Depends(get_db)):
+    """Registrar un lote de muestras regulares de un canal"""
+    channel = get_channel_or_404(channel_name)
+    if not db.query(PlayerDB.id).filter(PlayerDB.id == player_id).first():
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    try:
+        chunks = channels.ingest(db, player_id, channel, batch.samples, batch.start_time, batch.timestamps)
+    except channels.ChannelError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return ChannelWrite(
+        player_id=player_id, channel=channel_name, chunks=len(chunks), count=sum(c.count for c in chunks),
+        start_time=chunks[0].start_time, end_time=chunks[-1].end_time
+    )
+
+@app.get("/players/{player_id}/channels/{channel_name}", response_model=ChannelRange)
+def get_channel_samples(
+    player_id: int,
+    channel_name: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    minutes: float = Query(10, gt=0, description="Rango por defecto si no se indica start"),
+    max_points: int = Query(100000, ge=1, le=1000000),
+    db: Session = Depends(get_db)
+):
+    """Muestras en bruto de un canal en un rango"""
+    channel = get_channel_or_404(channel_name)
+    start, end = channel_window(start, end, minutes)
+    expected = channels.points_for(channel, start, end)
+    if expected is not None and expected > max_points:
+        raise HTTPException(status_code=400, detail="Demasiadas muestras; usa /rollup o un rango menor")
+    
+    series = channels.load_range(db, player_id, channel, start, end)
+    if len(series) > max_points:
+        raise HTTPException(status_code=400, detail="Demasiadas muestras; usa /rollup o un rango menor")
+    return ChannelRange(
+        player_id=player_id, channel=channel_name, unit=channel["unit"], components=channel["components"],
+        start=start, end=end, count=len(series),
+        offsets=np.round(series.time - channels.seconds_of(start), 6).tolist(), values=np.round(series.values, 6).tolist()
+    )
+
+@app.get("/players/{player_id}/channels/{channel_name}/rollup", response_model=ChannelRollup)
+def get_channel_rollup(
+    player_id: int,
+    channel_name: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    minutes: float = Query(60, gt=0, description="Rango por defecto si no se indica start"),
+    bucket: float = Query(60, gt=0, description="Tamaño de cubeta en segundos"),
+    db: Session = Depends(get_db)
+):
+    """Conteo, media, mínimo y máximo por cubeta de cualquier canal"""
+    channel = get_channel_or_404(channel_name)
+    start, end = channel_window(start, end, minutes)
+    series = channels.load_range(db, player_id, channel, start, end)
+    return ChannelRollup(
+        player_id=player_id, channel=channel_name, unit=channel["unit"], bucket=bucket, start=start, end=end,
+        buckets=channels.rollup(series, start, bucket)
+    )
+
+@app.get("/players/{player_id}/aligned", response_model=AlignedSeries)
+def get_aligned_streams(
+    player_id: int,
+    streams: List[str] = Query(["heart_rate", "oxygen_saturation"], description="Canales o metrics.heart_rate / metrics.oxygen_saturation"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    minutes: float = Query(60, gt=0, description="Rango por defecto si no se indica start"),
+    mode: str = Query("asof", pattern="^(asof|interpolate)$"),
+    step: float = Query(5, gt=0, description="Paso de la rejilla regular en segundos"),
+    base: Optional[str] = Query(None, description="Alinear a los instantes de este flujo en lugar de a la rejilla"),
+    tolerance: Optional[float] = Query(None, gt=0, description="asof: antigüedad máxima del último valor (por defecto, max_gap)"),
+    max_gap: float = Query(30, gt=0, description="Hueco máximo interpolable y umbral de detección de huecos"),
+    max_points: int = Query(100000, ge=1, le=1000000),
+    db: Session = Depends(get_db)
+):
+    """Flujos independientes alineados bajo demanda (as-of o interpolación) y sus huecos"""
+    if not db.query(PlayerDB.id).filter(PlayerDB.id == player_id).first():
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    start, end = channel_window(start, end, minutes)
+    tolerance = tolerance or max_gap
+    origin, finish = channels.seconds_of(start), channels.seconds_of(end)
+    
+    # Se carga un margen alrededor del rango: el primer punto necesita la muestra
+    # anterior a start (y en interpolación, el último la posterior a end)
+    before, after = alignment.margin(mode, tolerance, max_gap)
+    names = list(dict.fromkeys(streams + ([base] if base else [])))
+    try:
+        loaded = alignment.load_streams(db, player_id, names, start - timedelta(seconds=before),
+                                        end + timedelta(seconds=after))
+    except alignment.UnknownStream as exc:
+        raise HTTPException(status_code=404, detail=f"Flujo desconocido: {exc.args[0]}")
+    
+    if base is not None:
+        if base not in loaded:
+            raise HTTPException(status_code=400, detail="base debe ser un flujo de una sola componente")
+        targets = alignment.clip(loaded[base], origin, finish).time
+    elif (end - start).total_seconds() / step > max_points:
+        raise HTTPException(status_code=400, detail="Demasiados puntos; aumenta step")
+    else:
+        targets = alignment.regular_grid(start, end, step)
+    if len(targets) > max_points:
+        raise HTTPException(status_code=400, detail="Demasiados puntos en el flujo base")
+    
+    aligned = {name: stream for name, stream in loaded.items() if name != base or base in streams}
+    return AlignedSeries(
+        player_id=player_id, mode=mode, start=start, end=end,
+        offsets=np.round(targets - origin, 6).tolist(),
+        series=alignment.align(aligned, targets, mode, tolerance, max_gap),
+        gaps={name: alignment.gaps(alignment.clip(stream, origin, finish), origin, finish, max_gap)
+              for name, stream in aligned.items()}
+    )
+
+@app.get("/aggregates")
+def get_aggregates(
+    by: str = Query("team", description="Dimensión: player, team, role, country o global"),
+    hours: float = Query(AGGREGATION_HOURS, gt=0, le=AGGREGATION_HOURS, description="Ventana en horas"),
+):
+    """Group-by sobre los agregados incrementales en memoria (sin consultar lecturas)"""
+    if by not in AGGREGATION_DIMENSIONS:
+        raise HTTPException(status_code=400, detail="Dimensión desconocida")
+    return [{"group": key, **summary} for key, summary in tree.group_by(by, hours).items()]
+
+@app.get("/leaderboard", response_model=LeaderboardResponse)
+def get_leaderboard(
+    metric: str = Query("risk", description="heart_rate, oxygen_saturation (de menor a mayor), strain o risk"),
+    k: int = Query(10, ge=1, le=500),
+    team: Optional[str] = None,
+    role: Optional[str] = None,
+    max_age: Optional[float] = Query(None, gt=0, description="Ignorar jugadores sin lecturas en estos segundos"),
+    db: Session = Depends(get_db)
+):
+    """Top-k del roster según la última lectura de cada jugador, desde índices en memoria"""
+    if metric not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=400, detail="Métrica desconocida")
+    
+    # Strain y nivel dependen de las reglas: si han cambiado, recalcular
+    rules.refresh()
+    if leaderboard.version != rules.version:
+        leaderboard.rebuild(db, db.query(PlayerDB).all())
+    
+    entries = leaderboard.top(metric, k, team, role, max_age)
+    return LeaderboardResponse(
+        metric=metric, k=k, team=team, role=role, total=leaderboard.size(team, role),
+        entries=[{"rank": rank, **entry} for rank, entry in enumerate(entries, 1)]
     )
 
 @app.get("/players/{player_id}/summary", response_model=PlayerMetrics)
@@ -225,46 +1143,32 @@ def get_player_summary(player_id: int, db: Session = Depends(get_db)):
 
 # Endpoints de Equipos y Estadísticas Globales
 @app.get("/teams/{team_name}/stats", response_model=TeamStats)
-def get_team_stats(team_name: str, db: Session = Depends(get_db)):
+def get_team_stats_endpoint(team_name: str, request: Request, db: Session = Depends(get_db)):
     """Obtener estadísticas de un equipo completo"""
+    etag = make_etag("team", team_name, versions.roster(), versions.team(team_name), rules.version, window_now())
+
+    def build():
+        stats = get_team_stats(team_name, db)
+        with timed_serialization():
+            return stats.model_dump_json().encode(), {}
+    return conditional_response(request, etag, SHORT_LIVED, build)
+
+def get_team_stats(team_name: str, db: Session) -> TeamStats:
+    """Calcular las estadísticas de un equipo (sin capa de caché)"""
     players = db.query(PlayerDB).filter(PlayerDB.team == team_name).all()
     
     if not players:
         raise HTTPException(status_code=404, detail="Equipo no encontrado")
     
-    team_heart_rates = []
-    team_oxygen_levels = []
-    players_status = {}
+    # Agregados en memoria del árbol de agregación: sin leer lecturas
+    players = sorted(players, key=lambda p: p.id)
+    summaries = tree.group_by("player", 4, [p.id for p in players])
+    statuses = tree.player_status(players, 4)
     
-    for player in players:
-        # Obtener métricas recientes de cada jugador
-        start_time = datetime.utcnow() - timedelta(hours=4)
-        metrics = db.query(MetricDB).filter(
-            MetricDB.player_id == player.id,
-            MetricDB.timestamp >= start_time
-        ).all()
-        
-        if metrics:
-            heart_rates = [m.heart_rate for m in metrics]
-            oxygen_levels = [m.oxygen_saturation for m in metrics]
-            
-            avg_hr = sum(heart_rates) / len(heart_rates)
-            avg_o2 = sum(oxygen_levels) / len(oxygen_levels)
-            
-            team_heart_rates.append(avg_hr)
-            team_oxygen_levels.append(avg_o2)
-            
-            # Determinar estado individual
-            max_hr = max(heart_rates)
-            min_o2 = min(oxygen_levels)
-            
-            status = "normal"
-            if max_hr > 110 or min_o2 < 95:
-                status = "fatigue"
-            if max_hr > 120 or min_o2 < 94:
-                status = "risk"
-                
-            players_status[player.name] = status
+    players_status = {p.name: statuses[p.id] for p in players if p.id in statuses}
+    with_data = [summaries[p.id] for p in players if p.id in statuses]
+    team_heart_rates = [summary["avg_heart_rate"] for summary in with_data]
+    team_oxygen_levels = [summary["avg_oxygen_saturation"] for summary in with_data]
     
     avg_team_hr = sum(team_heart_rates) / len(team_heart_rates) if team_heart_rates else 0
     avg_team_o2 = sum(team_oxygen_levels) / len(team_oxygen_levels) if team_oxygen_levels else 0
@@ -278,38 +1182,22 @@ def get_team_stats(team_name: str, db: Session = Depends(get_db)):
     )
 
 @app.get("/dashboard/overview")
+@coalesce(flight)
 def get_dashboard_overview(db: Session = Depends(get_db)):
     """Vista general del dashboard con estadísticas globales"""
     total_players = db.query(PlayerDB).count()
     teams = db.query(PlayerDB.team).distinct().all()
     total_teams = len(teams)
     
-    # Obtener todas las métricas recientes (últimas 4 horas)
-    start_time = datetime.utcnow() - timedelta(hours=4)
-    recent_metrics = db.query(MetricDB).filter(MetricDB.timestamp >= start_time).all()
-    
-    if recent_metrics:
-        heart_rates = [m.heart_rate for m in recent_metrics]
-        oxygen_levels = [m.oxygen_saturation for m in recent_metrics]
+    # Últimas 4 horas desde el árbol de agregación en memoria
+    overall = tree.group_by("global", 4).get(None, {"count": 0})
+    if overall["count"]:
+        global_avg_hr = overall["avg_heart_rate"]
+        global_avg_o2 = overall["avg_oxygen_saturation"]
         
-        global_avg_hr = sum(heart_rates) / len(heart_rates)
-        global_avg_o2 = sum(oxygen_levels) / len(oxygen_levels)
-        
-        # Jugadores en riesgo
-        players_at_risk = 0
-        players = db.query(PlayerDB).all()
-        for player in players:
-            player_metrics = db.query(MetricDB).filter(
-                MetricDB.player_id == player.id,
-                MetricDB.timestamp >= start_time
-            ).all()
-            
-            if player_metrics:
-                player_hr = [m.heart_rate for m in player_metrics]
-                player_o2 = [m.oxygen_saturation for m in player_metrics]
-                
-                if max(player_hr) > 120 or min(player_o2) < 94:
-                    players_at_risk += 1
+        # Jugadores en el nivel más grave de las reglas
+        statuses = tree.player_status(db.query(PlayerDB).all(), 4)
+        players_at_risk = sum(1 for status in statuses.values() if status == rules.levels()[-1])
     else:
         global_avg_hr = 0
         global_avg_o2 = 0
@@ -324,6 +1212,197 @@ def get_dashboard_overview(db: Session = Depends(get_db)):
         "last_updated": datetime.utcnow()
     }
 
+# Difusión WebSocket para espectadores
+def team_broadcast_payload(team_name: str) -> dict:
+    with SessionLocal() as db:
+        return get_team_stats(team_name, db).model_dump(mode="json")
+
+def player_broadcast_payload(player_id: int) -> dict:
+    with SessionLocal() as db:
+        metric = db.query(MetricDB).filter(
+            MetricDB.player_id == player_id
+        ).order_by(MetricDB.timestamp.desc()).first()
+        latest = Metric.model_validate(metric).model_dump(mode="json") if metric else None
+    return {"player_id": player_id, "latest": latest}
+
+def overview_broadcast_payload() -> dict:
+    with SessionLocal() as db:
+        return get_dashboard_overview(db)
+
+@app.websocket("/ws/teams/{team_name}")
+async def ws_team(websocket: WebSocket, team_name: str):
+    """Estadísticas del equipo difundidas una vez por tick a todos los espectadores"""
+    with SessionLocal() as db:
+        exists = db.query(PlayerDB.id).filter(PlayerDB.team == team_name).first()
+    if not exists:
+        await websocket.close(code=1008)
+        return
+    await broadcaster.serve(websocket, f"team:{team_name}", lambda: team_broadcast_payload(team_name))
+
+@app.websocket("/ws/players/{player_id}")
+async def ws_player(websocket: WebSocket, player_id: int):
+    """Última lectura de un jugador difundida a todos los espectadores"""
+    with SessionLocal() as db:
+        exists = db.query(PlayerDB.id).filter(PlayerDB.id == player_id).first()
+    if not exists:
+        await websocket.close(code=1008)
+        return
+    await broadcaster.serve(websocket, f"player:{player_id}", lambda: player_broadcast_payload(player_id))
+
+@app.websocket("/ws/overview")
+async def ws_overview(websocket: WebSocket):
+    """Vista general del dashboard difundida a todos los espectadores"""
+    await broadcaster.serve(websocket, "overview", overview_broadcast_payload)
+
+@app.get("/broadcast/stats")
+def get_broadcast_stats():
+    """Conexiones activas, descartes y envíos por canal de difusión"""
+    return broadcaster.stats()
+
+@app.get("/admin/rules")
+def get_health_rules():
+    """Reglas de estado vigentes (se recargan al editar config/health_rules.json)"""
+    return {"version": rules.version, "path": rules.path, "rules": rules.config}
+
+@app.post("/admin/anomalies/recompute")
+def recompute_anomalies(
+    hours: int = Query(anomalies.BACKFILL_HOURS, ge=1, description="Ventana a recalcular"),
+    db: Session = Depends(get_db)
+):
+    """Recalcular los eventos de anomalía (p.ej. tras cambiar las reglas)"""
+    events = anomalies.backfill(db, db.query(PlayerDB).all(), datetime.utcnow() - timedelta(hours=hours))
+    return {"hours": hours, "events": events}
+
+@app.get("/players/{player_id}/quality", response_model=QualityReport)
+def get_player_quality(
+    player_id: int,
+    hours: int = Query(24, ge=1, description="Horas hacia atrás"),
+    db: Session = Depends(get_db)
+):
+    """Lecturas marcadas por el filtro de calidad y recuento por motivo"""
+    if not db.query(PlayerDB.id).filter(PlayerDB.id == player_id).first():
+        raise HTTPException(status_code=404, detail="Jugador no encontrado")
+    start_time = datetime.utcnow() - timedelta(hours=hours)
+    return QualityReport(player_id=player_id, hours=hours, **quality_report(db, player_id, start_time))
+
+@app.post("/admin/quality/reprocess")
+def reprocess_quality(
+    hours: int = Query(anomalies.BACKFILL_HOURS, ge=1, description="Ventana a reprocesar"),
+    db: Session = Depends(get_db)
+):
+    """Recalcular las marcas de calidad del histórico y lo que se calcula sin las lecturas marcadas"""
+    players = db.query(PlayerDB).all()
+    start_time = datetime.utcnow() - timedelta(hours=hours)
+    result = quality.reprocess(db, players, start_time)
+    
+    alerts.reset()
+    events = anomalies.backfill(db, players, start_time)
+    events += detectors.backfill(db, players, start_time, resume=False)
+    sketches.backfill(db, players, start_time)
+    tree.rebuild(db, players)
+    leaderboard.rebuild(db, players)
+    for match in matches.find_matches(db, start_time, status=matches.AGGREGATED):
+        matches.store_aggregates(db, match)
+    versions.bump_history(players)
+    return {"hours": hours, **result, "events": events}
+
+@app.get("/players/{player_id}/detectors")
+def get_player_detectors(player_id: int):
+    """Estado actual de los detectores estadísticos de un jugador"""
+    snapshot = detectors.snapshot(player_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Sin estado de detectores para este jugador")
+    return snapshot
+
+@app.get("/admin/detectors")
+def get_detectors_config():
+    return {
+        "detectors": [{"type": d.event_type, **d.params()} for d in detectors.detectors],
+        "tracked_players": len(detectors.snapshot()),
+    }
+
+@app.post("/admin/detectors/checkpoint")
+def checkpoint_detectors(db: Session = Depends(get_db)):
+    """Guardar el estado de los detectores (también se hace al apagar)"""
+    return {"players": detectors.checkpoint(db)}
+
+@app.post("/admin/detectors/backfill")
+def backfill_detectors(
+    hours: int = Query(anomalies.BACKFILL_HOURS, ge=1, description="Ventana a reprocesar"),
+    resume: bool = Query(False, description="Continuar desde el estado actual en lugar de empezar de cero"),
+    db: Session = Depends(get_db)
+):
+    """Reconstruir el estado de los detectores y sus eventos desde el histórico"""
+    events = detectors.backfill(db, db.query(PlayerDB).all(), datetime.utcnow() - timedelta(hours=hours), resume)
+    return {"hours": hours, "resume": resume, "events": events}
+
+@app.get("/singleflight/stats")
+def get_singleflight_stats():
+    """Aciertos, peticiones coalescidas y fallos de la capa single-flight"""
+    return flight.stats()
+
+def runtime_collector():
+    """Contadores de las capas de caché y tiempo real para la exposición Prometheus"""
+    cache = response_cache.stats()
+    coalescing = flight.stats()
+    broadcast = broadcaster.stats()
+    yield ("response_cache_entries", "gauge", "Respuestas serializadas en el LRU", {}, cache["entries"])
+    yield ("response_cache_requests_total", "counter", "Consultas al LRU de respuestas", {"result": "hit"}, cache["hits"])
+    yield ("response_cache_requests_total", "counter", "Consultas al LRU de respuestas", {"result": "miss"}, cache["misses"])
+    for result in ("hits", "coalesced", "misses"):
+        yield ("singleflight_requests_total", "counter", "Peticiones por resultado single-flight", {"result": result}, coalescing[result])
+    yield ("sse_subscribers", "gauge", "Suscriptores SSE activos", {}, hub.subscriber_count())
+    for name, channel in broadcast["channels"].items():
+        yield ("broadcast_connections", "gauge", "Conexiones WebSocket por canal", {"channel": name}, channel["connections"])
+        yield ("broadcast_dropped_total", "counter", "Clientes lentos descartados por canal", {"channel": name}, channel["dropped"])
+
+registry.register_collector(runtime_collector)
+
+@app.get("/metrics/prometheus", response_class=PlainTextResponse)
+def get_prometheus_metrics():
+    """Exposición de métricas en formato de texto de Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+# Administración del perfilado bajo demanda
+PROFILE_FORMATS = {
+    "pstats": "application/octet-stream",
+    "collapsed": "text/plain",
+    "allocations": "text/plain",
+}
+
+@app.get("/admin/profiling", response_model=ProfilingConfig)
+def get_profiling_config():
+    """Configuración actual del perfilado"""
+    return profiler.config()
+
+@app.put("/admin/profiling", response_model=ProfilingConfig)
+def update_profiling_config(config: ProfilingConfig):
+    """Activar, desactivar o ajustar el perfilado sin reiniciar el servidor"""
+    profiler.configure(**config.dict())
+    return profiler.config()
+
+@app.get("/admin/profiling/profiles", response_model=List[ProfileInfo])
+def list_profiles():
+    """Perfiles capturados más recientes"""
+    return [result.info() for result in reversed(profiler.results)]
+
+@app.get("/admin/profiling/profiles/{profile_id}/{fmt}")
+def get_profile(profile_id: int, fmt: str):
+    """Descargar un perfil como pstats, pilas collapsed (flamegraph) o asignaciones"""
+    if fmt not in PROFILE_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato no soportado")
+    result = profiler.get(profile_id)
+    data = getattr(result, fmt, None) if result else None
+    if data is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    
+    extension = "prof" if fmt == "pstats" else "txt"
+    return Response(
+        content=data,
+        media_type=PROFILE_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}-{fmt}.{extension}"'}
+    )
+
 # Health check
 @app.get("/health")
 def health_check():
@@ -1,6 +1,15 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime
+from pydantic import AfterValidator, BaseModel, Field
+from typing import Annotated, Dict, List, Optional, Union
+from datetime import datetime, timezone
+
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Fechas con zona a UTC sin zona, que es como se guardan y comparan en la BD"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+# datetime de entrada normalizado con naive_utc
+UtcDatetime = Annotated[datetime, AfterValidator(naive_utc)]
 
 class PlayerBase(BaseModel):
     name: str
@@ -29,6 +38,7 @@ class MetricCreate(MetricBase):
 class Metric(MetricBase):
     id: int
     timestamp: datetime
+    quality_flags: int = 0  # Máscara de services.quality; 0 = lectura limpia
     
     class Config:
         from_attributes = True
@@ -55,9 +65,323 @@ class AnalyticsResponse(BaseModel):
     trend_heart_rate: float
     trend_oxygen: float
 
+class RosterAnalytics(BaseModel):
+    period: str
+    team: Optional[str] = None
+    results: List[AnalyticsResponse]
+    players_without_metrics: List[int]
+
 class TeamStats(BaseModel):
     team: str
     total_players: int
     avg_team_heart_rate: float
     avg_team_oxygen: float
-    players_status: dict
\ No newline at end of file
+    players_status: dict
+
+class Alert(BaseModel):
+    id: int
+    player_id: int
+    metric_id: int
+    kind: str  # status, sudden_change
+    level: str
+    previous_level: Optional[str] = None
+    value: Optional[int] = None
+    message: str
+    reading_timestamp: datetime
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class AnomalyEvent(BaseModel):
+    id: int
+    player_id: int
+    metric_id: int
+    type: str  # heart_rate_peak, low_oxygen, sudden_change
+    timestamp: datetime
+    magnitude: int
+    score: Optional[float] = None  # Solo en los detectores estadísticos
+    window_start: datetime
+    window_end: datetime
+    
+    class Config:
+        from_attributes = True
+
+class FlaggedReading(BaseModel):
+    metric_id: int
+    timestamp: datetime
+    heart_rate: int
+    oxygen_saturation: int
+    flags: int
+    reasons: List[str]  # heart_rate_spike, oxygen_saturation_implausible...
+
+class QualityReport(BaseModel):
+    player_id: int
+    hours: int
+    readings: int
+    flagged: int
+    by_flag: Dict[str, int]
+    flagged_readings: List[FlaggedReading]
+
+class PercentileBucket(BaseModel):
+    start: Optional[datetime] = None  # None en el agregado de todo el rango
+    count: int
+    min: Optional[float] = None
+    max: Optional[float] = None
+    percentiles: Dict[str, Optional[float]]  # p50, p90, p99...
+
+class PercentilesResponse(BaseModel):
+    player_id: Optional[int] = None
+    team: Optional[str] = None
+    metric: str
+    relative_accuracy: float
+    overall: PercentileBucket
+    buckets: List[PercentileBucket]
+
+class ZoneBucket(BaseModel):
+    zone: str  # "<80", "80-100" (80 <= x < 100), ">=120"
+    lower: Optional[float] = None
+    upper: Optional[float] = None
+    minutes: float
+    fraction: float
+    readings: int
+
+class ZoneHistogram(BaseModel):
+    metric: str
+    edges: List[float]
+    covered_minutes: float
+    zones: List[ZoneBucket]
+
+class ZonesResponse(BaseModel):
+    player_id: Optional[int] = None
+    team: Optional[str] = None
+    start: datetime
+    end: datetime
+    heart_rate: ZoneHistogram
+    oxygen_saturation: ZoneHistogram
+    players: Optional[List["ZonesResponse"]] = None  # Desglose por jugador (solo equipos)
+
+class MatchEventBase(BaseModel):
+    player_id: int
+    match_id: str
+    type: str = Field(..., min_length=1, description="fight, death, objective...")
+    timestamp: Optional[UtcDatetime] = None  # Por defecto, el instante de recepción
+    end_timestamp: Optional[UtcDatetime] = None  # Solo en eventos con duración
+
+class MatchEventCreate(MatchEventBase):
+    pass
+
+class MatchEvent(MatchEventBase):
+    id: int
+    timestamp: datetime
+    end_timestamp: datetime
+    
+    class Config:
+        from_attributes = True
+
+class EventResponseCurve(BaseModel):
+    type: str
+    events: int  # Eventos con al menos una muestra de HR en la ventana
+    offsets: List[float]  # Segundos respecto al evento
+    mean_heart_rate: List[Optional[float]]
+    std_heart_rate: List[Optional[float]]
+    delta_heart_rate: List[Optional[float]]  # Respecto a la media previa al evento de cada evento
+    samples: List[int]
+
+class EventResponseAnalysis(BaseModel):
+    before: float
+    after: float
+    step: float
+    max_gap: float
+    curves: List[EventResponseCurve]
+
+class MatchBase(BaseModel):
+    name: str
+    start_time: Optional[UtcDatetime] = None  # Por defecto, ahora
+    end_time: Optional[UtcDatetime] = None  # Con fin, la partida se crea ya cerrada
+
+class MatchCreate(MatchBase):
+    id: Optional[str] = Field(None, min_length=1, description="Por defecto se genera uno")
+    player_ids: List[int] = Field(..., min_length=1)
+
+class Match(MatchBase):
+    id: str
+    start_time: datetime
+    status: str  # open, closed, aggregated
+    aggregated_at: Optional[datetime] = None
+    player_ids: List[int]
+
+class MatchClose(BaseModel):
+    end_time: Optional[UtcDatetime] = None  # Por defecto, ahora
+
+class MatchAggregate(BaseModel):
+    scope: str  # player, team
+    player_id: Optional[int] = None
+    team: str
+    count: int
+    avg_heart_rate: Optional[float] = None
+    std_heart_rate: Optional[float] = None
+    min_heart_rate: Optional[int] = None
+    max_heart_rate: Optional[int] = None
+    avg_oxygen_saturation: Optional[float] = None
+    std_oxygen_saturation: Optional[float] = None
+    min_oxygen_saturation: Optional[int] = None
+    max_oxygen_saturation: Optional[int] = None
+    readings_by_level: Dict[str, int]
+
+class MatchAnalytics(BaseModel):
+    match: Match
+    final: bool  # False mientras la partida no está agregada (calculado al vuelo)
+    players: List[MatchAggregate]
+    teams: List[MatchAggregate]
+
+class SynchronyResponse(BaseModel):
+    team: str
+    match_id: Optional[str] = None
+    start: datetime
+    end: datetime
+    step: float
+    max_lag: float
+    player_ids: List[int]  # Orden de filas y columnas de las matrices
+    synchrony: Optional[float] = None  # Media de la máxima correlación entre pares
+    correlation: List[List[Optional[float]]]  # Máxima correlación dentro de ±max_lag
+    best_lag: List[List[Optional[float]]]  # Segundos; positivo si el jugador de la columna va detrás
+    zero_lag: List[List[Optional[float]]]
+    coverage: List[float]  # Fracción de la rejilla con datos de cada jugador
+
+class RRBatch(BaseModel):
+    intervals_ms: List[int] = Field(..., min_length=1, max_length=100000, description="Intervalos RR en ms")
+    start_time: Optional[datetime] = None  # Latido inicial; por defecto, el último latido es ahora
+
+class RRChunk(BaseModel):
+    id: int
+    player_id: int
+    start_time: datetime
+    end_time: datetime
+    count: int
+    
+    class Config:
+        from_attributes = True
+
+class HRVWindow(BaseModel):
+    start: datetime
+    end: datetime
+    beats: int
+    mean_rr: Optional[float] = None  # ms
+    mean_heart_rate: Optional[float] = None
+    sdnn: Optional[float] = None  # ms
+    rmssd: Optional[float] = None  # ms
+    pnn50: Optional[float] = None  # %
+    lf: Optional[float] = None  # ms², 0.04-0.15 Hz
+    hf: Optional[float] = None  # ms², 0.15-0.4 Hz
+    lf_hf: Optional[float] = None
+
+class HRVResponse(BaseModel):
+    player_id: int
+    window: float
+    step: float
+    windows: List[HRVWindow]
+
+class TeamHRVResponse(BaseModel):
+    team: str
+    window: float
+    step: float
+    players: List[HRVResponse]
+
+class ChannelDefinition(BaseModel):
+    name: str = Field(..., pattern="^[a-z0-9_]+$")
+    unit: str
+    dtype: str = Field("float32", description="int16, uint16, int32 o float32")
+    sample_rate: Optional[float] = Field(None, gt=0, le=1000, description="Hz; nulo en canales irregulares")
+    components: int = Field(1, ge=1, le=16)
+    description: Optional[str] = None
+
+class ChannelBatch(BaseModel):
+    samples: List[Union[float, List[float]]] = Field(..., min_length=1, max_length=200000)
+    start_time: Optional[datetime] = None  # Primera muestra; por defecto, la última es ahora
+    timestamps: Optional[List[datetime]] = None  # Solo canales irregulares: instante de cada muestra
+
+class ChannelWrite(BaseModel):
+    player_id: int
+    channel: str
+    chunks: int
+    count: int
+    start_time: datetime
+    end_time: datetime
+
+class ChannelRange(BaseModel):
+    player_id: int
+    channel: str
+    unit: str
+    components: int
+    start: datetime
+    end: datetime
+    count: int
+    offsets: List[float]  # Segundos desde start de cada muestra
+    values: List[List[float]]
+
+class ChannelRollupBucket(BaseModel):
+    start: datetime
+    count: int
+    mean: List[float]  # Una entrada por componente
+    min: List[float]
+    max: List[float]
+
+class ChannelRollup(BaseModel):
+    player_id: int
+    channel: str
+    unit: str
+    bucket: float
+    start: datetime
+    end: datetime
+    buckets: List[ChannelRollupBucket]
+
+class StreamGap(BaseModel):
+    start: datetime
+    end: datetime
+    seconds: float
+
+class AlignedSeries(BaseModel):
+    player_id: int
+    mode: str  # asof, interpolate
+    start: datetime
+    end: datetime
+    offsets: List[float]  # Segundos desde start de cada instante alineado
+    series: Dict[str, List[Optional[float]]]
+    gaps: Dict[str, List[StreamGap]]
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    player_id: int
+    name: str
+    team: str
+    role: str
+    value: float
+    heart_rate: int
+    oxygen_saturation: int
+    strain: float = Field(..., description="HR actual como % del primer umbral de HR del jugador")
+    status: str
+    timestamp: datetime
+
+class LeaderboardResponse(BaseModel):
+    metric: str
+    k: int
+    team: Optional[str] = None
+    role: Optional[str] = None
+    total: int
+    entries: List[LeaderboardEntry]
+
+class ProfilingConfig(BaseModel):
+    enabled: bool = False
+    paths: List[str] = Field(default_factory=list, description="Patrones glob de rutas, p.ej. /players/*/analytics")
+    sample_rate: float = Field(1.0, ge=0, le=1, description="Fracción de peticiones coincidentes a perfilar")
+    mode: str = Field("cprofile", pattern="^(cprofile|sampling)$")
+    trace_allocations: bool = False  # Snapshots de tracemalloc antes y después
+
+class ProfileInfo(BaseModel):
+    id: int
+    path: str
+    mode: str
+    started: datetime
+    duration_ms: float
+    formats: List[str]  # pstats, collapsed, allocations
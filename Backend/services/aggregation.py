@@ -0,0 +1,246 @@
+"""Agregación jerárquica incremental: jugador → equipo / rol / país → global.
+
+Cada nodo guarda agregados parciales fusionables (conteo, suma, suma de
+cuadrados, mínimo, máximo y lecturas por nivel de estado) en ranuras de
+SLOT_SECONDS. Una lectura actualiza en O(1) su jugador y los nodos de su
+equipo, rol, país y el global; un group-by sobre cualquier dimensión se
+responde fusionando ranuras en memoria, en O(grupos × ranuras) y sin tocar
+la base de datos.
+
+Las ventanas tienen resolución de una ranura: empiezan al inicio de la
+ranura que contiene el instante pedido. Solo se conservan WINDOW_HOURS.
+"""
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import MetricDB, PlayerDB
+from services.analytics import load_window
+from services.rules import rules
+
+SLOT_SECONDS = 60
+WINDOW_HOURS = int(os.getenv("AGGREGATION_WINDOW_HOURS", "4"))
+DIMENSIONS = ("player", "team", "role", "country", "global")
+
+EPOCH = datetime(1970, 1, 1)
+
+# Posiciones de cada campo en el agregado de una ranura
+COUNT, HR_SUM, HR_SQ, HR_MIN, HR_MAX, O2_SUM, O2_SQ, O2_MIN, O2_MAX = range(9)
+
+
+def slot_of(timestamp: datetime) -> int:
+    return int((timestamp - EPOCH).total_seconds()) // SLOT_SECONDS
+
+
+def empty_aggregate() -> list:
+    return [0, 0, 0, math.inf, -math.inf, 0, 0, math.inf, -math.inf]
+
+
+def merge_into(target: list, source: list):
+    target[COUNT] += source[COUNT]
+    target[HR_SUM] += source[HR_SUM]
+    target[HR_SQ] += source[HR_SQ]
+    target[HR_MIN] = min(target[HR_MIN], source[HR_MIN])
+    target[HR_MAX] = max(target[HR_MAX], source[HR_MAX])
+    target[O2_SUM] += source[O2_SUM]
+    target[O2_SQ] += source[O2_SQ]
+    target[O2_MIN] = min(target[O2_MIN], source[O2_MIN])
+    target[O2_MAX] = max(target[O2_MAX], source[O2_MAX])
+
+
+class Node:
+    """Agregados por ranura de un grupo (jugador, equipo, rol, país o global)"""
+
+    __slots__ = ("slots", "levels")
+
+    def __init__(self):
+        self.slots: Dict[int, list] = {}
+        self.levels: Dict[int, Dict[str, int]] = {}
+
+    def add(self, slot: int, heart_rate: int, oxygen: int, status: str):
+        aggregate = self.slots.get(slot)
+        if aggregate is None:
+            aggregate = self.slots[slot] = empty_aggregate()
+        aggregate[COUNT] += 1
+        aggregate[HR_SUM] += heart_rate
+        aggregate[HR_SQ] += heart_rate * heart_rate
+        aggregate[HR_MIN] = min(aggregate[HR_MIN], heart_rate)
+        aggregate[HR_MAX] = max(aggregate[HR_MAX], heart_rate)
+        aggregate[O2_SUM] += oxygen
+        aggregate[O2_SQ] += oxygen * oxygen
+        aggregate[O2_MIN] = min(aggregate[O2_MIN], oxygen)
+        aggregate[O2_MAX] = max(aggregate[O2_MAX], oxygen)
+        levels = self.levels.setdefault(slot, {})
+        levels[status] = levels.get(status, 0) + 1
+
+    def merge_slot(self, slot: int, aggregate: list, levels: Dict[str, int]):
+        target = self.slots.get(slot)
+        if target is None:
+            target = self.slots[slot] = empty_aggregate()
+        merge_into(target, aggregate)
+        counts = self.levels.setdefault(slot, {})
+        for status, count in levels.items():
+            counts[status] = counts.get(status, 0) + count
+
+    def window(self, first_slot: int) -> Tuple[list, Dict[str, int]]:
+        total = empty_aggregate()
+        levels: Dict[str, int] = {}
+        for slot, aggregate in self.slots.items():
+            if slot >= first_slot:
+                merge_into(total, aggregate)
+                for status, count in self.levels[slot].items():
+                    levels[status] = levels.get(status, 0) + count
+        return total, levels
+
+    def prune(self, first_slot: int):
+        for slot in [s for s in self.slots if s < first_slot]:
+            del self.slots[slot]
+            del self.levels[slot]
+
+
+def summarize(aggregate: list, levels: Dict[str, int]) -> dict:
+    """Media, desviación típica y extremos a partir de un agregado fusionado"""
+    count = aggregate[COUNT]
+    if not count:
+        return {"count": 0, "readings_by_level": {}}
+
+    def std(total, squares):
+        if count < 2:
+            return 0.0
+        return math.sqrt(max(count * squares - total * total, 0) / (count * (count - 1)))
+
+    return {
+        "count": count,
+        "avg_heart_rate": aggregate[HR_SUM] / count,
+        "std_heart_rate": std(aggregate[HR_SUM], aggregate[HR_SQ]),
+        "min_heart_rate": aggregate[HR_MIN],
+        "max_heart_rate": aggregate[HR_MAX],
+        "avg_oxygen_saturation": aggregate[O2_SUM] / count,
+        "std_oxygen_saturation": std(aggregate[O2_SUM], aggregate[O2_SQ]),
+        "min_oxygen_saturation": aggregate[O2_MIN],
+        "max_oxygen_saturation": aggregate[O2_MAX],
+        "readings_by_level": levels,
+    }
+
+
+class AggregationTree:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._nodes: Dict[str, Dict[object, Node]] = {dimension: {} for dimension in DIMENSIONS}
+        self._pruned = time.monotonic()
+
+    def _path(self, player: PlayerDB) -> List[Tuple[str, object]]:
+        return [("player", player.id), ("team", player.team), ("role", player.role),
+                ("country", player.country), ("global", None)]
+
+    def _node(self, dimension: str, key) -> Node:
+        nodes = self._nodes[dimension]
+        node = nodes.get(key)
+        if node is None:
+            node = nodes[key] = Node()
+        return node
+
+    def add(self, player: PlayerDB, metric: MetricDB, status: str):
+        """Ingesta: actualizar el jugador y sus cuatro nodos superiores"""
+        slot = slot_of(metric.timestamp)
+        with self._lock:
+            if slot < self._first_slot(WINDOW_HOURS):
+                return
+            for dimension, key in self._path(player):
+                self._node(dimension, key).add(slot, metric.heart_rate, metric.oxygen_saturation, status)
+            self._maybe_prune()
+
+    def register(self, player: PlayerDB):
+        """Dar de alta un jugador sin lecturas (aparece con count 0 en los group-by)"""
+        with self._lock:
+            for dimension, key in self._path(player):
+                self._node(dimension, key)
+
+    def _first_slot(self, hours: float) -> int:
+        return slot_of(datetime.utcnow() - timedelta(hours=hours))
+
+    def _maybe_prune(self):
+        if time.monotonic() - self._pruned < SLOT_SECONDS:
+            return
+        self._pruned = time.monotonic()
+        first_slot = self._first_slot(WINDOW_HOURS)
+        for nodes in self._nodes.values():
+            for node in nodes.values():
+                node.prune(first_slot)
+
+    def group_by(self, dimension: str, hours: float = WINDOW_HOURS,
+                 keys: Optional[Iterable] = None) -> Dict[object, dict]:
+        """Resumen de la ventana para cada grupo de la dimensión (o solo los pedidos)"""
+        first_slot = self._first_slot(min(hours, WINDOW_HOURS))
+        with self._lock:
+            nodes = self._nodes[dimension]
+            selected = nodes.items() if keys is None else [(k, nodes[k]) for k in keys if k in nodes]
+            windows = {key: node.window(first_slot) for key, node in selected}
+        return {key: summarize(*window) for key, window in windows.items()}
+
+    def player_status(self, players: Sequence[PlayerDB], hours: float = WINDOW_HOURS) -> Dict[int, str]:
+        """Estado de cada jugador con lecturas, evaluando las reglas sobre sus extremos"""
+        summaries = self.group_by("player", hours, [p.id for p in players])
+        with_data = [p for p in players if summaries.get(p.id, {}).get("count")]
+        if not with_data:
+            return {}
+        compiled = rules.compile(with_data)
+        ids = np.array([p.id for p in with_data])
+        column = lambda name: np.array([summaries[p.id][name] for p in with_data])
+        level, _ = compiled.evaluate_aggregates(ids, {
+            "max_heart_rate": column("max_heart_rate"), "min_heart_rate": column("min_heart_rate"),
+            "max_oxygen_saturation": column("max_oxygen_saturation"),
+            "min_oxygen_saturation": column("min_oxygen_saturation"),
+        })
+        return dict(zip(ids.tolist(), compiled.statuses(level).tolist()))
+
+    def rebuild(self, db: Session, players: Sequence[PlayerDB]):
+        """Reconstruir el árbol desde MetricDB: una consulta y agregación por ranura con numpy"""
+        first_slot = self._first_slot(WINDOW_HOURS)
+        arrays = load_window(db, [p.id for p in players], EPOCH + timedelta(seconds=first_slot * SLOT_SECONDS))
+        by_id = {p.id: p for p in players}
+
+        nodes: Dict[str, Dict[object, Node]] = {dimension: {} for dimension in DIMENSIONS}
+        for player in players:
+            for dimension, key in self._path(player):
+                nodes[dimension].setdefault(key, Node())
+
+        if len(arrays):
+            compiled = rules.compile(players)
+            fired = compiled.fired_readings(arrays.player_id, {
+                "heart_rate": arrays.heart_rate, "oxygen_saturation": arrays.oxygen})
+            statuses = compiled.statuses(compiled.level_of(fired))
+            slots = arrays.timestamp.astype("datetime64[s]").astype(np.int64) // SLOT_SECONDS
+
+            # Grupos contiguos (jugador, ranura): load_window ordena por jugador y tiempo
+            change = np.r_[True, (arrays.player_id[1:] != arrays.player_id[:-1]) | (slots[1:] != slots[:-1])]
+            starts = np.flatnonzero(change)
+            hr, o2 = arrays.heart_rate, arrays.oxygen
+            columns = [
+                np.add.reduceat(np.ones(len(hr), dtype=np.int64), starts),
+                np.add.reduceat(hr, starts), np.add.reduceat(hr * hr, starts),
+                np.minimum.reduceat(hr, starts), np.maximum.reduceat(hr, starts),
+                np.add.reduceat(o2, starts), np.add.reduceat(o2 * o2, starts),
+                np.minimum.reduceat(o2, starts), np.maximum.reduceat(o2, starts),
+            ]
+            ends = np.r_[starts[1:], len(hr)]
+            for row, (begin, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+                player = by_id[int(arrays.player_id[begin])]
+                aggregate = [int(column[row]) for column in columns]
+                levels: Dict[str, int] = {}
+                for status in statuses[begin:end].tolist():
+                    levels[status] = levels.get(status, 0) + 1
+                for dimension, key in self._path(player):
+                    nodes[dimension][key].merge_slot(int(slots[begin]), aggregate, levels)
+
+        with self._lock:
+            self._nodes = nodes
+
+
+tree = AggregationTree()
@@ -0,0 +1,178 @@
+"""Alertas evaluadas en la ingesta de cada lectura.
+
+Cada jugador tiene un estado incremental (nivel actual, candidato pendiente y
+última lectura), así que evaluar una lectura es O(1): no se consulta la
+ventana de métricas. Para que las alertas no parpadeen:
+
+- debounce: un cambio de nivel solo se confirma tras raise_after lecturas
+  consecutivas (al subir) o clear_after (al bajar);
+- histéresis: para salir de un nivel la lectura debe quedar a un margen del
+  umbral, no basta con rozarlo.
+"""
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from database.db import AlertDB, MetricDB, PlayerDB
+from models.models import Alert
+from services.analytics import clean_readings
+from services.instrumentation import registry
+from services.realtime import hub
+from services.rules import NORMAL, rules
+
+ALERT_LATENCY = registry.histogram(
+    "alert_latency_seconds", "Tiempo desde la recepción de la lectura hasta publicar la alerta",
+    ("kind",))
+ALERTS_RAISED = registry.counter(
+    "alerts_total", "Alertas generadas en la ingesta", ("kind", "level"))
+
+
+def alerts_topic(player_id: Optional[int] = None, team: Optional[str] = None) -> str:
+    if player_id is not None:
+        return f"alerts:player:{player_id}"
+    if team is not None:
+        return f"alerts:team:{team}"
+    return "alerts"
+
+
+class PlayerAlertState:
+    __slots__ = ("lock", "hydrated", "level", "candidate", "streak",
+                 "last_heart_rate", "last_timestamp", "rules_key", "compiled", "relaxed")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hydrated = False
+        self.level = 0
+        self.candidate = None
+        self.streak = 0
+        self.last_heart_rate = None
+        self.last_timestamp = None
+        self.rules_key = None
+        self.compiled = None
+        self.relaxed = None
+
+
+class AlertEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[int, PlayerAlertState] = {}
+
+    def _state(self, player_id: int) -> PlayerAlertState:
+        state = self._states.get(player_id)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(player_id, PlayerAlertState())
+        return state
+
+    def _hydrate(self, db: Session, state: PlayerAlertState, player: PlayerDB, metric: MetricDB):
+        """Recuperar el estado tras un reinicio: una vez por jugador y proceso"""
+        last_status = db.query(AlertDB.level).filter(
+            AlertDB.player_id == player.id, AlertDB.kind == "status"
+        ).order_by(AlertDB.id.desc()).first()
+        if last_status is not None and last_status[0] in state.compiled.levels:
+            state.level = state.compiled.levels.index(last_status[0]) + 1
+
+        previous = clean_readings(db.query(MetricDB.heart_rate, MetricDB.timestamp)).filter(
+            MetricDB.player_id == player.id, MetricDB.id != metric.id,
+            MetricDB.timestamp <= metric.timestamp
+        ).order_by(MetricDB.timestamp.desc(), MetricDB.id.desc()).first()
+        if previous is not None:
+            state.last_heart_rate, state.last_timestamp = previous
+        state.hydrated = True
+
+    def _rules(self, state: PlayerAlertState, player: PlayerDB):
+        # Solo se recompila si cambian las reglas o el equipo/rol del jugador
+        rules.refresh()
+        key = (rules.version, player.team, player.role)
+        if state.rules_key != key:
+            state.compiled = rules.compile([player])
+            state.relaxed = state.compiled.relaxed(rules.alerting()["hysteresis"])
+            state.rules_key = key
+
+    def evaluate(self, db: Session, player: PlayerDB, metric: MetricDB) -> List[AlertDB]:
+        """Actualizar el estado del jugador con una lectura; devuelve las alertas nuevas"""
+        state = self._state(player.id)
+        alerting = rules.alerting()
+        values = {"heart_rate": metric.heart_rate, "oxygen_saturation": metric.oxygen_saturation}
+        alerts = []
+
+        with state.lock:
+            self._rules(state, player)
+            if not state.hydrated:
+                self._hydrate(db, state, player, metric)
+            compiled = state.compiled
+
+            entered = compiled.reading_level(player.id, values)
+            held = state.relaxed.reading_level(player.id, values)
+            if entered > state.level:
+                target, needed = entered, alerting["raise_after"]
+            elif held < state.level:
+                target, needed = held, alerting["clear_after"]
+            else:
+                target = state.level
+
+            if target == state.level:
+                state.candidate, state.streak = None, 0
+            else:
+                if target == state.candidate:
+                    state.streak += 1
+                else:
+                    state.candidate, state.streak = target, 1
+                if state.streak >= needed:
+                    statuses = [NORMAL] + compiled.levels
+                    alerts.append(AlertDB(
+                        player_id=player.id, metric_id=metric.id, kind="status",
+                        level=statuses[target], previous_level=statuses[state.level],
+                        message=f"Estado {statuses[state.level]} → {statuses[target]}: "
+                                f"HR {metric.heart_rate} BPM, SpO2 {metric.oxygen_saturation}%",
+                        reading_timestamp=metric.timestamp,
+                    ))
+                    state.level, state.candidate, state.streak = target, None, 0
+
+            # Lecturas fuera de orden no cuentan para el cambio brusco
+            if state.last_timestamp is None or metric.timestamp >= state.last_timestamp:
+                if state.last_heart_rate is not None:
+                    change = abs(metric.heart_rate - state.last_heart_rate)
+                    if change > compiled.sudden_change_bpm:
+                        alerts.append(AlertDB(
+                            player_id=player.id, metric_id=metric.id, kind="sudden_change",
+                            level=[NORMAL, *compiled.levels][state.level], value=change,
+                            message=f"Cambio brusco en HR: {change} BPM",
+                            reading_timestamp=metric.timestamp,
+                        ))
+                state.last_heart_rate, state.last_timestamp = metric.heart_rate, metric.timestamp
+
+        return alerts
+
+    def publish(self, player: PlayerDB, alerts: List[AlertDB], received: float):
+        """Difundir alertas ya guardadas; received es el perf_counter() de llegada de la lectura"""
+        topics = (alerts_topic(), alerts_topic(team=player.team), alerts_topic(player_id=player.id))
+        for alert in alerts:
+            payload = Alert.model_validate(alert).model_dump(mode="json")
+            payload["player"] = player.name
+            payload["team"] = player.team
+            for topic in topics:
+                hub.publish(topic, alert.id, payload)
+            ALERT_LATENCY.observe(time.perf_counter() - received, (alert.kind,))
+            ALERTS_RAISED.inc((alert.kind, alert.level))
+
+    def reset(self, player_id: Optional[int] = None):
+        with self._lock:
+            if player_id is None:
+                self._states.clear()
+            else:
+                self._states.pop(player_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            states = list(self._states.items())
+        levels = Counter(
+            ([NORMAL] + state.compiled.levels)[state.level] for _, state in states if state.compiled is not None
+        )
+        return {"tracked_players": len(states), "players_by_level": dict(levels)}
+
+
+alerts = AlertEngine()
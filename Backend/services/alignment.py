@@ -0,0 +1,133 @@
+"""Alineación temporal de flujos independientes (HR, SpO2, canales de sensores).
+
+Cada flujo llega a su ritmo y se guarda por separado; aquí se convierte en
+un par de arrays ordenados (instantes, valores) y se alinea bajo demanda:
+    asof         último valor conocido en cada instante (a lo sumo tolerance s antes)
+    interpolate  interpolación lineal, solo entre dos muestras a menos de max_gap s
+    gaps         tramos de más de max_gap s sin muestras
+Todo con np.searchsorted sobre los instantes ordenados, sin bucles por muestra.
+
+Nombres de flujo: cualquier canal registrado en services.channels (los de
+varias componentes dan un flujo por componente: accelerometer.0, .1, .2) y
+las lecturas emparejadas de MetricDB como metrics.heart_rate y
+metrics.oxygen_saturation.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from services import channels
+from services.analytics import load_window
+
+METRIC_STREAMS = {"metrics.heart_rate": "heart_rate", "metrics.oxygen_saturation": "oxygen"}
+
+
+class Stream:
+    """Serie ordenada: instantes en s desde EPOCH y valores"""
+
+    def __init__(self, time: np.ndarray, values: np.ndarray):
+        self.time = time
+        self.values = values
+
+    def __len__(self):
+        return len(self.time)
+
+
+class UnknownStream(KeyError):
+    pass
+
+
+def load_streams(db: Session, player_id: int, names: Sequence[str], start_time: datetime,
+                 end_time: datetime) -> Dict[str, Stream]:
+    """Una consulta para las lecturas de MetricDB y una por canal pedido"""
+    streams: Dict[str, Stream] = {}
+    if any(name in METRIC_STREAMS for name in names):
+        arrays = load_window(db, [player_id], start_time, end_time)
+        time = (arrays.timestamp - np.datetime64(channels.EPOCH, "us")) / np.timedelta64(1, "s")
+        for name, column in METRIC_STREAMS.items():
+            if name in names:
+                streams[name] = Stream(time, getattr(arrays, column).astype(float))
+
+    for name in names:
+        if name in streams:
+            continue
+        base, _, component = name.partition(".")
+        channel = channels.registry.get(base)
+        if channel is None or (component and not (component.isdigit() and int(component) < channel["components"])):
+            raise UnknownStream(name)
+        series = channels.load_range(db, player_id, channel, start_time, end_time)
+        if component:
+            streams[name] = Stream(series.time, series.values[:, int(component)])
+        elif channel["components"] == 1:
+            streams[name] = Stream(series.time, series.values[:, 0])
+        else:
+            for index in range(channel["components"]):
+                streams[f"{name}.{index}"] = Stream(series.time, series.values[:, index])
+    return streams
+
+
+def margin(mode: str, tolerance: float, max_gap: float) -> tuple:
+    """Segundos a cargar antes y después del rango pedido para que sus bordes vean sus vecinos"""
+    return (tolerance, 0.0) if mode == "asof" else (max_gap, max_gap)
+
+
+def clip(stream: Stream, start: float, end: float) -> Stream:
+    """Muestras con instante en [start, end)"""
+    first, last = np.searchsorted(stream.time, [start, end])
+    return Stream(stream.time[first:last], stream.values[first:last])
+
+
+def asof(stream: Stream, targets: np.ndarray, tolerance: Optional[float] = None) -> np.ndarray:
+    """Último valor con instante <= objetivo; NaN si no hay o es más antiguo que tolerance"""
+    if not len(stream):
+        return np.full(len(targets), np.nan)
+    index = np.searchsorted(stream.time, targets, side="right") - 1
+    clipped = np.maximum(index, 0)
+    valid = index >= 0
+    if tolerance is not None:
+        valid &= targets - stream.time[clipped] <= tolerance
+    return np.where(valid, stream.values[clipped], np.nan)
+
+
+def interpolate(stream: Stream, targets: np.ndarray, max_gap: float) -> np.ndarray:
+    """Interpolación lineal entre las muestras que rodean cada objetivo si distan <= max_gap"""
+    n = len(stream)
+    if not n:
+        return np.full(len(targets), np.nan)
+    right = np.searchsorted(stream.time, targets, side="right")
+    left = right - 1
+    left_c, right_c = np.clip(left, 0, n - 1), np.clip(right, 0, n - 1)
+    t_left, t_right = stream.time[left_c], stream.time[right_c]
+    v_left, v_right = stream.values[left_c], stream.values[right_c]
+
+    exact = (left >= 0) & (t_left == targets)
+    bracket = (left >= 0) & (right < n) & (t_right - t_left <= max_gap)
+    weight = (targets - t_left) / np.where(t_right > t_left, t_right - t_left, 1)
+    return np.where(exact, v_left, np.where(bracket, v_left + weight * (v_right - v_left), np.nan))
+
+
+def gaps(stream: Stream, start: float, end: float, max_gap: float) -> List[dict]:
+    """Tramos de [start, end) de más de max_gap s sin muestras (incluidos los extremos)"""
+    edges = np.r_[start, stream.time, end]
+    lengths = np.diff(edges)
+    return [
+        {"start": channels.from_seconds(edges[i]), "end": channels.from_seconds(edges[i + 1]),
+         "seconds": round(float(lengths[i]), 3)}
+        for i in np.flatnonzero(lengths > max_gap).tolist()
+    ]
+
+
+def align(streams: Dict[str, Stream], targets: np.ndarray, mode: str, tolerance: Optional[float],
+          max_gap: float) -> Dict[str, List[Optional[float]]]:
+    series = {}
+    for name, stream in streams.items():
+        values = asof(stream, targets, tolerance) if mode == "asof" else interpolate(stream, targets, max_gap)
+        series[name] = [None if np.isnan(v) else round(float(v), 4) for v in values]
+    return series
+
+
+def regular_grid(start_time: datetime, end_time: datetime, step: float) -> np.ndarray:
+    start = channels.seconds_of(start_time)
+    return start + np.arange(0, (end_time - start_time) / timedelta(seconds=1), step)
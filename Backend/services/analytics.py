@@ -0,0 +1,218 @@
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Query, Session
+
+from database.db import MetricDB, MetricQualityDB
+from models.models import AnalyticsResponse
+from services.rules import CompiledRules
+
+TREND_READINGS = 4
+
+# Las lecturas marcadas por services.quality (artefactos) quedan fuera de los análisis
+EXCLUDE_FLAGGED = os.getenv("QUALITY_EXCLUDE_FLAGGED", "1") == "1"
+
+
+class MetricArrays:
+    """Lecturas de varios jugadores en arrays columnares ordenados por (jugador, tiempo)"""
+
+    def __init__(self, player_id: np.ndarray, timestamp: np.ndarray,
+                 heart_rate: np.ndarray, oxygen: np.ndarray, id: Optional[np.ndarray] = None):
+        self.player_id = player_id
+        self.timestamp = timestamp
+        self.heart_rate = heart_rate
+        self.oxygen = oxygen
+        self.id = id
+
+    def __len__(self):
+        return len(self.player_id)
+
+
+def clean_readings(query: Query) -> Query:
+    """Quitar de una consulta sobre MetricDB las lecturas con marcas de calidad (si EXCLUDE_FLAGGED)"""
+    if not EXCLUDE_FLAGGED:
+        return query
+    return query.outerjoin(MetricQualityDB, MetricQualityDB.metric_id == MetricDB.id).filter(
+        MetricQualityDB.metric_id.is_(None))
+
+
+def load_window(db: Session, player_ids: Sequence[int], start_time: datetime,
+                end_time: Optional[datetime] = None, include_flagged: bool = False) -> MetricArrays:
+    """Una sola consulta para todos los jugadores; solo columnas, sin objetos ORM"""
+    query = db.query(
+        MetricDB.player_id, MetricDB.timestamp, MetricDB.id,
+        MetricDB.heart_rate, MetricDB.oxygen_saturation
+    ).filter(
+        MetricDB.player_id.in_(list(player_ids)),
+        MetricDB.timestamp >= start_time
+    )
+    if end_time is not None:
+        query = query.filter(MetricDB.timestamp < end_time)
+    if not include_flagged:
+        query = clean_readings(query)
+    rows = query.all()
+
+    n = len(rows)
+    player_id = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    timestamp = np.array([r[1] for r in rows], dtype="datetime64[us]").reshape(n)
+    row_id = np.fromiter((r[2] for r in rows), dtype=np.int64, count=n)
+    heart_rate = np.fromiter((r[3] for r in rows), dtype=np.int64, count=n)
+    oxygen = np.fromiter((r[4] for r in rows), dtype=np.int64, count=n)
+
+    # lexsort ordena por la última clave primero: jugador, luego tiempo, luego id
+    order = np.lexsort((row_id, timestamp, player_id))
+    return MetricArrays(player_id[order], timestamp[order], heart_rate[order], oxygen[order], row_id[order])
+
+
+def group_bounds(player_id: np.ndarray):
+    """Inicio, fin y tamaño de cada grupo contiguo de un mismo jugador"""
+    if len(player_id) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    starts = np.flatnonzero(np.r_[True, player_id[1:] != player_id[:-1]])
+    ends = np.r_[starts[1:], len(player_id)]
+    return starts, ends, ends - starts
+
+
+def classify(compiled: CompiledRules, player_id: np.ndarray, max_hr, min_hr, max_o2, min_o2) -> dict:
+    """Estado según las reglas compiladas, para todas las filas"""
+    level, _ = compiled.evaluate_aggregates(player_id, {
+        "max_heart_rate": max_hr, "min_heart_rate": min_hr,
+        "max_oxygen_saturation": max_o2, "min_oxygen_saturation": min_o2,
+    })
+    return {"status": compiled.statuses(level)}
+
+
+def compute_analytics(arrays: MetricArrays, compiled: CompiledRules) -> Dict[str, np.ndarray]:
+    """Todas las métricas de AnalyticsResponse para todos los jugadores a la vez"""
+    hr = arrays.heart_rate
+    o2 = arrays.oxygen
+    starts, ends, counts = group_bounds(arrays.player_id)
+    if len(starts) == 0:
+        return {"player_id": np.zeros(0, dtype=np.int64)}
+
+    group = np.repeat(np.arange(len(starts)), counts)
+
+    hr_sum = np.add.reduceat(hr, starts)
+    o2_sum = np.add.reduceat(o2, starts)
+    avg_hr = hr_sum / counts
+    avg_o2 = o2_sum / counts
+
+    max_hr = np.maximum.reduceat(hr, starts)
+    min_hr = np.minimum.reduceat(hr, starts)
+    max_o2 = np.maximum.reduceat(o2, starts)
+    min_o2 = np.minimum.reduceat(o2, starts)
+
+    # Desviación estándar muestral en dos pasadas (como statistics.stdev)
+    deviation = hr - avg_hr[group]
+    squares = np.add.reduceat(deviation * deviation, starts)
+    hrv = np.where(counts > 1, np.sqrt(squares / np.maximum(counts - 1, 1)), 0.0)
+
+    # Tendencia: media de las últimas lecturas menos la de las primeras
+    k = np.minimum(counts, TREND_READINGS)
+    hr_cumsum = np.r_[0, np.cumsum(hr)]
+    o2_cumsum = np.r_[0, np.cumsum(o2)]
+    trend_hr = ((hr_cumsum[ends] - hr_cumsum[ends - k]) - (hr_cumsum[starts + k] - hr_cumsum[starts])) / k
+    trend_o2 = ((o2_cumsum[ends] - o2_cumsum[ends - k]) - (o2_cumsum[starts + k] - o2_cumsum[starts])) / k
+
+    player_id = arrays.player_id[starts]
+    return {
+        "player_id": player_id,
+        "count": counts,
+        "avg_heart_rate": avg_hr,
+        "avg_oxygen_saturation": avg_o2,
+        "max_heart_rate": max_hr,
+        "min_heart_rate": min_hr,
+        "max_oxygen": max_o2,
+        "min_oxygen": min_o2,
+        "hrv": hrv,
+        "trend_heart_rate": trend_hr,
+        "trend_oxygen": trend_o2,
+        **classify(compiled, player_id, max_hr, min_hr, max_o2, min_o2),
+    }
+
+
+def compute_nested_windows(arrays: MetricArrays, window_starts: Sequence[datetime],
+                           compiled: CompiledRules) -> Dict[str, np.ndarray]:
+    """Estadísticas de varias ventanas anidadas de un jugador con un solo recorrido.
+
+    Todas las ventanas terminan en el mismo instante, así que cada una es un
+    sufijo del array ordenado: se resuelven con sumas acumuladas y mínimos/máximos
+    acumulados desde el final en lugar de reescanear las lecturas.
+    """
+    hr = arrays.heart_rate
+    o2 = arrays.oxygen
+    n = len(hr)
+    all_starts = np.searchsorted(arrays.timestamp, np.array(window_starts, dtype="datetime64[us]"), side="left")
+    # Las ventanas sin lecturas no tienen fila; "window" indica a qué ventana corresponde cada una
+    window = np.flatnonzero(all_starts < n)
+    starts = all_starts[window]
+    if len(starts) == 0:
+        return {"player_id": np.zeros(0, dtype=np.int64)}
+    counts = n - starts
+    ends = np.full(len(starts), n)
+
+    hr_cumsum = np.r_[0, np.cumsum(hr)]
+    o2_cumsum = np.r_[0, np.cumsum(o2)]
+    hr_sqsum = np.r_[0, np.cumsum(hr * hr)]
+    hr_sum = hr_cumsum[n] - hr_cumsum[starts]
+    o2_sum = o2_cumsum[n] - o2_cumsum[starts]
+
+    max_hr = np.maximum.accumulate(hr[::-1])[::-1][starts]
+    min_hr = np.minimum.accumulate(hr[::-1])[::-1][starts]
+    max_o2 = np.maximum.accumulate(o2[::-1])[::-1][starts]
+    min_o2 = np.minimum.accumulate(o2[::-1])[::-1][starts]
+
+    # Numerador entero exacto: n·Σx² − (Σx)²
+    numerator = counts * (hr_sqsum[n] - hr_sqsum[starts]) - hr_sum * hr_sum
+    hrv = np.where(counts > 1, np.sqrt(numerator / np.maximum(counts * (counts - 1), 1)), 0.0)
+
+    k = np.minimum(counts, TREND_READINGS)
+    trend_hr = ((hr_cumsum[ends] - hr_cumsum[ends - k]) - (hr_cumsum[starts + k] - hr_cumsum[starts])) / k
+    trend_o2 = ((o2_cumsum[ends] - o2_cumsum[ends - k]) - (o2_cumsum[starts + k] - o2_cumsum[starts])) / k
+
+    player_id = arrays.player_id[starts]
+    return {
+        "player_id": player_id,
+        "window": window,
+        "count": counts,
+        "avg_heart_rate": hr_sum / counts,
+        "avg_oxygen_saturation": o2_sum / counts,
+        "max_heart_rate": max_hr,
+        "min_heart_rate": min_hr,
+        "max_oxygen": max_o2,
+        "min_oxygen": min_o2,
+        "hrv": hrv,
+        "trend_heart_rate": trend_hr,
+        "trend_oxygen": trend_o2,
+        **classify(compiled, player_id, max_hr, min_hr, max_o2, min_o2),
+    }
+
+
+def build_responses(stats: Dict[str, np.ndarray], period,
+                    anomalies: Sequence[List[str]]) -> List[AnalyticsResponse]:
+    """Convertir los arrays agregados en un AnalyticsResponse por fila (jugador o ventana)
+
+    period es un texto común o una secuencia con el período de cada fila;
+    anomalies trae los mensajes de cada fila (ver services.anomalies).
+    """
+    responses = []
+    for i, player_id in enumerate(stats["player_id"].tolist()):
+        responses.append(AnalyticsResponse(
+            player_id=player_id,
+            period=period if isinstance(period, str) else period[i],
+            avg_heart_rate=round(float(stats["avg_heart_rate"][i]), 1),
+            avg_oxygen_saturation=round(float(stats["avg_oxygen_saturation"][i]), 1),
+            max_heart_rate=int(stats["max_heart_rate"][i]),
+            min_heart_rate=int(stats["min_heart_rate"][i]),
+            max_oxygen=int(stats["max_oxygen"][i]),
+            min_oxygen=int(stats["min_oxygen"][i]),
+            hrv=round(float(stats["hrv"][i]), 1),
+            status=str(stats["status"][i]),
+            anomalies=anomalies[i],
+            trend_heart_rate=round(float(stats["trend_heart_rate"][i]), 1),
+            trend_oxygen=round(float(stats["trend_oxygen"][i]), 1),
+        ))
+    return responses
@@ -0,0 +1,181 @@
+"""Almacén de eventos de anomalía.
+
+Las anomalías se detectan una sola vez, al llegar cada lectura o en un pase
+por lotes sobre una ventana, y se guardan como eventos tipados en la tabla
+anomaly_events. Los endpoints de analytics leen esos eventos en lugar de
+volver a recorrer las lecturas.
+
+Al arrancar solo se recalculan las últimas BACKFILL_HOURS; una consulta que
+pide una ventana anterior la completa antes de leer (ensure_backfilled), así
+que las lecturas antiguas cargadas sin pasar por /metrics también tienen sus
+eventos. Cada jugador guarda desde cuándo tiene los eventos calculados.
+
+Tipos de evento (magnitud entre paréntesis):
+    heart_rate_peak  lectura que cumple alguna regla de HR alto (BPM)
+    low_oxygen       lectura que cumple alguna regla de SpO2 bajo (%)
+    sudden_change    salto de HR respecto a la lectura anterior (BPM)
+"""
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import AnomalyEventDB, MetricDB, PlayerDB
+from services.analytics import MetricArrays, clean_readings, load_window
+from services.rules import CompiledRules, rules
+
+HEART_RATE_PEAK = "heart_rate_peak"
+LOW_OXYGEN = "low_oxygen"
+SUDDEN_CHANGE = "sudden_change"
+EVENT_TYPES = (HEART_RATE_PEAK, LOW_OXYGEN, SUDDEN_CHANGE)
+
+# Ventana que se recalcula al arrancar (lecturas cargadas sin pasar por /metrics)
+BACKFILL_HOURS = int(os.getenv("ANOMALY_BACKFILL_HOURS", "24"))
+
+# Por jugador, instante desde el que los eventos están calculados hasta ahora
+_covered_from: Dict[int, datetime] = {}
+_covered_lock = threading.Lock()
+
+
+def detect_reading(db: Session, player: PlayerDB, metric: MetricDB) -> List[AnomalyEventDB]:
+    """Eventos de una lectura recién insertada (ya con id): una búsqueda por índice"""
+    compiled = rules.compile_player(player)
+    values = {"heart_rate": np.array([metric.heart_rate]),
+              "oxygen_saturation": np.array([metric.oxygen_saturation])}
+    fired = compiled.fired_readings(np.array([player.id]), values)
+
+    events = []
+    if compiled.fired_on(fired, "heart_rate", "max")[0]:
+        events.append(_event(metric, HEART_RATE_PEAK, metric.heart_rate, metric.timestamp))
+    if compiled.fired_on(fired, "oxygen_saturation", "min")[0]:
+        events.append(_event(metric, LOW_OXYGEN, metric.oxygen_saturation, metric.timestamp))
+
+    # Lectura anterior según el mismo orden (timestamp, id) y filtro de calidad que usa analytics
+    previous = clean_readings(db.query(MetricDB.heart_rate, MetricDB.timestamp)).filter(
+        MetricDB.player_id == player.id,
+        (MetricDB.timestamp < metric.timestamp)
+        | ((MetricDB.timestamp == metric.timestamp) & (MetricDB.id < metric.id))
+    ).order_by(MetricDB.timestamp.desc(), MetricDB.id.desc()).first()
+    if previous is not None:
+        change = abs(metric.heart_rate - previous[0])
+        if change > compiled.sudden_change_bpm:
+            events.append(_event(metric, SUDDEN_CHANGE, change, previous[1]))
+    return events
+
+
+def _event(metric: MetricDB, type: str, magnitude: int, window_start: datetime) -> AnomalyEventDB:
+    return AnomalyEventDB(
+        player_id=metric.player_id, metric_id=metric.id, type=type, timestamp=metric.timestamp,
+        magnitude=int(magnitude), window_start=window_start, window_end=metric.timestamp,
+    )
+
+
+def detect_window(arrays: MetricArrays, compiled: CompiledRules) -> List[AnomalyEventDB]:
+    """Eventos de todas las lecturas de una ventana, vectorizado sobre los arrays"""
+    if not len(arrays):
+        return []
+    hr = arrays.heart_rate
+    fired = compiled.fired_readings(arrays.player_id, {"heart_rate": hr, "oxygen_saturation": arrays.oxygen})
+    timestamps = arrays.timestamp.astype(datetime)
+
+    events = []
+    for index in np.flatnonzero(compiled.fired_on(fired, "heart_rate", "max")).tolist():
+        events.append((index, HEART_RATE_PEAK, hr[index], timestamps[index]))
+    for index in np.flatnonzero(compiled.fired_on(fired, "oxygen_saturation", "min")).tolist():
+        events.append((index, LOW_OXYGEN, arrays.oxygen[index], timestamps[index]))
+
+    change = np.abs(np.diff(hr))
+    same_player = arrays.player_id[1:] == arrays.player_id[:-1]
+    jumps = np.flatnonzero(same_player & (change > compiled.sudden_change_bpm)) + 1
+    for index in jumps.tolist():
+        events.append((index, SUDDEN_CHANGE, change[index - 1], timestamps[index - 1]))
+
+    return [
+        AnomalyEventDB(
+            player_id=int(arrays.player_id[index]), metric_id=int(arrays.id[index]), type=type,
+            timestamp=timestamps[index], magnitude=int(magnitude),
+            window_start=window_start, window_end=timestamps[index],
+        )
+        for index, type, magnitude, window_start in events
+    ]
+
+
+def backfill(db: Session, players: Sequence[PlayerDB], start_time: datetime,
+             end_time: Optional[datetime] = None) -> int:
+    """Recalcular y reemplazar los eventos de una ventana (p.ej. tras cambiar reglas)"""
+    player_ids = [p.id for p in players]
+    events = detect_window(load_window(db, player_ids, start_time, end_time), rules.compile(players))
+
+    # Se reemplazan los eventos cuyas lecturas caen todas en la ventana; un
+    # salto con la lectura anterior fuera de ella se conserva tal cual
+    stale = db.query(AnomalyEventDB).filter(
+        AnomalyEventDB.player_id.in_(player_ids),
+        AnomalyEventDB.type.in_(EVENT_TYPES),
+        AnomalyEventDB.window_start >= start_time
+    )
+    if end_time is not None:
+        stale = stale.filter(AnomalyEventDB.timestamp < end_time)
+    stale.delete(synchronize_session=False)
+    db.add_all(events)
+    db.commit()
+
+    if end_time is None:
+        for player_id in player_ids:
+            covered = _covered_from.get(player_id)
+            _covered_from[player_id] = start_time if covered is None else min(covered, start_time)
+    return len(events)
+
+
+def ensure_backfilled(db: Session, players: Sequence[PlayerDB], start_time: datetime) -> int:
+    """Calcular los eventos que falten desde start_time (una vez por jugador y tramo)"""
+    with _covered_lock:
+        missing = [p for p in players if _covered_from.get(p.id, datetime.max) > start_time]
+        if not missing:
+            return 0
+        # Hasta ahora y no solo hasta la marca: así se detecta también el salto
+        # entre la última lectura anterior a la marca y la primera posterior
+        return backfill(db, missing, start_time)
+
+
+def load_events(db: Session, player_ids: Sequence[int], start_time: datetime,
+                end_time: Optional[datetime] = None) -> List[AnomalyEventDB]:
+    query = db.query(AnomalyEventDB).filter(
+        AnomalyEventDB.player_id.in_(list(player_ids)),
+        AnomalyEventDB.type.in_(EVENT_TYPES),
+        AnomalyEventDB.window_start >= start_time
+    )
+    if end_time is not None:
+        query = query.filter(AnomalyEventDB.timestamp < end_time)
+    return query.order_by(AnomalyEventDB.timestamp, AnomalyEventDB.metric_id).all()
+
+
+def anomaly_messages(events: Sequence[AnomalyEventDB]) -> List[str]:
+    """Mensajes de analytics a partir de los eventos de una ventana (ordenados por tiempo)"""
+    peaks = [e.magnitude for e in events if e.type == HEART_RATE_PEAK]
+    lows = [e.magnitude for e in events if e.type == LOW_OXYGEN]
+    jump = next((e.magnitude for e in events if e.type == SUDDEN_CHANGE), None)
+
+    anomalies = []
+    if peaks:
+        anomalies.append(f"Pico de ritmo cardíaco elevado: {max(peaks)} BPM")
+    if lows:
+        anomalies.append(f"Oxigenación baja detectada: {min(lows)}%")
+    if jump is not None:
+        anomalies.append(f"Cambio brusco en HR: {jump} BPM")
+    return anomalies
+
+
+def window_messages(events: Sequence[AnomalyEventDB], player_ids: Sequence[int],
+                    window_starts: Sequence[datetime]) -> List[List[str]]:
+    """Mensajes por fila de analytics: (jugador, inicio de ventana) de cada fila"""
+    by_player: Dict[int, List[AnomalyEventDB]] = {}
+    for event in events:
+        by_player.setdefault(event.player_id, []).append(event)
+    return [
+        # Un salto cuenta si sus dos lecturas caen en la ventana
+        anomaly_messages([e for e in by_player.get(player_id, ()) if e.window_start >= start])
+        for player_id, start in zip(player_ids, window_starts)
+    ]
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+from typing import Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastConnection:
+    """Conexión de un espectador con un único mensaje pendiente (el más reciente)"""
+
+    def __init__(self, websocket, max_lag: int):
+        self.websocket = websocket
+        self.max_lag = max_lag
+        self.lag = 0
+        self.closed = False
+        self._pending: Optional[str] = None
+        self._ready = asyncio.Event()
+
+    def offer(self, message: str) -> bool:
+        """Dejar el mensaje listo para enviar; False si el cliente va demasiado atrasado"""
+        if self._pending is not None:
+            # El envío anterior sigue sin salir: se sustituye por el nuevo
+            self.lag += 1
+            if self.lag > self.max_lag:
+                return False
+        self._pending = message
+        self._ready.set()
+        return True
+
+    async def run(self):
+        """Bucle de envío; la contrapresión de cada socket solo frena a este cliente"""
+        while not self.closed:
+            await self._ready.wait()
+            self._ready.clear()
+            message, self._pending = self._pending, None
+            if message is None:
+                continue
+            self.lag = 0
+            await self.websocket.send_text(message)
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+
+class BroadcastChannel:
+    """Canal que calcula y serializa su payload una vez por tick para todos"""
+
+    def __init__(self, name: str, producer: Callable[[], dict], interval: float, max_lag: int):
+        self.name = name
+        self.producer = producer
+        self.interval = interval
+        self.max_lag = max_lag
+        self.connections: Set[BroadcastConnection] = set()
+        self.last_message: Optional[str] = None
+        self.ticks = 0
+        self.messages_sent = 0
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, connection: BroadcastConnection):
+        self.connections.add(connection)
+        if self.last_message is not None:
+            connection.offer(self.last_message)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def remove(self, connection: BroadcastConnection):
+        self.connections.discard(connection)
+
+    def close(self):
+        """Detener el tick de un canal que se queda sin conexiones"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def drop(self, connection: BroadcastConnection):
+        self.remove(connection)
+        self.dropped += 1
+        connection.close()
+        # 1013: "try again later", el cliente puede reconectarse
+        asyncio.create_task(_close_quietly(connection.websocket, 1013))
+
+    def fan_out(self, message: str):
+        """Enviar el mismo mensaje ya serializado a todas las conexiones"""
+        for connection in list(self.connections):
+            if connection.offer(message):
+                self.messages_sent += 1
+            else:
+                self.drop(connection)
+
+    async def tick(self):
+        payload = await asyncio.to_thread(self.producer)
+        message = json.dumps(payload, default=str)
+        self.ticks += 1
+        # Si nada cambió no se reenvía; los nuevos reciben last_message al entrar
+        if message != self.last_message:
+            self.last_message = message
+            self.fan_out(message)
+
+    async def _run(self):
+        while self.connections:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Error generando el payload del canal %s", self.name)
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "ticks": self.ticks,
+            "messages_sent": self.messages_sent,
+            "dropped": self.dropped,
+        }
+
+
+class BroadcastManager:
+    """Registro de canales de difusión por equipo, jugador y vista global"""
+
+    def __init__(self, interval: float = 1.0, max_lag: int = 5):
+        self.interval = interval
+        self.max_lag = max_lag
+        self.channels: Dict[str, BroadcastChannel] = {}
+
+    def channel(self, name: str, producer: Callable[[], dict]) -> BroadcastChannel:
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = BroadcastChannel(name, producer, self.interval, self.max_lag)
+            self.channels[name] = channel
+        return channel
+
+    async def serve(self, websocket, name: str, producer: Callable[[], dict]):
+        """Atender a un espectador hasta que se desconecte o sea descartado"""
+        await websocket.accept()
+        channel = self.channel(name, producer)
+        connection = BroadcastConnection(websocket, self.max_lag)
+        channel.add(connection)
+
+        sender = asyncio.create_task(connection.run())
+        receiver = asyncio.create_task(_wait_disconnect(websocket))
+        try:
+            await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            connection.close()
+            sender.cancel()
+            receiver.cancel()
+            channel.remove(connection)
+            self._prune(name, channel)
+
+    def _prune(self, name: str, channel: BroadcastChannel):
+        # Los nombres de canal llegan del cliente: sin conexiones no se conservan
+        if not channel.connections and self.channels.get(name) is channel:
+            del self.channels[name]
+            channel.close()
+
+    def stats(self) -> dict:
+        channels = {name: channel.stats() for name, channel in self.channels.items()}
+        return {
+            "total_connections": sum(c["connections"] for c in channels.values()),
+            "total_dropped": sum(c["dropped"] for c in channels.values()),
+            "channels": channels,
+        }
+
+
+async def _wait_disconnect(websocket):
+    # Los espectadores no envían datos; solo se espera el cierre
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+async def _close_quietly(websocket, code: int):
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
+
+
+broadcaster = BroadcastManager()
@@ -0,0 +1,133 @@
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import Request, Response
+
+# Cabeceras Cache-Control según lo que puede cambiar la respuesta
+NO_CACHE = "no-cache"
+SHORT_LIVED = "public, max-age=15"
+
+# Las ventanas relativas ("últimas N horas") se redondean a este paso (divisor
+# de 60) para que la respuesta sea estable dentro del bucket y se pueda reutilizar
+WINDOW_BUCKET_SECONDS = 15
+
+
+class DataVersions:
+    """Sellos de versión que se incrementan con cada escritura relevante"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Distingue versiones de distintos arranques del proceso
+        self.epoch = secrets.token_hex(4)
+        self._roster = 0
+        self._history = 0
+        self._players: Dict[int, int] = defaultdict(int)
+        self._teams: Dict[str, int] = defaultdict(int)
+
+    def bump_roster(self, player_id: int, team: str):
+        """Alta o cambio de un jugador"""
+        with self._lock:
+            self._roster += 1
+            self._players[player_id] += 1
+            self._teams[team] += 1
+
+    def bump_player(self, player_id: int, team: str):
+        """Nueva lectura de métricas de un jugador"""
+        with self._lock:
+            self._players[player_id] += 1
+            self._teams[team] += 1
+
+    def bump_history(self, players):
+        """Reproceso del histórico (p.ej. marcas de calidad): cambian también ventanas cerradas"""
+        with self._lock:
+            self._history += 1
+            for player in players:
+                self._players[player.id] += 1
+                self._teams[player.team] += 1
+
+    def roster(self) -> int:
+        return self._roster
+
+    def history(self) -> int:
+        return self._history
+
+    def player(self, player_id: int) -> int:
+        return self._players.get(player_id, 0)
+
+    def team(self, team: str) -> int:
+        return self._teams.get(team, 0)
+
+
+class ResponseCache:
+    """LRU en proceso de respuestas ya serializadas, indexado por ETag"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[bytes, dict]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: Tuple[bytes, dict]):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1("|".join(str(p) for p in (versions.epoch,) + parts).encode()).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Comparación débil: se ignora el prefijo W/. "*" no se acepta: el 304 se
+    # decide antes de consultar y respondería aunque el recurso no exista
+    return any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in candidates)
+
+
+def window_now() -> datetime:
+    """Instante actual redondeado hacia abajo al bucket de ventanas relativas"""
+    now = datetime.utcnow()
+    return now - timedelta(seconds=now.second % WINDOW_BUCKET_SECONDS, microseconds=now.microsecond)
+
+
+def conditional_response(request: Request, etag: str, cache_control: str,
+                         build: Callable[[], Tuple[bytes, dict]]) -> Response:
+    """Responder 304 sin ejecutar la consulta, desde el LRU o construyendo el cuerpo"""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    entry = response_cache.get(etag)
+    if entry is None:
+        entry = build()
+        response_cache.put(etag, entry)
+    body, extra_headers = entry
+    return Response(content=body, media_type="application/json", headers={**headers, **extra_headers})
+
+
+versions = DataVersions()
+response_cache = ResponseCache()
@@ -0,0 +1,245 @@
+"""Canales de sensores genéricos (temperatura de piel, EDA, acelerómetro...) en bloques compactos.
+
+Un canal se define en el registro (tabla channels: unidad, dtype, frecuencia
+de muestreo y componentes por muestra) y no necesita cambios de esquema. Sus
+muestras se guardan en channel_chunks: una fila por (jugador, canal, bloque
+de CHUNK_SECONDS) con el array de muestras empaquetado en el dtype del canal,
+así 25 Hz de acelerometría son 60 filas por hora y no 90.000.
+
+En los canales regulares la muestra i-ésima de un bloque está en
+start_time + i / sample_rate. Los irregulares (sin sample_rate, como HR y
+SpO2 de fuentes independientes) guardan además el desfase en µs de cada
+muestra. Las lecturas por rango desempaquetan los bloques que solapan (una
+consulta) y los rollups agregan por cubetas con np.*.reduceat. Las lecturas
+emparejadas de MetricDB siguen con su API de siempre.
+"""
+import math
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import ChannelChunkDB, ChannelDB
+
+EPOCH = datetime(1970, 1, 1)
+CHUNK_SECONDS = 60
+DTYPES = {"int16": "<i2", "uint16": "<u2", "int32": "<i4", "float32": "<f4"}
+
+DEFAULT_CHANNELS = [
+    {"name": "skin_temperature", "unit": "°C", "dtype": "float32", "sample_rate": 1.0, "components": 1,
+     "description": "Temperatura de la piel"},
+    {"name": "eda", "unit": "µS", "dtype": "float32", "sample_rate": 4.0, "components": 1,
+     "description": "Actividad electrodérmica"},
+    {"name": "accelerometer", "unit": "mg", "dtype": "int16", "sample_rate": 25.0, "components": 3,
+     "description": "Aceleración en x, y, z"},
+    {"name": "heart_rate", "unit": "BPM", "dtype": "float32", "sample_rate": None, "components": 1,
+     "description": "Ritmo cardíaco de una fuente independiente (irregular)"},
+    {"name": "oxygen_saturation", "unit": "%", "dtype": "float32", "sample_rate": None, "components": 1,
+     "description": "Saturación de oxígeno de una fuente independiente (irregular)"},
+]
+
+
+class ChannelError(ValueError):
+    pass
+
+
+def seconds_of(timestamp: datetime) -> float:
+    return (_naive_utc(timestamp) - EPOCH).total_seconds()
+
+
+def from_seconds(seconds: float) -> datetime:
+    return EPOCH + timedelta(seconds=float(seconds))
+
+
+class ChannelSeries:
+    """Muestras de un rango: instantes en s desde EPOCH y valores (n × componentes)"""
+
+    def __init__(self, time: np.ndarray, values: np.ndarray):
+        self.time = time
+        self.values = values
+
+    def __len__(self):
+        return len(self.time)
+
+
+class ChannelRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels: Dict[str, dict] = {}
+
+    def load(self, db: Session):
+        """Sembrar los canales por defecto que falten y cargar el registro"""
+        existing = {name for (name,) in db.query(ChannelDB.name).all()}
+        db.add_all(ChannelDB(**c) for c in DEFAULT_CHANNELS if c["name"] not in existing)
+        db.commit()
+        with self._lock:
+            self._channels = {c.name: channel_dict(c) for c in db.query(ChannelDB).all()}
+
+    def register(self, db: Session, definition: dict) -> dict:
+        if definition["dtype"] not in DTYPES:
+            raise ChannelError(f"dtype desconocido; válidos: {', '.join(DTYPES)}")
+        sample_rate = definition.get("sample_rate")
+        if (sample_rate is not None and sample_rate <= 0) or definition.get("components", 1) < 1:
+            raise ChannelError("sample_rate y components deben ser positivos")
+        with self._lock:
+            if definition["name"] in self._channels:
+                raise ChannelError("El canal ya existe")
+        channel = ChannelDB(**definition)
+        db.add(channel)
+        db.commit()
+        db.refresh(channel)
+        with self._lock:
+            self._channels[channel.name] = channel_dict(channel)
+        return self._channels[channel.name]
+
+    def get(self, name: str) -> Optional[dict]:
+        with self._lock:
+            return self._channels.get(name)
+
+    def all(self) -> List[dict]:
+        with self._lock:
+            return sorted(self._channels.values(), key=lambda c: c["name"])
+
+
+def channel_dict(channel: ChannelDB) -> dict:
+    return {
+        "name": channel.name, "unit": channel.unit, "dtype": channel.dtype, "sample_rate": channel.sample_rate,
+        "components": channel.components or 1, "description": channel.description,
+    }
+
+
+def as_samples(channel: dict, samples: Sequence) -> np.ndarray:
+    """Lote recibido como array (n × componentes) en el dtype del canal"""
+    values = np.asarray(samples, dtype=float)
+    components = channel["components"]
+    if components == 1 and values.ndim == 1:
+        values = values[:, None]
+    if values.ndim != 2 or values.shape[1] != components or not len(values):
+        raise ChannelError(f"Se esperaban muestras con {components} componente(s)")
+    dtype = np.dtype(DTYPES[channel["dtype"]])
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        if values.min() < info.min or values.max() > info.max or not np.isfinite(values).all():
+            raise ChannelError(f"Valores fuera del rango de {channel['dtype']}")
+        values = np.rint(values)
+    return values.astype(dtype)
+
+
+def make_chunks(player_id: int, channel: dict, samples: np.ndarray, times: np.ndarray) -> List[ChannelChunkDB]:
+    """Partir el lote (instantes en µs desde EPOCH, crecientes) en bloques alineados a CHUNK_SECONDS"""
+    rate = channel["sample_rate"]
+    boundaries = np.flatnonzero(np.diff(times // (CHUNK_SECONDS * 1_000_000))) + 1
+    chunks = []
+    for part in np.split(np.arange(len(samples)), boundaries):
+        first, last = int(times[part[0]]), int(times[part[-1]])
+        # Los regulares terminan un periodo después de la última muestra; los irregulares, en ella
+        end = first + round(len(part) * 1_000_000 / rate) if rate else last
+        chunks.append(ChannelChunkDB(
+            player_id=player_id, channel=channel["name"],
+            start_time=EPOCH + timedelta(microseconds=first), end_time=EPOCH + timedelta(microseconds=end),
+            count=len(part), data=samples[part].tobytes(),
+            offsets=None if rate else (times[part] - first).astype("<i8").tobytes(),
+        ))
+    return chunks
+
+
+def ingest(db: Session, player_id: int, channel: dict, samples: Sequence, start_time: Optional[datetime] = None,
+           timestamps: Optional[Sequence[datetime]] = None) -> List[ChannelChunkDB]:
+    """Guardar un lote: regular desde start_time (por defecto, última muestra ahora) o con un instante por muestra"""
+    values = as_samples(channel, samples)
+    rate = channel["sample_rate"]
+    if rate is None:
+        if timestamps is None or len(timestamps) != len(values):
+            raise ChannelError("Los canales irregulares necesitan un timestamp por muestra")
+        times = np.array([_micros(t) for t in timestamps], dtype=np.int64)
+        order = np.argsort(times, kind="stable")
+        times, values = times[order], values[order]
+    else:
+        if timestamps is not None:
+            raise ChannelError("Los canales regulares usan start_time, no timestamps")
+        if start_time is None:
+            start_time = datetime.utcnow() - timedelta(seconds=(len(values) - 1) / rate)
+        times = _micros(start_time) + np.rint(np.arange(len(values)) * 1_000_000 / rate).astype(np.int64)
+    chunks = make_chunks(player_id, channel, values, times)
+    db.add_all(chunks)
+    db.commit()
+    return chunks
+
+
+def load_range(db: Session, player_id: int, channel: dict, start_time: datetime,
+               end_time: datetime) -> ChannelSeries:
+    """Muestras del canal en [start_time, end_time), desempaquetando los bloques que solapan"""
+    chunks = db.query(ChannelChunkDB.start_time, ChannelChunkDB.data, ChannelChunkDB.offsets).filter(
+        ChannelChunkDB.player_id == player_id,
+        ChannelChunkDB.channel == channel["name"],
+        ChannelChunkDB.start_time < end_time,
+        ChannelChunkDB.end_time >= start_time
+    ).order_by(ChannelChunkDB.start_time, ChannelChunkDB.id).all()
+
+    components = channel["components"]
+    dtype = np.dtype(DTYPES[channel["dtype"]])
+    if not chunks:
+        return ChannelSeries(np.zeros(0), np.zeros((0, components)))
+    values = [np.frombuffer(data, dtype=dtype).reshape(-1, components) for _, data, _ in chunks]
+    times = np.concatenate([
+        seconds_of(start) + _sample_offsets(channel, len(v), offsets) for (start, _, offsets), v in zip(chunks, values)
+    ])
+    values = np.concatenate(values).astype(float)
+
+    keep = (times >= seconds_of(start_time)) & (times < seconds_of(end_time))
+    order = np.argsort(times[keep], kind="stable")
+    return ChannelSeries(times[keep][order], values[keep][order])
+
+
+def _sample_offsets(channel: dict, count: int, offsets: Optional[bytes]) -> np.ndarray:
+    """Segundos desde el inicio del bloque de cada muestra"""
+    if channel["sample_rate"] is None:
+        return np.frombuffer(offsets, dtype="<i8") / 1_000_000
+    return np.arange(count) / channel["sample_rate"]
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _micros(timestamp: datetime) -> int:
+    return (_naive_utc(timestamp) - EPOCH) // timedelta(microseconds=1)
+
+
+def rollup(series: ChannelSeries, start_time: datetime, bucket: float) -> List[dict]:
+    """Conteo, media, mínimo y máximo por cubeta de `bucket` segundos (por componente)"""
+    if not len(series):
+        return []
+    origin = seconds_of(start_time)
+    index = np.floor((series.time - origin) / bucket).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    counts = np.diff(np.r_[starts, len(index)])
+    values = series.values
+    sums = np.add.reduceat(values, starts, axis=0)
+    mins = np.minimum.reduceat(values, starts, axis=0)
+    maxs = np.maximum.reduceat(values, starts, axis=0)
+    return [
+        {
+            "start": from_seconds(origin + index[s] * bucket), "count": int(n),
+            "mean": _round(total / n), "min": _round(low), "max": _round(high),
+        }
+        for s, n, total, low, high in zip(starts.tolist(), counts.tolist(), sums, mins, maxs)
+    ]
+
+
+def _round(values: np.ndarray) -> List[float]:
+    return [round(float(v), 4) for v in values]
+
+
+def points_for(channel: dict, start_time: datetime, end_time: datetime) -> Optional[int]:
+    """Muestras esperadas en el rango (desconocidas en los canales irregulares)"""
+    if channel["sample_rate"] is None:
+        return None
+    return math.ceil((end_time - start_time).total_seconds() * channel["sample_rate"])
+
+
+registry = ChannelRegistry()
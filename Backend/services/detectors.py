@@ -0,0 +1,418 @@
+"""Detectores estadísticos en streaming por jugador (EWMA, z-score robusto, CUSUM).
+
+Cada detector guarda unos pocos floats por jugador y se actualiza en O(1) por
+lectura. La función step() trabaja con arrays de numpy: en la ingesta recibe
+arrays de un elemento y en el modo por lotes avanza a la vez, lectura a
+lectura, a todos los jugadores de una ventana de MetricDB. Ambos caminos
+ejecutan exactamente el mismo código, así que un backfill deja el mismo
+estado y los mismos eventos que la ingesta en vivo.
+
+Para añadir un detector basta con heredar de Detector (fields, step) y
+registrarlo en el banco con detectors.register(...).
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import AnomalyEventDB, DetectorStateDB, MetricDB, PlayerDB
+from services.analytics import MetricArrays, group_bounds, load_window
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Normalización de la MAD para que sea comparable con la desviación típica
+MAD_SCALE = 0.6745
+
+
+class Detector:
+    """Detector sobre una métrica; state es un dict de arrays (uno por campo)"""
+
+    name = "detector"
+    fields: Tuple[str, ...] = ()
+
+    def __init__(self, metric: str = "heart_rate", warmup: int = 10):
+        self.metric = metric
+        self.warmup = warmup
+
+    @property
+    def event_type(self) -> str:
+        return f"{self.name}_{self.metric}"
+
+    def initial(self, size: int) -> Dict[str, np.ndarray]:
+        return {field: np.zeros(size) for field in self.fields}
+
+    def step(self, state: Dict[str, np.ndarray], x: np.ndarray, t: np.ndarray):
+        """Actualizar el estado con una lectura por fila.
+
+        x son los valores y t los instantes en microsegundos. Devuelve
+        (puntuación, disparado, inicio del episodio en microsegundos).
+        """
+        raise NotImplementedError
+
+    def params(self) -> dict:
+        return {key: value for key, value in vars(self).items() if not key.startswith("_")}
+
+
+class EwmaDetector(Detector):
+    """Gráfico de control EWMA: media y varianza con olvido exponencial"""
+
+    name = "ewma"
+    fields = ("n", "mean", "var")
+
+    def __init__(self, metric: str = "heart_rate", alpha: float = 0.1, limit: float = 3.0,
+                 min_std: float = 2.0, warmup: int = 10):
+        super().__init__(metric, warmup)
+        self.alpha = alpha
+        self.limit = limit
+        self.min_std = min_std
+
+    def step(self, state, x, t):
+        n, mean, var = state["n"], state["mean"], state["var"]
+        ready = n >= self.warmup
+        score = np.where(ready, (x - mean) / np.maximum(np.sqrt(var), self.min_std), 0.0)
+        fired = ready & (np.abs(score) > self.limit)
+
+        first = n == 0
+        diff = x - mean
+        increment = self.alpha * diff
+        state["mean"] = np.where(first, x, mean + increment)
+        state["var"] = np.where(first, 0.0, (1 - self.alpha) * (var + diff * increment))
+        state["n"] = n + 1
+        return score, fired, t
+
+
+class RobustZDetector(Detector):
+    """z-score robusto con mediana y MAD estimadas por sketches frugales.
+
+    Mediana y MAD se mueven un paso hacia cada lectura (estimación frugal de
+    cuantiles), así que olvidan el pasado como una ventana deslizante sin
+    tener que guardarla: dos floats por jugador y O(1) por lectura.
+    """
+
+    name = "robust_z"
+    fields = ("n", "median", "mad")
+
+    def __init__(self, metric: str = "heart_rate", rate: float = 0.1, limit: float = 3.5,
+                 min_mad: float = 1.0, warmup: int = 10):
+        super().__init__(metric, warmup)
+        self.rate = rate
+        self.limit = limit
+        self.min_mad = min_mad
+
+    def step(self, state, x, t):
+        n, median, mad = state["n"], state["median"], state["mad"]
+        scale = np.maximum(mad, self.min_mad)
+        ready = n >= self.warmup
+        score = np.where(ready, MAD_SCALE * (x - median) / scale, 0.0)
+        fired = ready & (np.abs(score) > self.limit)
+
+        first = n == 0
+        step = self.rate * scale
+        median = np.where(first, x, median + step * np.sign(x - median))
+        state["median"] = median
+        state["mad"] = np.where(first, 0.0, np.maximum(mad + step * np.sign(np.abs(x - median) - mad), 0.0))
+        state["n"] = n + 1
+        return score, fired, t
+
+
+class CusumDetector(Detector):
+    """CUSUM de dos colas sobre la lectura estandarizada, para derivas sostenidas.
+
+    La referencia (media y desviación) se fija con las primeras `warmup`
+    lecturas del jugador; k es la holgura y h el umbral, en desviaciones.
+    Tras disparar, el acumulado vuelve a cero.
+    """
+
+    name = "cusum"
+    fields = ("n", "mean", "m2", "pos", "neg", "pos_onset", "neg_onset")
+
+    def __init__(self, metric: str = "heart_rate", k: float = 0.5, h: float = 5.0,
+                 min_std: float = 2.0, warmup: int = 10):
+        super().__init__(metric, warmup)
+        self.k = k
+        self.h = h
+        self.min_std = min_std
+
+    def step(self, state, x, t):
+        n, mean, m2 = state["n"], state["mean"], state["m2"]
+        ready = n >= self.warmup
+
+        # Referencia por Welford durante el calentamiento; después queda fija
+        learning = ~ready
+        delta = x - mean
+        new_mean = mean + delta / (n + 1)
+        state["mean"] = np.where(learning, new_mean, mean)
+        state["m2"] = np.where(learning, m2 + delta * (x - new_mean), m2)
+        state["n"] = n + 1
+
+        sigma = np.maximum(np.sqrt(m2 / np.maximum(self.warmup - 1, 1)), self.min_std)
+        z = (x - mean) / sigma
+        pos = np.where(ready, np.maximum(0.0, state["pos"] + z - self.k), 0.0)
+        neg = np.where(ready, np.maximum(0.0, state["neg"] - z - self.k), 0.0)
+        pos_onset = np.where((state["pos"] == 0) & (pos > 0), t, state["pos_onset"])
+        neg_onset = np.where((state["neg"] == 0) & (neg > 0), t, state["neg_onset"])
+
+        fired_pos = pos > self.h
+        fired_neg = neg > self.h
+        score = np.where(pos >= neg, pos, -neg)
+        onset = np.where(fired_pos, pos_onset, neg_onset)
+
+        state["pos"] = np.where(fired_pos, 0.0, pos)
+        state["neg"] = np.where(fired_neg, 0.0, neg)
+        state["pos_onset"] = pos_onset
+        state["neg_onset"] = neg_onset
+        return score, fired_pos | fired_neg, onset
+
+
+def default_detectors() -> List[Detector]:
+    return [
+        EwmaDetector("heart_rate"),
+        RobustZDetector("heart_rate"),
+        CusumDetector("heart_rate"),
+        CusumDetector("oxygen_saturation", min_std=0.5),
+    ]
+
+
+def to_micros(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: float) -> datetime:
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+class PlayerDetectorState:
+    __slots__ = ("lock", "states", "last_metric_id", "last_timestamp")
+
+    def __init__(self, states: Dict[str, Dict[str, float]], last_metric_id: Optional[int] = None,
+                 last_timestamp: Optional[datetime] = None):
+        self.lock = threading.Lock()
+        self.states = states
+        self.last_metric_id = last_metric_id
+        self.last_timestamp = last_timestamp
+
+    def snapshot(self) -> dict:
+        return {
+            "detectors": self.states,
+            "last_metric_id": self.last_metric_id,
+            "last_timestamp": self.last_timestamp.isoformat() if self.last_timestamp else None,
+        }
+
+
+class DetectorBank:
+    """Conjunto de detectores y estado compacto por jugador"""
+
+    def __init__(self, detectors: Sequence[Detector]):
+        self.detectors: List[Detector] = list(detectors)
+        self._lock = threading.Lock()
+        self._players: Dict[int, PlayerDetectorState] = {}
+
+    @property
+    def event_types(self) -> Tuple[str, ...]:
+        return tuple(d.event_type for d in self.detectors)
+
+    def register(self, detector: Detector):
+        if detector.event_type in self.event_types:
+            raise ValueError(f"Detector duplicado: {detector.event_type}")
+        self.detectors.append(detector)
+
+    def _initial(self) -> Dict[str, Dict[str, float]]:
+        return {
+            d.event_type: {field: float(value[0]) for field, value in d.initial(1).items()}
+            for d in self.detectors
+        }
+
+    def _player(self, player_id: int) -> PlayerDetectorState:
+        player = self._players.get(player_id)
+        if player is None:
+            with self._lock:
+                player = self._players.setdefault(player_id, PlayerDetectorState(self._initial()))
+        return player
+
+    def update(self, metric: MetricDB) -> List[AnomalyEventDB]:
+        """Ingesta: pasar una lectura por todos los detectores del jugador"""
+        player = self._player(metric.player_id)
+        values = {"heart_rate": metric.heart_rate, "oxygen_saturation": metric.oxygen_saturation}
+        t = np.array([to_micros(metric.timestamp)], dtype=float)
+        events = []
+
+        with player.lock:
+            # Los detectores suponen orden temporal: las lecturas atrasadas se
+            # recogen en el siguiente backfill
+            if player.last_timestamp is not None and metric.timestamp < player.last_timestamp:
+                return events
+            for detector in self.detectors:
+                stored = player.states.get(detector.event_type)
+                state = ({field: np.array([value]) for field, value in stored.items()}
+                         if stored is not None else detector.initial(1))
+                x = np.array([values[detector.metric]], dtype=float)
+                score, fired, onset = detector.step(state, x, t)
+                player.states[detector.event_type] = {field: float(value[0]) for field, value in state.items()}
+                if fired[0]:
+                    events.append(AnomalyEventDB(
+                        player_id=metric.player_id, metric_id=metric.id, type=detector.event_type,
+                        timestamp=metric.timestamp, magnitude=int(values[detector.metric]),
+                        score=round(float(score[0]), 3), window_start=from_micros(onset[0]),
+                        window_end=metric.timestamp,
+                    ))
+            player.last_metric_id = metric.id
+            player.last_timestamp = metric.timestamp
+        return events
+
+    def run_batch(self, arrays: MetricArrays,
+                  initial: Optional[Dict[int, PlayerDetectorState]] = None) -> Tuple[List[AnomalyEventDB], Dict[int, PlayerDetectorState]]:
+        """Modo por lotes: todos los jugadores avanzan a la vez, una lectura por paso.
+
+        Devuelve los eventos y el estado final de cada jugador de la ventana.
+        """
+        initial = initial or {}
+        starts, _, counts = group_bounds(arrays.player_id)
+        if not len(starts):
+            return [], {}
+        player_ids = arrays.player_id[starts]
+
+        values = {"heart_rate": arrays.heart_rate.astype(float),
+                  "oxygen_saturation": arrays.oxygen.astype(float)}
+        micros = arrays.timestamp.astype("datetime64[us]").astype(np.int64).astype(float)
+
+        states = {}
+        for detector in self.detectors:
+            state = detector.initial(len(player_ids))
+            for row, player_id in enumerate(player_ids.tolist()):
+                stored = initial.get(player_id)
+                stored = stored.states.get(detector.event_type) if stored is not None else None
+                if stored is not None:
+                    for field in detector.fields:
+                        state[field][row] = stored[field]
+            states[detector.event_type] = state
+
+        fired_at: List[Tuple[int, Detector, float, float]] = []
+        for step in range(int(counts.max())):
+            active = np.flatnonzero(counts > step)
+            index = starts[active] + step
+            for detector in self.detectors:
+                state = states[detector.event_type]
+                subset = {field: value[active] for field, value in state.items()}
+                score, fired, onset = detector.step(subset, values[detector.metric][index], micros[index])
+                for field, value in subset.items():
+                    state[field][active] = value
+                for i in np.flatnonzero(fired).tolist():
+                    fired_at.append((int(index[i]), detector, float(score[i]), float(onset[i])))
+
+        events = [
+            AnomalyEventDB(
+                player_id=int(arrays.player_id[i]), metric_id=int(arrays.id[i]), type=detector.event_type,
+                timestamp=from_micros(micros[i]), magnitude=int(values[detector.metric][i]),
+                score=round(score, 3), window_start=from_micros(onset), window_end=from_micros(micros[i]),
+            )
+            for i, detector, score, onset in fired_at
+        ]
+
+        final = {}
+        for row, player_id in enumerate(player_ids.tolist()):
+            last = starts[row] + counts[row] - 1
+            final[player_id] = PlayerDetectorState(
+                {d.event_type: {field: float(value[row]) for field, value in states[d.event_type].items()}
+                 for d in self.detectors},
+                int(arrays.id[last]), from_micros(micros[last]),
+            )
+        return events, final
+
+    def backfill(self, db: Session, players: Sequence[PlayerDB], start_time: datetime,
+                 resume: bool = True) -> int:
+        """Reconstruir el estado desde MetricDB y reemplazar los eventos de los detectores.
+
+        Con resume, los jugadores con estado parten de él y solo se procesan
+        sus lecturas posteriores; el resto arranca de cero en start_time.
+        """
+        player_ids = [p.id for p in players]
+        initial = {pid: self._players[pid] for pid in player_ids if resume and pid in self._players}
+        resumed = {pid: state for pid, state in initial.items() if state.last_timestamp is not None}
+        since = min([start_time] + [s.last_timestamp for s in resumed.values()])
+        arrays = load_window(db, player_ids, since)
+
+        # Descartar lo que cada jugador ya había procesado (orden (timestamp, id))
+        keep = np.ones(len(arrays), dtype=bool)
+        micros = arrays.timestamp.astype("datetime64[us]").astype(np.int64)
+        for player_id in np.unique(arrays.player_id).tolist():
+            mine = arrays.player_id == player_id
+            state = resumed.get(player_id)
+            if state is not None:
+                last = to_micros(state.last_timestamp)
+                keep &= ~mine | (micros > last) | ((micros == last) & (arrays.id > state.last_metric_id))
+            else:
+                keep &= ~mine | (micros >= to_micros(start_time))
+        arrays = MetricArrays(arrays.player_id[keep], arrays.timestamp[keep], arrays.heart_rate[keep],
+                              arrays.oxygen[keep], arrays.id[keep])
+
+        events, final = self.run_batch(arrays, resumed)
+
+        for player_id in player_ids:
+            stale = db.query(AnomalyEventDB).filter(
+                AnomalyEventDB.player_id == player_id,
+                AnomalyEventDB.type.in_(self.event_types)
+            )
+            state = resumed.get(player_id)
+            if state is not None:
+                stale = stale.filter(
+                    (AnomalyEventDB.timestamp > state.last_timestamp)
+                    | ((AnomalyEventDB.timestamp == state.last_timestamp)
+                       & (AnomalyEventDB.metric_id > state.last_metric_id))
+                )
+            else:
+                stale = stale.filter(AnomalyEventDB.timestamp >= start_time)
+            stale.delete(synchronize_session=False)
+        db.add_all(events)
+        db.commit()
+
+        with self._lock:
+            for player_id in player_ids:
+                if player_id in final:
+                    self._players[player_id] = final[player_id]
+                elif player_id not in resumed:
+                    self._players.pop(player_id, None)
+        return len(events)
+
+    def snapshot(self, player_id: Optional[int] = None) -> dict:
+        with self._lock:
+            players = dict(self._players)
+        if player_id is not None:
+            player = players.get(player_id)
+            return player.snapshot() if player is not None else None
+        return {str(pid): player.snapshot() for pid, player in players.items()}
+
+    def restore(self, snapshot: dict):
+        """Inverso de snapshot(); los detectores ausentes del snapshot arrancan de cero"""
+        restored = {}
+        for player_id, data in snapshot.items():
+            states = self._initial()
+            for event_type, fields in data.get("detectors", {}).items():
+                if event_type in states:
+                    states[event_type].update({k: v for k, v in fields.items() if k in states[event_type]})
+            last_timestamp = data.get("last_timestamp")
+            restored[int(player_id)] = PlayerDetectorState(
+                states, data.get("last_metric_id"),
+                datetime.fromisoformat(last_timestamp) if last_timestamp else None,
+            )
+        with self._lock:
+            self._players.update(restored)
+
+    def checkpoint(self, db: Session) -> int:
+        """Guardar el estado de todos los jugadores en detector_states"""
+        snapshot = self.snapshot()
+        for player_id, data in snapshot.items():
+            db.merge(DetectorStateDB(player_id=int(player_id), state=json.dumps(data), updated_at=datetime.utcnow()))
+        db.commit()
+        return len(snapshot)
+
+    def load(self, db: Session) -> int:
+        rows = db.query(DetectorStateDB).all()
+        self.restore({str(row.player_id): json.loads(row.state) for row in rows})
+        return len(rows)
+
+
+detectors = DetectorBank(default_detectors())
@@ -0,0 +1,142 @@
+"""Eventos de partida (peleas, muertes, objetivos...) y respuesta cardíaca alineada a ellos.
+
+El análisis event-locked toma la traza de HR de cada evento entre -before y
++after segundos, en una rejilla común de offsets, y promedia todas las trazas
+alineadas. Las lecturas de todos los jugadores implicados se cargan con una
+sola consulta; el muestreo de cada (evento, offset) se hace con un único
+np.searchsorted sobre la clave (jugador, tiempo), interpolando linealmente
+entre las dos lecturas que rodean el instante si distan como mucho max_gap.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import MatchEventDB
+from services.analytics import load_window
+
+MAX_GAP_SECONDS = float(os.getenv("EVENT_MAX_GAP_SECONDS", "30"))
+MAX_OFFSETS = 2000
+
+
+def load_events(db: Session, player_ids: Optional[Sequence[int]] = None, match_id: Optional[str] = None,
+                types: Optional[Sequence[str]] = None, start_time: Optional[datetime] = None,
+                end_time: Optional[datetime] = None) -> List[MatchEventDB]:
+    """Eventos que solapan [start_time, end_time), por el índice de intervalos"""
+    query = db.query(MatchEventDB)
+    if player_ids is not None:
+        query = query.filter(MatchEventDB.player_id.in_(list(player_ids)))
+    if match_id is not None:
+        query = query.filter(MatchEventDB.match_id == match_id)
+    if types:
+        query = query.filter(MatchEventDB.type.in_(list(types)))
+    if end_time is not None:
+        query = query.filter(MatchEventDB.timestamp < end_time)
+    if start_time is not None:
+        query = query.filter(MatchEventDB.end_timestamp >= start_time)
+    return query.order_by(MatchEventDB.timestamp, MatchEventDB.id).all()
+
+
+def offset_grid(before: float, after: float, step: float) -> np.ndarray:
+    offsets = np.arange(-before, after + step / 2, step)
+    if len(offsets) > MAX_OFFSETS:
+        raise ValueError(f"La ventana tiene más de {MAX_OFFSETS} offsets; aumenta step")
+    return offsets
+
+
+def sample_traces(db: Session, event_players: np.ndarray, event_times: np.ndarray,
+                  offsets: np.ndarray, max_gap: float = MAX_GAP_SECONDS) -> np.ndarray:
+    """Matriz (eventos × offsets) de HR; NaN donde no hay lecturas suficientemente cerca"""
+    traces = np.full((len(event_times), len(offsets)), np.nan)
+    if not len(event_times):
+        return traces
+    margin = timedelta(seconds=max_gap)
+    first = event_times.min().astype(datetime) + timedelta(seconds=float(offsets[0])) - margin
+    last = event_times.max().astype(datetime) + timedelta(seconds=float(offsets[-1])) + margin
+    arrays = load_window(db, np.unique(event_players).tolist(), first, last)
+    if not len(arrays):
+        return traces
+
+    # Clave (jugador, tiempo) creciente: grupo × span + segundos desde el origen
+    origin = np.datetime64(first, "us")
+    seconds = (arrays.timestamp - origin) / np.timedelta64(1, "s")
+    query = ((event_times - origin) / np.timedelta64(1, "s"))[:, None] + offsets[None, :]
+    span = max(seconds.max(), query.max()) + max_gap + 1
+    players, group = np.unique(arrays.player_id, return_inverse=True)
+    keys = group * span + seconds
+
+    event_group = np.searchsorted(players, event_players)
+    found = players[np.minimum(event_group, len(players) - 1)] == event_players
+    right = np.searchsorted(keys, event_group[:, None] * span + query, side="right")
+    left = right - 1
+    n = len(keys)
+    left_c, right_c = np.clip(left, 0, n - 1), np.clip(right, 0, n - 1)
+    left_ok = (left >= 0) & (group[left_c] == event_group[:, None])
+    right_ok = (right < n) & (group[right_c] == event_group[:, None])
+
+    t_left, t_right = seconds[left_c], seconds[right_c]
+    hr_left, hr_right = arrays.heart_rate[left_c], arrays.heart_rate[right_c]
+    exact = left_ok & (t_left == query)
+    bracket = left_ok & right_ok & (t_right - t_left <= max_gap)
+    weight = (query - t_left) / np.where(t_right > t_left, t_right - t_left, 1)
+    interpolated = hr_left + weight * (hr_right - hr_left)
+
+    traces = np.where(exact, hr_left, np.where(bracket, interpolated, np.nan))
+    traces[~found] = np.nan
+    return traces
+
+
+def _nan_stats(traces: np.ndarray):
+    valid = ~np.isnan(traces)
+    samples = valid.sum(axis=0)
+    filled = np.where(valid, traces, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0) / samples
+        variance = (np.where(valid, traces - mean, 0.0) ** 2).sum(axis=0) / (samples - 1)
+    std = np.where(samples > 1, np.sqrt(variance), np.where(samples == 1, 0.0, np.nan))
+    return mean, std, samples
+
+
+def _optional(values: np.ndarray, digits: int = 2) -> List[Optional[float]]:
+    return [None if np.isnan(v) else round(float(v), digits) for v in values]
+
+
+def response_curves(traces: np.ndarray, event_types: Sequence[str], offsets: np.ndarray) -> List[dict]:
+    """Media, desviación y variación respecto al pre-evento, por tipo de evento"""
+    # Línea base de cada evento: media de sus muestras en offsets <= 0
+    baseline_columns = traces[:, offsets <= 0]
+    has_baseline = (~np.isnan(baseline_columns)).any(axis=1)
+    baseline = np.full(len(traces), np.nan)
+    baseline[has_baseline] = np.nanmean(baseline_columns[has_baseline], axis=1)
+    deltas = traces - baseline[:, None]
+
+    types = np.asarray(event_types)
+    curves = []
+    for type in sorted(set(event_types)):
+        mask = types == type
+        mean, std, samples = _nan_stats(traces[mask])
+        delta, _, _ = _nan_stats(deltas[mask])
+        curves.append({
+            "type": type,
+            "events": int((~np.isnan(traces[mask])).any(axis=1).sum()),
+            "offsets": offsets.tolist(),
+            "mean_heart_rate": _optional(mean),
+            "std_heart_rate": _optional(std),
+            "delta_heart_rate": _optional(delta),
+            "samples": samples.tolist(),
+        })
+    return curves
+
+
+def event_locked(db: Session, events: Sequence[MatchEventDB], before: float, after: float,
+                 step: float, max_gap: float = MAX_GAP_SECONDS) -> Dict[str, object]:
+    offsets = offset_grid(before, after, step)
+    event_players = np.fromiter((e.player_id for e in events), dtype=np.int64, count=len(events))
+    event_times = np.array([e.timestamp for e in events], dtype="datetime64[us]").reshape(len(events))
+    traces = sample_traces(db, event_players, event_times, offsets, max_gap)
+    return {
+        "before": before, "after": after, "step": step, "max_gap": max_gap,
+        "curves": response_curves(traces, [e.type for e in events], offsets),
+    }
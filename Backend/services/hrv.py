@@ -0,0 +1,321 @@
+"""Canal de intervalos RR (latido a latido) y motor de HRV vectorizado.
+
+Cada lote recibido se guarda como un bloque de rr_chunks con los intervalos
+empaquetados en uint16 (2 bytes por latido) e índice de intervalos por
+jugador; una hora a 1-3 Hz son unas pocas filas, no miles.
+
+La HRV se calcula por ventanas deslizantes de `window` segundos cada `step`
+(alineadas a múltiplos de step), para todos los jugadores a la vez:
+    tiempo      SDNN, RMSSD y pNN50 con sumas acumuladas: cada ventana es la
+                resta de dos posiciones localizadas con searchsorted
+    frecuencia  LF (0.04-0.15 Hz) y HF (0.15-0.4 Hz) por Welch sobre el
+                tacograma remuestreado a RESAMPLE_HZ, todas las ventanas en
+                un único rfft
+Los intervalos fuera de [RR_MIN_MS, RR_MAX_MS] se descartan como artefactos;
+una diferencia sucesiva solo cuenta entre latidos consecutivos sin hueco.
+
+Los resultados se cachean por (jugador, ventana); un bloque nuevo invalida
+las ventanas del jugador que solapa.
+"""
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import RRChunkDB
+
+EPOCH = datetime(1970, 1, 1)
+RR_MIN_MS = 300
+RR_MAX_MS = 2000
+CONTIGUOUS_TOLERANCE_MS = 5  # Holgura entre el hueco entre latidos y el intervalo
+MIN_BEATS = 30  # Latidos mínimos en una ventana para dar métricas
+RESAMPLE_HZ = 4.0
+SEGMENT_SECONDS = 64  # Segmentos de Welch (256 muestras a 4 Hz, solapados al 50%)
+MIN_COVERAGE = 0.95  # Fracción del tacograma con datos para dar LF/HF
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.40)
+MAX_WINDOWS = 5000
+FREQUENCY_BATCH = 256  # Ventanas por rfft, para acotar memoria
+
+
+def seconds_of(timestamp: datetime) -> float:
+    return (timestamp - EPOCH).total_seconds()
+
+
+def make_chunk(player_id: int, intervals: Sequence[int], start_time: datetime) -> RRChunkDB:
+    rr = np.asarray(intervals, dtype=np.int64)
+    if rr.min() < 1 or rr.max() > np.iinfo(np.uint16).max:
+        raise ValueError("Los intervalos RR deben estar entre 1 y 65535 ms")
+    return RRChunkDB(
+        player_id=player_id, start_time=start_time, end_time=start_time + timedelta(milliseconds=int(rr.sum())),
+        count=len(rr), intervals=rr.astype("<u2").tobytes(),
+    )
+
+
+def unpack(chunk: RRChunkDB) -> np.ndarray:
+    return np.frombuffer(chunk.intervals, dtype="<u2").astype(float)
+
+
+class Beats:
+    """Latidos ordenados por (jugador, tiempo): instante en s desde EPOCH y RR en ms"""
+
+    def __init__(self, player_id: np.ndarray, time: np.ndarray, rr: np.ndarray):
+        self.player_id = player_id
+        self.time = time
+        self.rr = rr
+        # contiguous[i]: el latido i sigue al i-1 del mismo jugador sin hueco
+        gap_ms = np.r_[np.inf, np.diff(time) * 1000]
+        same = np.r_[False, player_id[1:] == player_id[:-1]]
+        self.contiguous = same & (np.abs(gap_ms - rr) <= CONTIGUOUS_TOLERANCE_MS)
+
+    def __len__(self):
+        return len(self.rr)
+
+
+def load_beats(db: Session, player_ids: Sequence[int], start_time: datetime, end_time: datetime) -> Beats:
+    """Desempaquetar los bloques que solapan el rango (una consulta) y descartar artefactos"""
+    chunks = db.query(RRChunkDB).filter(
+        RRChunkDB.player_id.in_(list(player_ids)),
+        RRChunkDB.start_time < end_time,
+        RRChunkDB.end_time >= start_time
+    ).all()
+    if not chunks:
+        empty = np.zeros(0)
+        return Beats(empty.astype(np.int64), empty, empty)
+
+    rr = [unpack(c) for c in chunks]
+    times = np.concatenate([seconds_of(c.start_time) + np.cumsum(r) / 1000 for c, r in zip(chunks, rr)])
+    players = np.repeat([c.player_id for c in chunks], [len(r) for r in rr])
+    rr = np.concatenate(rr)
+
+    keep = (rr >= RR_MIN_MS) & (rr <= RR_MAX_MS) & (times >= seconds_of(start_time)) & (times < seconds_of(end_time))
+    order = np.lexsort((times[keep], players[keep]))
+    return Beats(players[keep][order], times[keep][order], rr[keep][order])
+
+
+def _prefix(values: np.ndarray) -> np.ndarray:
+    return np.r_[0.0, np.cumsum(values)]
+
+
+def window_metrics(beats: Beats, window_players: np.ndarray, window_starts: np.ndarray,
+                   window: float) -> Dict[str, np.ndarray]:
+    """Métricas de HRV de cada ventana (jugador, inicio en s); NaN si no hay datos suficientes"""
+    n_windows = len(window_starts)
+    if not len(beats):
+        nan = np.full(n_windows, np.nan)
+        return {"beats": np.zeros(n_windows, dtype=np.int64), **{k: nan for k in (
+            "mean_rr", "sdnn", "rmssd", "pnn50", "lf", "hf")}}
+
+    # Clave (jugador, tiempo) creciente, como en services.events
+    origin = min(beats.time.min(), window_starts.min())
+    span = max(beats.time.max(), window_starts.max() + window) - origin + 1
+    players, group = np.unique(beats.player_id, return_inverse=True)
+    keys = group * span + (beats.time - origin)
+    window_group = np.searchsorted(players, window_players)
+    found = players[np.minimum(window_group, len(players) - 1)] == window_players
+    base = window_group * span + (window_starts - origin)
+    lo = np.where(found, np.searchsorted(keys, base), 0)
+    hi = np.where(found, np.searchsorted(keys, base + window), 0)
+
+    rr = beats.rr
+    count = hi - lo
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = _prefix(rr)
+        squares = _prefix(rr * rr)
+        mean = (total[hi] - total[lo]) / count
+        variance = ((squares[hi] - squares[lo]) - count * mean ** 2) / (count - 1)
+
+        # Diferencias sucesivas: la del latido i (con el i-1) cuenta si ambos están en la ventana
+        diff = np.r_[0.0, np.diff(rr)]
+        valid = beats.contiguous
+        diff_squares = _prefix(np.where(valid, diff * diff, 0.0))
+        diff_count = _prefix(valid.astype(float))
+        nn50 = _prefix((valid & (np.abs(diff) > 50)).astype(float))
+        first = np.minimum(lo + 1, hi)
+        pairs = diff_count[hi] - diff_count[first]
+        rmssd = np.sqrt((diff_squares[hi] - diff_squares[first]) / pairs)
+        pnn50 = 100 * (nn50[hi] - nn50[first]) / pairs
+
+    enough = count >= MIN_BEATS
+    lf, hf = _frequency_domain(beats, keys, group, window_group, found & enough, base, window)
+    masked = lambda values: np.where(enough, values, np.nan)
+    return {
+        "beats": count, "mean_rr": masked(mean), "sdnn": masked(np.sqrt(np.maximum(variance, 0))),
+        "rmssd": masked(rmssd), "pnn50": masked(pnn50), "lf": lf, "hf": hf,
+    }
+
+
+def _frequency_domain(beats: Beats, keys: np.ndarray, group: np.ndarray, window_group: np.ndarray,
+                      selected: np.ndarray, base: np.ndarray, window: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Potencia LF y HF (ms²) por Welch sobre el tacograma remuestreado de cada ventana"""
+    lf = np.full(len(base), np.nan)
+    hf = np.full(len(base), np.nan)
+    samples = int(window * RESAMPLE_HZ)
+    segment = min(int(SEGMENT_SECONDS * RESAMPLE_HZ), samples)
+    if segment < 2:
+        return lf, hf
+    offsets = np.arange(samples) / RESAMPLE_HZ
+    taper = np.hanning(segment)
+    scale = 1.0 / (RESAMPLE_HZ * (taper ** 2).sum())
+    freqs = np.fft.rfftfreq(segment, 1 / RESAMPLE_HZ)
+    df = freqs[1] - freqs[0]
+    lf_band = (freqs >= LF_BAND[0]) & (freqs < LF_BAND[1])
+    hf_band = (freqs >= HF_BAND[0]) & (freqs < HF_BAND[1])
+    nyquist = -1 if segment % 2 == 0 else None
+    n = len(keys)
+
+    indices = np.flatnonzero(selected)
+    for batch in np.array_split(indices, max(1, -(-len(indices) // FREQUENCY_BATCH))):
+        if not len(batch):
+            continue
+        query = base[batch, None] + offsets[None, :]
+        right = np.searchsorted(keys, query, side="right")
+        left = right - 1
+        left_c, right_c = np.clip(left, 0, n - 1), np.clip(right, 0, n - 1)
+        # Interpolación solo entre dos latidos consecutivos del mismo jugador
+        valid = (left >= 0) & (right < n) & (group[left_c] == window_group[batch, None]) & beats.contiguous[right_c]
+        t_left, t_right = keys[left_c], keys[right_c]
+        weight = (query - t_left) / np.where(t_right > t_left, t_right - t_left, 1)
+        tachogram = beats.rr[left_c] + weight * (beats.rr[right_c] - beats.rr[left_c])
+
+        counts = valid.sum(axis=1)
+        coverage = counts / samples
+        fill = np.where(valid, tachogram, 0.0).sum(axis=1) / np.maximum(counts, 1)
+        tachogram = np.where(valid, tachogram, fill[:, None])
+
+        segments = np.lib.stride_tricks.sliding_window_view(tachogram, segment, axis=1)[:, ::max(segment // 2, 1), :]
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        power = np.abs(np.fft.rfft(segments * taper, axis=2)) ** 2 * scale
+        power[:, :, 1:nyquist] *= 2  # Espectro de un solo lado
+        psd = power.mean(axis=1)
+
+        ok = coverage >= MIN_COVERAGE
+        lf[batch] = np.where(ok, psd[:, lf_band].sum(axis=1) * df, np.nan)
+        hf[batch] = np.where(ok, psd[:, hf_band].sum(axis=1) * df, np.nan)
+    return lf, hf
+
+
+def _optional(value: float, digits: int = 2) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+class HRVCache:
+    """Métricas por (jugador, inicio, longitud de ventana), invalidadas por solape con bloques nuevos"""
+
+    def __init__(self, max_per_player: int = 20000):
+        self.max_per_player = max_per_player
+        self._lock = threading.Lock()
+        self._windows: Dict[int, Dict[Tuple[float, float], dict]] = {}
+        self._generation: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, player_id: int) -> int:
+        with self._lock:
+            return self._generation.get(player_id, 0)
+
+    def get(self, player_id: int, start: float, window: float) -> Optional[dict]:
+        with self._lock:
+            entry = self._windows.get(player_id, {}).get((start, window))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, player_id: int, generation: int, entries: Dict[Tuple[float, float], dict]):
+        """Guardar solo si no ha llegado ningún bloque del jugador mientras se calculaba"""
+        with self._lock:
+            if self._generation.get(player_id, 0) != generation:
+                return
+            windows = self._windows.setdefault(player_id, {})
+            windows.update(entries)
+            while len(windows) > self.max_per_player:
+                windows.pop(next(iter(windows)))
+
+    def invalidate(self, player_id: int, start: float, end: float):
+        with self._lock:
+            self._generation[player_id] = self._generation.get(player_id, 0) + 1
+            windows = self._windows.get(player_id, {})
+            for key in [k for k in windows if k[0] <= end and k[0] + k[1] > start]:
+                del windows[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": sum(len(w) for w in self._windows.values()), "hits": self.hits, "misses": self.misses}
+
+
+class HRVEngine:
+    def __init__(self):
+        self.cache = HRVCache()
+
+    def ingest(self, db: Session, player_id: int, intervals: Sequence[int],
+               start_time: Optional[datetime] = None) -> RRChunkDB:
+        """Guardar un lote; sin start_time se asume que su último latido es ahora"""
+        if start_time is None:
+            start_time = datetime.utcnow() - timedelta(milliseconds=int(np.sum(intervals)))
+        chunk = make_chunk(player_id, intervals, start_time)
+        db.add(chunk)
+        db.commit()
+        db.refresh(chunk)
+        self.cache.invalidate(player_id, seconds_of(chunk.start_time), seconds_of(chunk.end_time))
+        return chunk
+
+    def windows(self, db: Session, player_ids: Sequence[int], start_time: datetime, end_time: datetime,
+                window: float, step: float) -> Dict[int, List[dict]]:
+        """Ventanas completas dentro de [start_time, end_time), desde la caché o calculadas en lote"""
+        first = np.ceil(seconds_of(start_time) / step) * step
+        starts = np.arange(first, seconds_of(end_time) - window + 1e-9, step)
+        if len(starts) * len(player_ids) > MAX_WINDOWS:
+            raise ValueError(f"Más de {MAX_WINDOWS} ventanas; reduce el rango o aumenta step")
+
+        results = {pid: {} for pid in player_ids}
+        generations = {pid: self.cache.generation(pid) for pid in player_ids}
+        missing = []
+        for pid in player_ids:
+            for start in starts.tolist():
+                cached = self.cache.get(pid, start, window)
+                if cached is None:
+                    missing.append((pid, start))
+                else:
+                    results[pid][start] = cached
+
+        if missing:
+            window_players = np.array([pid for pid, _ in missing], dtype=np.int64)
+            window_starts = np.array([start for _, start in missing])
+            range_start = EPOCH + timedelta(seconds=float(window_starts.min()))
+            range_end = EPOCH + timedelta(seconds=float(window_starts.max() + window))
+            beats = load_beats(db, sorted(set(window_players.tolist())), range_start, range_end)
+            metrics = window_metrics(beats, window_players, window_starts, window)
+
+            computed: Dict[int, Dict[Tuple[float, float], dict]] = {}
+            for i, (pid, start) in enumerate(missing):
+                entry = self._entry(start, window, {name: values[i] for name, values in metrics.items()})
+                results[pid][start] = entry
+                computed.setdefault(pid, {})[(start, window)] = entry
+            for pid, entries in computed.items():
+                self.cache.put(pid, generations[pid], entries)
+
+        return {pid: [windows[start] for start in starts.tolist()] for pid, windows in results.items()}
+
+    def _entry(self, start: float, window: float, values: dict) -> dict:
+        mean_rr = values["mean_rr"]
+        lf, hf = values["lf"], values["hf"]
+        return {
+            "start": EPOCH + timedelta(seconds=start),
+            "end": EPOCH + timedelta(seconds=start + window),
+            "beats": int(values["beats"]),
+            "mean_rr": _optional(mean_rr),
+            "mean_heart_rate": _optional(60000 / mean_rr) if not np.isnan(mean_rr) else None,
+            "sdnn": _optional(values["sdnn"]),
+            "rmssd": _optional(values["rmssd"]),
+            "pnn50": _optional(values["pnn50"]),
+            "lf": _optional(lf),
+            "hf": _optional(hf),
+            "lf_hf": _optional(lf / hf) if not np.isnan(lf) and hf > 0 else None,
+        }
+
+
+hrv = HRVEngine()
@@ -0,0 +1,274 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import fastapi.routing
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+class _ShardedMetric:
+    """Métrica con un shard por hilo: el camino caliente no toma locks"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "values", None)
+        if shard is None:
+            shard = self._local.values = {}
+            # Solo se bloquea la primera vez que un hilo usa la métrica
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _snapshot(self) -> List[List[Tuple[tuple, object]]]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [list(shard.items()) for shard in shards]
+
+    def _labels(self, labelvalues: tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, labelvalues))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+    def expose(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_ShardedMetric):
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _samples(self) -> List[str]:
+        totals: Dict[tuple, float] = {}
+        for items in self._snapshot():
+            for labels, value in items:
+                totals[labels] = totals.get(labels, 0) + value
+        return [f"{self.name}{self._labels(labels)} {value}" for labels, value in sorted(totals.items())]
+
+
+class Histogram(_ShardedMetric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels: tuple = ()):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # Un contador por bucket más +Inf, y la suma al final
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _samples(self) -> List[str]:
+        merged: Dict[tuple, list] = {}
+        for items in self._snapshot():
+            for labels, counts in items:
+                total = merged.setdefault(labels, [0] * len(counts))
+                for i, value in enumerate(list(counts)):
+                    total[i] += value
+
+        lines = []
+        bounds = [_format_bound(b) for b in self.buckets] + ["+Inf"]
+        for labels, counts in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels(labels, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Registro de métricas y de colectores de valores calculados al exponer"""
+
+    def __init__(self):
+        self.metrics: List[_ShardedMetric] = []
+        self.collectors: List[Callable[[], Iterable[Tuple[str, str, str, dict, float]]]] = []
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """collector() devuelve tuplas (nombre, tipo, ayuda, labels, valor)"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        declared = set()
+        for collector in self.collectors:
+            for name, kind, help, labels, value in collector():
+                if name not in declared:
+                    declared.add(name)
+                    lines.append(f"# HELP {name} {help}")
+                    lines.append(f"# TYPE {name} {kind}")
+                label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    __slots__ = ("statements", "rows", "serialization")
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.serialization = 0.0
+
+
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    "http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta",
+    ("method", "route", "status"))
+REQUEST_STATEMENTS = registry.histogram(
+    "db_statements_per_request", "Sentencias SQL ejecutadas por petición",
+    ("route",), COUNT_BUCKETS)
+REQUEST_ROWS = registry.histogram(
+    "orm_rows_loaded_per_request", "Filas ORM cargadas por petición",
+    ("route",), COUNT_BUCKETS)
+REQUEST_SERIALIZATION = registry.histogram(
+    "response_serialization_seconds", "Tiempo de serialización de la respuesta por petición",
+    ("route",))
+DB_STATEMENTS = registry.counter(
+    "db_statements_total", "Sentencias SQL ejecutadas")
+POOL_CHECKOUT_WAIT = registry.histogram(
+    "db_pool_checkout_wait_seconds", "Espera para obtener una conexión del pool")
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool que mide la espera de checkout de cada conexión"""
+
+    def connect(self):
+        started = time.perf_counter()
+        connection = super().connect()
+        POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+        return connection
+
+
+class PrometheusMiddleware:
+    """Middleware ASGI que registra latencia y contadores por plantilla de ruta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_request.reset(token)
+            # El router deja la ruta resuelta en el scope; así se etiqueta por
+            # plantilla (/players/{player_id}) y no por URL concreta
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            REQUEST_LATENCY.observe(elapsed, (scope["method"], route, str(status[0])))
+            REQUEST_STATEMENTS.observe(stats.statements, (route,))
+            REQUEST_ROWS.observe(stats.rows, (route,))
+            REQUEST_SERIALIZATION.observe(stats.serialization, (route,))
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _current_request.get()
+
+
+def install_sqlalchemy(engine, base):
+    """Contar sentencias SQL y filas ORM de la petición en curso"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        DB_STATEMENTS.inc()
+        stats = _current_request.get()
+        if stats is not None:
+            stats.statements += 1
+
+    @event.listens_for(base, "load", propagate=True)
+    def count_row(target, context):
+        stats = _current_request.get()
+        if stats is not None:
+            stats.rows += 1
+
+
+def install_serialization_timer():
+    """Medir fastapi.routing.serialize_response, que FastAPI resuelve en cada llamada"""
+    original = fastapi.routing.serialize_response
+
+    @functools.wraps(original)
+    async def timed_serialize_response(*args, **kwargs):
+        with timed_serialization():
+            return await original(*args, **kwargs)
+
+    fastapi.routing.serialize_response = timed_serialize_response
+
+
+@contextlib.contextmanager
+def timed_serialization():
+    """Medir una serialización hecha fuera de serialize_response (build() de la caché de respuestas)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = _current_request.get()
+        if stats is not None:
+            stats.serialization += time.perf_counter() - started
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
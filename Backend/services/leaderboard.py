@@ -0,0 +1,163 @@
+"""Clasificaciones en vivo del roster (top-k), actualizadas en la ingesta.
+
+Para cada puntuación se mantienen listas ordenadas (bisect) de todo el
+roster, de cada equipo y de cada rol. Una lectura nueva recoloca a su
+jugador en ellas con búsqueda binaria; un top-k es recorrer los k primeros
+elementos del índice que corresponda, sin consultar la base de datos.
+
+Puntuaciones:
+    heart_rate         HR actual, de mayor a menor
+    oxygen_saturation  SpO2 actual, de menor a mayor
+    strain             HR actual como % del primer umbral de HR del jugador
+    risk               nivel de estado de la lectura actual y, a igualdad, strain
+"""
+import bisect
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import and_, func
+from sqlalchemy.orm import Session
+
+from database.db import MetricDB, PlayerDB
+from services.analytics import clean_readings
+from services.rules import NORMAL, OPERATORS, CompiledRules, rules
+
+METRICS = ("heart_rate", "oxygen_saturation", "strain", "risk")
+
+
+def heart_rate_limit(compiled: CompiledRules, player_id: int) -> Optional[float]:
+    """Umbral de HR más bajo del jugador (el que antes dispara un nivel)"""
+    thresholds = compiled.player_thresholds(player_id)
+    limits = [
+        thresholds[k] for k, (_, metric, op) in enumerate(compiled.keys)
+        if metric == "heart_rate" and OPERATORS[op][1] == "max" and np.isfinite(thresholds[k])
+    ]
+    return float(min(limits)) if limits else None
+
+
+class Entry:
+    __slots__ = ("player_id", "name", "team", "role", "heart_rate", "oxygen_saturation",
+                 "strain", "level", "status", "timestamp")
+
+    def __init__(self, player: PlayerDB):
+        self.player_id = player.id
+        self.name = player.name
+        self.team = player.team
+        self.role = player.role
+
+    def sort_keys(self) -> Dict[str, tuple]:
+        # Orden ascendente = mejor puesto; el id desempata de forma estable
+        return {
+            "heart_rate": (-self.heart_rate, self.player_id),
+            "oxygen_saturation": (self.oxygen_saturation, self.player_id),
+            "strain": (-self.strain, self.player_id),
+            "risk": (-self.level, -self.strain, self.player_id),
+        }
+
+    def value(self, metric: str):
+        return self.level if metric == "risk" else getattr(self, metric)
+
+    def to_dict(self, metric: str) -> dict:
+        return {
+            "player_id": self.player_id,
+            "name": self.name,
+            "team": self.team,
+            "role": self.role,
+            "value": round(self.strain, 1) if metric == "strain" else self.value(metric),
+            "heart_rate": self.heart_rate,
+            "oxygen_saturation": self.oxygen_saturation,
+            "strain": round(self.strain, 1),
+            "status": self.status,
+            "timestamp": self.timestamp,
+        }
+
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Entry] = {}
+        self._keys: Dict[int, Dict[str, tuple]] = {}
+        # (métrica, ámbito) -> lista ordenada de claves; ámbito: None, ("team", x), ("role", x)
+        self._indexes: Dict[Tuple[str, Optional[tuple]], List[tuple]] = {}
+        self.version = None  # Versión de reglas con la que se calcularon strain y nivel
+
+    def _scopes(self, entry: Entry):
+        return (None, ("team", entry.team), ("role", entry.role))
+
+    def update(self, player: PlayerDB, metric: MetricDB, compiled: Optional[CompiledRules] = None):
+        """Ingesta: recolocar al jugador en todos sus índices (búsqueda binaria)"""
+        compiled = compiled or rules.compile_player(player)
+        values = {"heart_rate": metric.heart_rate, "oxygen_saturation": metric.oxygen_saturation}
+        limit = heart_rate_limit(compiled, player.id)
+        level = compiled.reading_level(player.id, values)
+
+        with self._lock:
+            entry = self._entries.get(player.id)
+            if entry is not None and entry.timestamp > metric.timestamp:
+                return  # Lectura atrasada: no es el valor actual
+            if entry is None:
+                entry = self._entries[player.id] = Entry(player)
+            entry.heart_rate = metric.heart_rate
+            entry.oxygen_saturation = metric.oxygen_saturation
+            entry.strain = 100.0 * metric.heart_rate / limit if limit else 0.0
+            entry.level = level
+            entry.status = ([NORMAL] + compiled.levels)[level]
+            entry.timestamp = metric.timestamp
+
+            old_keys = self._keys.get(player.id)
+            new_keys = self._keys[player.id] = entry.sort_keys()
+            for name in METRICS:
+                for scope in self._scopes(entry):
+                    index = self._indexes.setdefault((name, scope), [])
+                    if old_keys is not None:
+                        del index[bisect.bisect_left(index, old_keys[name])]
+                    bisect.insort(index, new_keys[name])
+
+    def top(self, metric: str, k: int, team: Optional[str] = None, role: Optional[str] = None,
+            max_age: Optional[float] = None) -> List[dict]:
+        """Los k primeros; con equipo y rol se recorre el índice del equipo filtrando el rol"""
+        scope = ("team", team) if team is not None else ("role", role) if role is not None else None
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age) if max_age is not None else None
+        results = []
+        with self._lock:
+            for key in self._indexes.get((metric, scope), ()):
+                entry = self._entries[key[-1]]
+                if role is not None and entry.role != role:
+                    continue
+                if cutoff is not None and entry.timestamp < cutoff:
+                    continue
+                results.append(entry.to_dict(metric))
+                if len(results) == k:
+                    break
+        return results
+
+    def size(self, team: Optional[str] = None, role: Optional[str] = None) -> int:
+        scope = ("team", team) if team is not None else ("role", role) if role is not None else None
+        with self._lock:
+            index = self._indexes.get(("heart_rate", scope), ())
+            if team is not None and role is not None:
+                return sum(1 for key in index if self._entries[key[-1]].role == role)
+            return len(index)
+
+    def rebuild(self, db: Session, players: Sequence[PlayerDB]):
+        """Cargar la última lectura de cada jugador en una sola consulta"""
+        latest = clean_readings(db.query(
+            MetricDB.player_id, func.max(MetricDB.timestamp).label("timestamp")
+        )).group_by(MetricDB.player_id).subquery()
+        metrics = clean_readings(db.query(MetricDB)).join(latest, and_(
+            MetricDB.player_id == latest.c.player_id, MetricDB.timestamp == latest.c.timestamp
+        )).order_by(MetricDB.id).all()
+
+        compiled = rules.compile(players)
+        with self._lock:
+            self._entries, self._keys, self._indexes = {}, {}, {}
+            self.version = rules.version
+        by_id = {p.id: p for p in players}
+        for metric in metrics:
+            if metric.player_id in by_id:
+                self.update(by_id[metric.player_id], metric, compiled)
+
+
+leaderboard = Leaderboard()
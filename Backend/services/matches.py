@@ -0,0 +1,144 @@
+"""Partidas (sesiones) y sus agregados precalculados.
+
+Una partida tiene inicio, fin y jugadores participantes. Al cerrarse, una
+tarea en segundo plano lee sus lecturas con una consulta, calcula los
+agregados por jugador y por equipo (fusionando los de sus jugadores con los
+mismos agregados parciales que services.aggregation) y los guarda en
+match_aggregates; los endpoints de la partida devuelven esas filas sin tocar
+las lecturas. Mientras está abierta, los agregados se calculan al vuelo.
+
+Los niveles de estado quedan evaluados con las reglas vigentes al agregar;
+POST /admin/matches/{id}/aggregate los recalcula.
+"""
+import json
+import secrets
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import MatchAggregateDB, MatchDB, MatchPlayerDB, PlayerDB, SessionLocal
+from services.aggregation import empty_aggregate, merge_into, summarize
+from services.analytics import group_bounds, load_window
+from services.rules import rules
+
+OPEN = "open"
+CLOSED = "closed"
+AGGREGATED = "aggregated"
+
+
+def new_match_id() -> str:
+    return secrets.token_hex(6)
+
+
+def find_matches(db: Session, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
+                 player_id: Optional[int] = None, status: Optional[str] = None) -> List[MatchDB]:
+    """Partidas que solapan [start_time, end_time) (las abiertas llegan hasta ahora)"""
+    query = db.query(MatchDB)
+    if player_id is not None:
+        query = query.join(MatchPlayerDB).filter(MatchPlayerDB.player_id == player_id)
+    if end_time is not None:
+        query = query.filter(MatchDB.start_time < end_time)
+    if start_time is not None:
+        query = query.filter((MatchDB.end_time >= start_time) | (MatchDB.end_time.is_(None)))
+    if status is not None:
+        query = query.filter(MatchDB.status == status)
+    return query.order_by(MatchDB.start_time, MatchDB.id).all()
+
+
+def compute_aggregates(db: Session, match: MatchDB) -> List[dict]:
+    """Agregados por jugador y por equipo de las lecturas de la partida"""
+    player_ids = sorted(p.player_id for p in match.players)
+    players = db.query(PlayerDB).filter(PlayerDB.id.in_(player_ids)).order_by(PlayerDB.id).all()
+    arrays = load_window(db, player_ids, match.start_time, match.end_time or datetime.utcnow())
+
+    per_player: Dict[int, tuple] = {}
+    if len(arrays):
+        compiled = rules.compile(players)
+        fired = compiled.fired_readings(arrays.player_id, {
+            "heart_rate": arrays.heart_rate, "oxygen_saturation": arrays.oxygen})
+        statuses = compiled.statuses(compiled.level_of(fired))
+        starts, ends, counts = group_bounds(arrays.player_id)
+        hr, o2 = arrays.heart_rate, arrays.oxygen
+        columns = [
+            counts,
+            np.add.reduceat(hr, starts), np.add.reduceat(hr * hr, starts),
+            np.minimum.reduceat(hr, starts), np.maximum.reduceat(hr, starts),
+            np.add.reduceat(o2, starts), np.add.reduceat(o2 * o2, starts),
+            np.minimum.reduceat(o2, starts), np.maximum.reduceat(o2, starts),
+        ]
+        for row, (begin, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            levels: Dict[str, int] = {}
+            for status in statuses[begin:end].tolist():
+                levels[status] = levels.get(status, 0) + 1
+            per_player[int(arrays.player_id[begin])] = ([int(column[row]) for column in columns], levels)
+
+    results = []
+    teams: Dict[str, tuple] = {}
+    for player in players:
+        aggregate, levels = per_player.get(player.id, (empty_aggregate(), {}))
+        results.append({"scope": "player", "player_id": player.id, "team": player.team, **summarize(aggregate, levels)})
+        team_aggregate, team_levels = teams.setdefault(player.team, (empty_aggregate(), {}))
+        merge_into(team_aggregate, aggregate)
+        for status, count in levels.items():
+            team_levels[status] = team_levels.get(status, 0) + count
+    for team, (aggregate, levels) in sorted(teams.items()):
+        results.append({"scope": "team", "player_id": None, "team": team, **summarize(aggregate, levels)})
+    return results
+
+
+def store_aggregates(db: Session, match: MatchDB) -> int:
+    rows = compute_aggregates(db, match)
+    db.query(MatchAggregateDB).filter(MatchAggregateDB.match_id == match.id).delete(synchronize_session=False)
+    db.add_all(
+        MatchAggregateDB(match_id=match.id, **{**row, "readings_by_level": json.dumps(row["readings_by_level"])})
+        for row in rows
+    )
+    match.status = AGGREGATED
+    match.aggregated_at = datetime.utcnow()
+    db.commit()
+    return len(rows)
+
+
+def aggregate_match(match_id: str):
+    """Tarea en segundo plano: agregar una partida cerrada con su propia sesión"""
+    with SessionLocal() as db:
+        match = db.query(MatchDB).filter(MatchDB.id == match_id).first()
+        if match is not None and match.status == CLOSED:
+            store_aggregates(db, match)
+
+
+def aggregate_pending(db: Session) -> int:
+    """Partidas cerradas sin agregar (p.ej. si el proceso se detuvo antes de la tarea)"""
+    pending = find_matches(db, status=CLOSED)
+    for match in pending:
+        store_aggregates(db, match)
+    return len(pending)
+
+
+def load_aggregates(db: Session, match_id: str) -> List[dict]:
+    rows = db.query(MatchAggregateDB).filter(MatchAggregateDB.match_id == match_id).order_by(MatchAggregateDB.id).all()
+    return [aggregate_dict(row) for row in rows]
+
+
+def aggregate_dict(row: MatchAggregateDB) -> dict:
+    columns = [c.name for c in MatchAggregateDB.__table__.columns if c.name not in ("id", "match_id", "computed_at")]
+    data = {name: getattr(row, name) for name in columns}
+    data["readings_by_level"] = json.loads(row.readings_by_level or "{}")
+    return data
+
+
+def match_dict(match: MatchDB) -> dict:
+    return {
+        "id": match.id, "name": match.name, "start_time": match.start_time, "end_time": match.end_time,
+        "status": match.status, "aggregated_at": match.aggregated_at,
+        "player_ids": sorted(p.player_id for p in match.players),
+    }
+
+
+def split_scopes(aggregates: Sequence[dict]) -> Dict[str, List[dict]]:
+    return {
+        "players": [a for a in aggregates if a["scope"] == "player"],
+        "teams": [a for a in aggregates if a["scope"] == "team"],
+    }
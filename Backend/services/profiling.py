@@ -0,0 +1,302 @@
+import asyncio
+import cProfile
+import fnmatch
+import functools
+import io
+import itertools
+import marshal
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+
+# Con token, la cabecera X-Profile debe llevar este valor; sin él, la cabecera
+# (X-Profile: 1) solo vale mientras el perfilado esté activado desde /admin/profiling
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+HEADER = "x-profile"
+MODE_HEADER = "x-profile-mode"
+
+SAMPLE_INTERVAL_SECONDS = 0.002
+MAX_STACK_DEPTH = 128
+
+
+class ProfileRequest:
+    """Petición seleccionada para perfilar (se propaga por contextvar)"""
+
+    __slots__ = ("path", "mode", "trace_allocations")
+
+    def __init__(self, path: str, mode: str, trace_allocations: bool):
+        self.path = path
+        self.mode = mode
+        self.trace_allocations = trace_allocations
+
+
+class ProfileResult:
+    def __init__(self, id: int, request: ProfileRequest, started: datetime, duration: float,
+                 pstats: Optional[bytes], collapsed: Optional[str], allocations: Optional[str]):
+        self.id = id
+        self.path = request.path
+        self.mode = request.mode
+        self.started = started
+        self.duration = duration
+        self.pstats = pstats
+        self.collapsed = collapsed
+        self.allocations = allocations
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "path": self.path,
+            "mode": self.mode,
+            "started": self.started,
+            "duration_ms": round(self.duration * 1000, 2),
+            "formats": [name for name, data in (
+                ("pstats", self.pstats), ("collapsed", self.collapsed), ("allocations", self.allocations)
+            ) if data is not None],
+        }
+
+
+class Profiler:
+    """Configuración en caliente, selección de peticiones y almacén de perfiles"""
+
+    def __init__(self, max_results: int = 50):
+        self.enabled = False
+        self.paths: List[str] = []
+        self.sample_rate = 1.0
+        self.mode = "cprofile"
+        self.trace_allocations = False
+        self.results: Deque[ProfileResult] = deque(maxlen=max_results)
+        self._ids = itertools.count(1)
+        self._tracemalloc_lock = threading.Lock()
+        self._tracemalloc_users = 0
+        self._tracemalloc_owned = False  # Solo se para el tracing que arrancó este módulo
+
+    def configure(self, enabled: bool, paths: List[str], sample_rate: float,
+                  mode: str, trace_allocations: bool):
+        self.enabled = enabled
+        self.paths = list(paths)
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.trace_allocations = trace_allocations
+
+    def config(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "paths": self.paths,
+            "sample_rate": self.sample_rate,
+            "mode": self.mode,
+            "trace_allocations": self.trace_allocations,
+        }
+
+    def select(self, path: str, headers: Dict[str, str]) -> Optional[ProfileRequest]:
+        """Decidir si se perfila la petición: cabecera explícita o muestreo por ruta"""
+        mode = headers.get(MODE_HEADER, self.mode)
+        if mode not in ("cprofile", "sampling"):
+            mode = self.mode
+
+        flag = headers.get(HEADER)
+        if flag is not None:
+            if PROFILING_TOKEN:
+                allowed = secrets.compare_digest(flag, PROFILING_TOKEN)
+            else:
+                allowed = self.enabled and flag == "1"
+            if allowed:
+                return ProfileRequest(path, mode, self.trace_allocations)
+
+        if not self.enabled:
+            return None
+        if self.paths and not any(fnmatch.fnmatchcase(path, pattern) for pattern in self.paths):
+            return None
+        if random.random() >= self.sample_rate:
+            return None
+        return ProfileRequest(path, mode, self.trace_allocations)
+
+    def get(self, profile_id: int) -> Optional[ProfileResult]:
+        return next((r for r in self.results if r.id == profile_id), None)
+
+    # tracemalloc es global al proceso: se arranca mientras haya peticiones que lo usen
+    def _start_tracemalloc(self):
+        with self._tracemalloc_lock:
+            if self._tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self._tracemalloc_owned = True
+            self._tracemalloc_users += 1
+
+    def _stop_tracemalloc(self):
+        with self._tracemalloc_lock:
+            self._tracemalloc_users -= 1
+            if self._tracemalloc_users == 0 and self._tracemalloc_owned:
+                tracemalloc.stop()
+                self._tracemalloc_owned = False
+
+    def run(self, request: ProfileRequest, fn, /, *args, **kwargs):
+        """Ejecutar fn en el hilo actual bajo el perfilador elegido"""
+        before = None
+        if request.trace_allocations:
+            self._start_tracemalloc()
+            before = tracemalloc.take_snapshot()
+
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        profile = sampler = None
+        if request.mode == "cprofile":
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Desde 3.12 solo puede haber un cProfile activo por proceso:
+                # las peticiones concurrentes pasan a muestreo
+                profile = None
+                request.mode = "sampling"
+        if request.mode == "sampling":
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.disable()
+            if sampler is not None:
+                sampler.stop()
+            duration = time.perf_counter() - started
+
+            allocations = None
+            if before is not None:
+                after = tracemalloc.take_snapshot()
+                self._stop_tracemalloc()
+                allocations = format_allocations(after.compare_to(before, "lineno"))
+
+            self.results.append(ProfileResult(
+                next(self._ids), request, started_at, duration,
+                pstats=dump_pstats(profile) if profile is not None else None,
+                collapsed=sampler.collapsed() if sampler is not None else None,
+                allocations=allocations,
+            ))
+
+    async def run_async(self, request: ProfileRequest, fn, /, *args, **kwargs):
+        # En el bucle de eventos cProfile también verá otras tareas concurrentes
+        profile = cProfile.Profile()
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError:
+            return await fn(*args, **kwargs)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            self.results.append(ProfileResult(
+                next(self._ids), request, started_at, time.perf_counter() - started,
+                pstats=dump_pstats(profile), collapsed=None, allocations=None,
+            ))
+
+
+class StackSampler(threading.Thread):
+    """Muestreo estadístico de la pila de un hilo, acumulado en formato collapsed"""
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL_SECONDS):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+def dump_pstats(profile: cProfile.Profile) -> bytes:
+    """Mismo formato que Profile.dump_stats, cargable con pstats.Stats(fichero)"""
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
+
+
+def format_allocations(differences, limit: int = 25) -> str:
+    output = io.StringIO()
+    for stat in differences[:limit]:
+        output.write(f"{stat}\n")
+    return output.getvalue()
+
+
+_current_profile: ContextVar[Optional[ProfileRequest]] = ContextVar("profile_request", default=None)
+
+profiler = Profiler()
+
+
+def profiled(endpoint):
+    """Envolver un endpoint para perfilarlo en el hilo en el que realmente se ejecuta"""
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            selected = _current_profile.get()
+            if selected is None:
+                return await endpoint(*args, **kwargs)
+            return await profiler.run_async(selected, endpoint, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        # Los endpoints síncronos corren en el threadpool; el contextvar se copia
+        selected = _current_profile.get()
+        if selected is None:
+            return endpoint(*args, **kwargs)
+        return profiler.run(selected, endpoint, *args, **kwargs)
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """Ruta cuyo endpoint se puede perfilar bajo demanda"""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+
+class ProfilingMiddleware:
+    """Selecciona las peticiones a perfilar según la configuración o la cabecera"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]
+                   if k in (HEADER.encode(), MODE_HEADER.encode())}
+        request = profiler.select(scope["path"], headers)
+        if request is None:
+            await self.app(scope, receive, send)
+            return
+
+        token = _current_profile.set(request)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_profile.reset(token)
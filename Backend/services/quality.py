@@ -0,0 +1,251 @@
+"""Calidad de señal en la ingesta: marcas de artefacto por lectura.
+
+Los sensores ópticos producen picos por movimiento que disparan falsos
+"Cambio brusco en HR" y ensucian mínimos y máximos. Cada lectura pasa por
+tres comprobaciones, por métrica (HR y SpO2):
+
+    implausible  fuera del rango fisiológico (LIMITS)
+    spike        filtro de Hampel: se aleja más de HAMPEL_K desviaciones (MAD
+                 escalada) de la mediana de las WINDOW lecturas anteriores
+    rate         la distancia a esa mediana, dividida por los segundos desde
+                 la última lectura de la ventana, supera el ritmo máximo
+
+La ventana solo incluye lecturas de los últimos HORIZON_SECONDS, así que con
+lecturas espaciadas (minutos) solo se aplica el rango y los picos reales de
+una partida no se confunden con artefactos. Las lecturas implausibles no
+cuentan para la mediana; las marcadas por las otras dos sí (la mediana ya es
+robusta) para que la ventana sea la misma en streaming y por lotes.
+
+En streaming cada jugador guarda una cola de WINDOW lecturas: O(1) por
+lectura. La versión por lotes construye la matriz (lecturas × WINDOW) con
+índices y evalúa todo de una vez; ambos caminos usan evaluate(), así que
+reprocesar el histórico deja las mismas marcas que la ingesta en vivo.
+Las marcas se guardan en metric_quality (solo las lecturas marcadas).
+"""
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database.db import MetricDB, MetricQualityDB, PlayerDB
+from services.analytics import MetricArrays, group_bounds, load_window
+
+WINDOW = int(os.getenv("QUALITY_WINDOW", "7"))
+HORIZON_SECONDS = float(os.getenv("QUALITY_HORIZON_SECONDS", "60"))
+HAMPEL_K = float(os.getenv("QUALITY_HAMPEL_K", "3"))
+MIN_WINDOW = 3  # Lecturas válidas mínimas en la ventana para aplicar Hampel
+BATCH_ROWS = 100_000
+
+# Escala de la MAD a desviación típica con datos normales
+MAD_TO_STD = 1.4826
+
+# Rango plausible, ritmo máximo por segundo y MAD mínima (lecturas enteras)
+LIMITS = {
+    "heart_rate": {"low": 30, "high": 220, "rate": 15.0, "min_mad": 2.0},
+    "oxygen_saturation": {"low": 70, "high": 100, "rate": 3.0, "min_mad": 1.0},
+}
+CHECKS = ("implausible", "spike", "rate")
+FLAGS = {f"{metric}_{check}": 1 << (3 * m + c) for m, metric in enumerate(LIMITS) for c, check in enumerate(CHECKS)}
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def flag_names(flags: int) -> List[str]:
+    return [name for name, bit in FLAGS.items() if flags & bit]
+
+
+def _median(window: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """Mediana por fila de los count primeros valores tras ordenar (los NaN van al final)"""
+    ordered = np.sort(window, axis=1)
+    rows = np.arange(len(window))
+    low = ordered[rows, np.maximum(count - 1, 0) // 2]
+    high = ordered[rows, count // 2]
+    return np.where(count > 0, (low + high) / 2, np.nan)
+
+
+def evaluate(values: Dict[str, np.ndarray], times: np.ndarray, window_values: Dict[str, np.ndarray],
+             window_times: np.ndarray) -> np.ndarray:
+    """Máscara de marcas por lectura.
+
+    values y times (µs) son de n lecturas; window_values y window_times son
+    matrices (n × WINDOW) con las lecturas anteriores de cada una (NaN donde
+    no hay).
+    """
+    flags = np.zeros(len(times), dtype=np.int64)
+    recent = (times[:, None] - window_times) <= HORIZON_SECONDS * 1_000_000
+    for metric, limits in LIMITS.items():
+        x = values[metric].astype(float)
+        window = window_values[metric]
+        implausible = (x < limits["low"]) | (x > limits["high"])
+        valid = recent & (window >= limits["low"]) & (window <= limits["high"])
+        window = np.where(valid, window, np.nan)
+        count = valid.sum(axis=1)
+
+        median = _median(window, count)
+        mad = _median(np.abs(window - median[:, None]), count)
+        distance = np.abs(x - median)
+        spike = (count >= MIN_WINDOW) & (distance > HAMPEL_K * MAD_TO_STD * np.maximum(mad, limits["min_mad"]))
+
+        last = np.where(valid, window_times, -np.inf).max(axis=1, initial=-np.inf)
+        elapsed = np.maximum((times - last) / 1_000_000, 1.0)
+        rate = (count > 0) & (distance / elapsed > limits["rate"])
+
+        for check, fired in zip(CHECKS, (implausible, spike & ~implausible, rate & ~implausible)):
+            flags |= np.where(fired, FLAGS[f"{metric}_{check}"], 0)
+    return flags
+
+
+def flag_readings(arrays: MetricArrays) -> np.ndarray:
+    """Versión por lotes: marcas de todas las lecturas (ordenadas por jugador y tiempo)"""
+    n = len(arrays)
+    flags = np.zeros(n, dtype=np.int64)
+    if not n:
+        return flags
+    starts, _, counts = group_bounds(arrays.player_id)
+    group_start = np.repeat(starts, counts)
+    times = arrays.timestamp.astype("datetime64[us]").astype(np.int64).astype(float)
+    columns = {"heart_rate": arrays.heart_rate.astype(float), "oxygen_saturation": arrays.oxygen.astype(float)}
+
+    # Por bloques para acotar la memoria de las matrices n × WINDOW
+    for begin in range(0, n, BATCH_ROWS):
+        rows = np.arange(begin, min(begin + BATCH_ROWS, n))
+        index = rows[:, None] - WINDOW + np.arange(WINDOW)[None, :]
+        present = index >= group_start[rows][:, None]
+        index = np.maximum(index, 0)
+        flags[rows] = evaluate(
+            {metric: column[rows] for metric, column in columns.items()}, times[rows],
+            {metric: np.where(present, column[index], np.nan) for metric, column in columns.items()},
+            np.where(present, times[index], np.nan),
+        )
+    return flags
+
+
+class PlayerQualityState:
+    __slots__ = ("lock", "hydrated", "window", "last_key")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hydrated = False
+        self.window = deque(maxlen=WINDOW)  # (µs, HR, SpO2) de las últimas lecturas
+        self.last_key = None  # (timestamp, id) de la última lectura de la ventana
+
+
+class QualityFilter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[int, PlayerQualityState] = {}
+
+    def _state(self, player_id: int) -> PlayerQualityState:
+        state = self._states.get(player_id)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(player_id, PlayerQualityState())
+        return state
+
+    def _hydrate(self, db: Session, state: PlayerQualityState, metric: MetricDB):
+        """Ventana inicial tras un reinicio: las WINDOW lecturas anteriores, una consulta"""
+        previous = db.query(MetricDB.timestamp, MetricDB.id, MetricDB.heart_rate, MetricDB.oxygen_saturation).filter(
+            MetricDB.player_id == metric.player_id,
+            (MetricDB.timestamp < metric.timestamp)
+            | ((MetricDB.timestamp == metric.timestamp) & (MetricDB.id < metric.id))
+        ).order_by(MetricDB.timestamp.desc(), MetricDB.id.desc()).limit(WINDOW).all()
+        for timestamp, _, heart_rate, oxygen in reversed(previous):
+            state.window.append(((timestamp - EPOCH) // MICROSECOND, heart_rate, oxygen))
+        if previous:
+            state.last_key = (previous[0][0], previous[0][1])
+        state.hydrated = True
+
+    def check(self, db: Session, metric: MetricDB) -> int:
+        """Ingesta: marcas de una lectura recién insertada (ya con id)"""
+        state = self._state(metric.player_id)
+        micros = (metric.timestamp - EPOCH) // MICROSECOND
+        with state.lock:
+            if not state.hydrated:
+                self._hydrate(db, state, metric)
+            window = np.full((3, WINDOW), np.nan)
+            if state.window:
+                window[:, WINDOW - len(state.window):] = np.array(state.window, dtype=float).T
+            flags = evaluate(
+                {"heart_rate": np.array([metric.heart_rate]), "oxygen_saturation": np.array([metric.oxygen_saturation])},
+                np.array([micros], dtype=float),
+                {"heart_rate": window[1:2], "oxygen_saturation": window[2:3]}, window[0:1],
+            )
+            # Las atrasadas se evalúan con la ventana actual pero no entran en ella
+            key = (metric.timestamp, metric.id)
+            if state.last_key is None or key > state.last_key:
+                state.window.append((micros, metric.heart_rate, metric.oxygen_saturation))
+                state.last_key = key
+        return int(flags[0])
+
+    def reset(self, player_id: Optional[int] = None):
+        with self._lock:
+            if player_id is None:
+                self._states.clear()
+            else:
+                self._states.pop(player_id, None)
+
+    def reprocess(self, db: Session, players: Sequence[PlayerDB], start_time: datetime,
+                  end_time: Optional[datetime] = None) -> dict:
+        """Recalcular y reemplazar las marcas de una ventana del histórico (vectorizado)"""
+        player_ids = [p.id for p in players]
+        # Las ventanas de las primeras lecturas llegan hasta HORIZON_SECONDS antes
+        arrays = load_window(db, player_ids, start_time - timedelta(seconds=HORIZON_SECONDS), end_time,
+                             include_flagged=True)
+        flags = flag_readings(arrays)
+        inside = arrays.timestamp >= np.datetime64(start_time, "us")
+        flagged = np.flatnonzero(inside & (flags > 0))
+
+        stale = db.query(MetricQualityDB).filter(
+            MetricQualityDB.player_id.in_(player_ids),
+            MetricQualityDB.timestamp >= start_time
+        )
+        if end_time is not None:
+            stale = stale.filter(MetricQualityDB.timestamp < end_time)
+        stale.delete(synchronize_session=False)
+        timestamps = arrays.timestamp.astype(datetime)
+        db.add_all(
+            MetricQualityDB(metric_id=int(arrays.id[i]), player_id=int(arrays.player_id[i]),
+                            timestamp=timestamps[i], flags=int(flags[i]))
+            for i in flagged.tolist()
+        )
+        db.commit()
+
+        # La ventana en memoria se reconstruye desde la base en la próxima lectura
+        self.reset()
+        return {
+            "readings": int(inside.sum()),
+            "flagged": len(flagged),
+            "by_flag": {name: int(np.count_nonzero(flags[flagged] & bit)) for name, bit in FLAGS.items()},
+        }
+
+
+def report(db: Session, player_id: int, start_time: datetime) -> dict:
+    """Lecturas marcadas de un jugador desde start_time y su recuento por marca"""
+    readings = db.query(func.count(MetricDB.id)).filter(
+        MetricDB.player_id == player_id, MetricDB.timestamp >= start_time
+    ).scalar()
+    rows = db.query(MetricDB, MetricQualityDB.flags).join(
+        MetricQualityDB, MetricQualityDB.metric_id == MetricDB.id
+    ).filter(
+        MetricQualityDB.player_id == player_id,
+        MetricQualityDB.timestamp >= start_time
+    ).order_by(MetricDB.timestamp, MetricDB.id).all()
+    return {
+        "readings": readings,
+        "flagged": len(rows),
+        "by_flag": {name: sum(1 for _, flags in rows if flags & bit) for name, bit in FLAGS.items()},
+        "flagged_readings": [
+            {"metric_id": metric.id, "timestamp": metric.timestamp, "heart_rate": metric.heart_rate,
+             "oxygen_saturation": metric.oxygen_saturation, "flags": flags, "reasons": flag_names(flags)}
+            for metric, flags in rows
+        ],
+    }
+
+
+quality = QualityFilter()
@@ -0,0 +1,137 @@
+"""Detector de consultas lentas y patrones N+1 para desarrollo y staging.
+
+Se activa con QUERY_DEBUG=1. Umbrales configurables por entorno:
+    SLOW_QUERY_MS      duración a partir de la cual se registra la consulta (100)
+    N_PLUS_ONE_MIN     repeticiones de una misma sentencia con distintos
+                       parámetros para marcarla como N+1 (3)
+"""
+import logging
+import os
+import re
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("QUERY_DEBUG", "0").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+N_PLUS_ONE_MIN = int(os.getenv("N_PLUS_ONE_MIN", "3"))
+
+HEADER = "X-Query-Debug"
+
+_WHITESPACE = re.compile(r"\s+")
+_IN_LIST = re.compile(r"\((\s*\?\s*,)+\s*\?\s*\)")
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def fingerprint(statement: str) -> str:
+    """Forma normalizada de una sentencia: sin literales ni listas IN variables"""
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _LITERAL.sub("?", statement)
+    return _IN_LIST.sub("(?+)", statement)
+
+
+class StatementStats:
+    __slots__ = ("count", "params", "elapsed")
+
+    def __init__(self):
+        self.count = 0
+        self.params = set()
+        self.elapsed = 0.0
+
+
+class QueryLog:
+    """Sentencias ejecutadas durante una petición, agrupadas por fingerprint"""
+
+    def __init__(self):
+        self.statements: Dict[str, StatementStats] = {}
+        self.slow = 0
+
+    def record(self, statement: str, parameters, elapsed: float):
+        stats = self.statements.setdefault(fingerprint(statement), StatementStats())
+        stats.count += 1
+        stats.elapsed += elapsed
+        # Basta con saber si cambian los parámetros; se acota la memoria
+        if len(stats.params) < 64:
+            stats.params.add(repr(parameters))
+
+    def n_plus_one(self) -> Dict[str, StatementStats]:
+        return {
+            sql: stats for sql, stats in self.statements.items()
+            if stats.count >= N_PLUS_ONE_MIN and len(stats.params) > 1
+        }
+
+    def summary(self) -> str:
+        total = sum(s.count for s in self.statements.values())
+        elapsed = sum(s.elapsed for s in self.statements.values()) * 1000
+        return (f"statements={total}; distinct={len(self.statements)}; "
+                f"time_ms={elapsed:.1f}; n_plus_one={len(self.n_plus_one())}; slow={self.slow}")
+
+
+_current_log: ContextVar[Optional[QueryLog]] = ContextVar("query_log", default=None)
+
+
+def explain(conn, statement: str, parameters) -> str:
+    """Plan de ejecución usando la conexión DBAPI directamente (sin disparar eventos)"""
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(" | ".join(str(col) for col in row) for row in cursor.fetchall())
+    except Exception as error:
+        return f"(sin plan: {error})"
+    finally:
+        cursor.close()
+
+
+def install(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        log = _current_log.get()
+        if log is not None:
+            log.record(statement, parameters, elapsed)
+
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            if log is not None:
+                log.slow += 1
+            plan = explain(conn, statement, parameters) if statement.lstrip().upper().startswith("SELECT") else ""
+            logger.warning("Consulta lenta (%.1f ms): %s\n%s", elapsed * 1000, _WHITESPACE.sub(" ", statement), plan)
+
+
+class QueryDebugMiddleware:
+    """Resume las consultas de cada petición en la cabecera X-Query-Debug"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        log = QueryLog()
+        token = _current_log.set(log)
+
+        async def send_with_summary(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (HEADER.lower().encode(), log.summary().encode())
+                ]
+                for sql, stats in log.n_plus_one().items():
+                    logger.warning("Posible N+1 en %s: %d ejecuciones de %s",
+                                   scope["path"], stats.count, sql)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_summary)
+        finally:
+            _current_log.reset(token)
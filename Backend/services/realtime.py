@@ -0,0 +1,108 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set
+
+
+class Subscription:
+    """Suscriptor de un conjunto de tópicos con buffer acotado y coalescencia"""
+
+    def __init__(self, hub: "PubSubHub", topics: Iterable[str], max_rate: float,
+                 loop: asyncio.AbstractEventLoop, max_pending: int = 64):
+        self.hub = hub
+        self.topics = set(topics)
+        self.interval = 1.0 / max_rate
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.closed = False
+
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._event = asyncio.Event()
+        # Solo se guarda la última actualización por clave (jugador): los
+        # clientes lentos reciben el estado más reciente, no todo el historial
+        self._pending: "OrderedDict[object, dict]" = OrderedDict()
+
+    def offer(self, key, payload: dict):
+        """Encolar una actualización; seguro de llamar desde cualquier hilo"""
+        with self._lock:
+            if key in self._pending:
+                self._pending.move_to_end(key)
+            elif len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            self._pending[key] = payload
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # El bucle del cliente ya se cerró
+            self.close()
+
+    def drain(self) -> list:
+        with self._lock:
+            batch = list(self._pending.values())
+            self._pending.clear()
+        return batch
+
+    async def next_batch(self, timeout: Optional[float] = None) -> list:
+        """Esperar el siguiente lote de actualizaciones (vacío si vence el timeout)"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._event.clear()
+        return self.drain()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.hub.unsubscribe(self)
+
+
+class PubSubHub:
+    """Hub pub/sub en proceso para difundir lecturas a los suscriptores"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+
+    def subscribe(self, topics: Iterable[str], max_rate: float,
+                  loop: asyncio.AbstractEventLoop, max_pending: int = 64) -> Subscription:
+        subscription = Subscription(self, topics, max_rate, loop, max_pending)
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def has_subscribers(self, *topics: str) -> bool:
+        return any(topic in self._subscribers for topic in topics)
+
+    def publish(self, topic: str, key, payload: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.offer(key, payload)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len({s for subs in self._subscribers.values() for s in subs})
+
+
+def player_topic(player_id: int) -> str:
+    return f"player:{player_id}"
+
+
+def team_topic(team: str) -> str:
+    return f"team:{team}"
+
+
+hub = PubSubHub()
@@ -0,0 +1,264 @@
+"""Motor de reglas de estado de salud (normal / fatigue / risk).
+
+Las reglas se leen de config/health_rules.json (o de HEALTH_RULES_PATH) y se
+pueden sobrescribir por equipo, rol o jugador, en ese orden de prioridad. Cada
+nivel es una lista de condiciones {"metric", "op", "value"}; basta con que se
+cumpla una para alcanzar el nivel. Editar el fichero basta para cambiar las
+reglas: se recarga solo cuando cambia su fecha de modificación.
+
+La sección opcional "alerting" controla las alertas en tiempo real: lecturas
+consecutivas necesarias para subir o bajar de nivel (raise_after/clear_after)
+y margen de histéresis por métrica para salir de un nivel.
+"""
+import json
+import operator
+import os
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+RULES_PATH = os.getenv(
+    "HEALTH_RULES_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "health_rules.json")
+)
+RELOAD_CHECK_SECONDS = 5.0
+
+NORMAL = "normal"
+METRICS = ("heart_rate", "oxygen_saturation")
+
+# Una condición "alguna lectura > x" equivale a "máximo > x" (y "<" al mínimo),
+# por eso las reglas se pueden evaluar sobre agregados min/max
+OPERATORS = {
+    ">": (operator.gt, "max"),
+    ">=": (operator.ge, "max"),
+    "<": (operator.lt, "min"),
+    "<=": (operator.le, "min"),
+}
+# Umbral que nunca se cumple, para condiciones ausentes en un jugador
+NEVER = {">": np.inf, ">=": np.inf, "<": -np.inf, "<=": -np.inf}
+
+DEFAULT_ALERTING = {
+    "raise_after": 2,
+    "clear_after": 3,
+    "hysteresis": {"heart_rate": 5, "oxygen_saturation": 1},
+}
+
+
+class RuleConfigError(ValueError):
+    pass
+
+
+def _validate_level(conditions) -> List[dict]:
+    for condition in conditions:
+        if condition.get("metric") not in METRICS:
+            raise RuleConfigError(f"Métrica desconocida: {condition.get('metric')}")
+        if condition.get("op") not in OPERATORS:
+            raise RuleConfigError(f"Operador desconocido: {condition.get('op')}")
+        float(condition["value"])
+    return list(conditions)
+
+
+class CompiledRules:
+    """Reglas resueltas para un conjunto de jugadores como matriz de umbrales.
+
+    Cada columna es una condición (nivel, métrica, operador) y cada fila un
+    jugador; evaluar todo el roster es una comparación de arrays por columna.
+    """
+
+    def __init__(self, levels: List[str], keys: List[Tuple[int, str, str]],
+                 rows: Dict[int, int], thresholds: np.ndarray, sudden_change_bpm: int):
+        self.levels = levels
+        self.keys = keys
+        self.rows = rows
+        self.thresholds = thresholds
+        self.sudden_change_bpm = sudden_change_bpm
+
+    def _thresholds(self, player_ids: np.ndarray) -> np.ndarray:
+        index = np.fromiter((self.rows[int(pid)] for pid in player_ids), dtype=np.int64, count=len(player_ids))
+        return self.thresholds[index]
+
+    def _fired(self, thresholds: np.ndarray, column) -> np.ndarray:
+        fired = np.zeros(thresholds.shape, dtype=bool)
+        for k, (_, metric, op) in enumerate(self.keys):
+            compare, _ = OPERATORS[op]
+            fired[:, k] = compare(column(metric, op), thresholds[:, k])
+        return fired
+
+    def level_of(self, fired: np.ndarray) -> np.ndarray:
+        level = np.zeros(fired.shape[0], dtype=np.int64)
+        for k, (level_index, _, _) in enumerate(self.keys):
+            level = np.where(fired[:, k], np.maximum(level, level_index), level)
+        return level
+
+    def evaluate_aggregates(self, player_ids: np.ndarray, aggregates: Dict[str, np.ndarray]):
+        """Evaluar sobre agregados por jugador: aggregates["max_heart_rate"], etc.
+
+        Devuelve (índice de nivel, matriz de condiciones cumplidas).
+        """
+        thresholds = self._thresholds(player_ids)
+        fired = self._fired(thresholds, lambda metric, op: aggregates[f"{OPERATORS[op][1]}_{metric}"])
+        return self.level_of(fired), fired
+
+    def fired_readings(self, player_ids: np.ndarray, readings: Dict[str, np.ndarray]) -> np.ndarray:
+        """Condiciones cumplidas por cada lectura (player_ids tiene una entrada por lectura)"""
+        return self._fired(self._thresholds(player_ids), lambda metric, op: readings[metric])
+
+    def evaluate_readings(self, player_ids: np.ndarray, starts: np.ndarray, readings: Dict[str, np.ndarray]):
+        """Evaluar lectura a lectura (grupos contiguos por jugador) y reducir por grupo"""
+        counts = np.diff(np.r_[starts, len(readings[METRICS[0]])])
+        per_reading = self.fired_readings(np.repeat(player_ids, counts), readings)
+        fired = np.logical_or.reduceat(per_reading, starts, axis=0) if len(starts) else per_reading[:0]
+        return self.level_of(fired), fired
+
+    def statuses(self, level: np.ndarray) -> np.ndarray:
+        return np.array([NORMAL] + self.levels)[level]
+
+    def fired_on(self, fired: np.ndarray, metric: str, direction: str) -> np.ndarray:
+        """¿Se cumplió alguna condición de esta métrica en ese sentido ("max"/"min")?"""
+        columns = [k for k, (_, m, op) in enumerate(self.keys) if m == metric and OPERATORS[op][1] == direction]
+        if not columns:
+            return np.zeros(fired.shape[0], dtype=bool)
+        return fired[:, columns].any(axis=1)
+
+    def player_thresholds(self, player_id: int) -> np.ndarray:
+        return self.thresholds[self.rows[player_id]]
+
+    def reading_level(self, player_id: int, values: Dict[str, float]) -> int:
+        """Nivel de una única lectura, sin numpy: camino caliente de la ingesta"""
+        thresholds = self.thresholds[self.rows[player_id]].tolist()
+        level = 0
+        for k, (level_index, metric, op) in enumerate(self.keys):
+            if level_index > level and OPERATORS[op][0](values[metric], thresholds[k]):
+                level = level_index
+        return level
+
+    def reading_status(self, player_id: int, values: Dict[str, float]) -> str:
+        return ([NORMAL] + self.levels)[self.reading_level(player_id, values)]
+
+    def relaxed(self, margins: Dict[str, float]) -> "CompiledRules":
+        """Mismas reglas con los umbrales desplazados hacia la zona normal (histéresis)"""
+        shift = np.array([
+            -margins.get(metric, 0) if OPERATORS[op][1] == "max" else margins.get(metric, 0)
+            for (_, metric, op) in self.keys
+        ], dtype=float)
+        return CompiledRules(self.levels, self.keys, self.rows, self.thresholds + shift, self.sudden_change_bpm)
+
+
+class RuleEngine:
+    def __init__(self, path: str = RULES_PATH):
+        self.path = path
+        self.version = 0
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.config: dict = {}
+        self._player_cache: Dict[tuple, CompiledRules] = {}
+        self.reload()
+
+    def reload(self):
+        with open(self.path, encoding="utf-8") as f:
+            config = json.load(f)
+        self.validate(config)
+        with self._lock:
+            self.config = config
+            self._mtime = os.path.getmtime(self.path)
+            self.version += 1
+            self._player_cache = {}
+
+    @staticmethod
+    def validate(config: dict):
+        levels = config.get("levels")
+        if not levels or NORMAL in levels:
+            raise RuleConfigError("'levels' debe listar los niveles de menor a mayor gravedad")
+        for level, conditions in config.get("default", {}).items():
+            if level not in levels:
+                raise RuleConfigError(f"Nivel desconocido: {level}")
+            _validate_level(conditions)
+        for scope in ("teams", "roles", "players"):
+            for overrides in config.get(scope, {}).values():
+                for level, conditions in overrides.items():
+                    if level not in levels:
+                        raise RuleConfigError(f"Nivel desconocido: {level}")
+                    _validate_level(conditions)
+        alerting = config.get("alerting", {})
+        for key in ("raise_after", "clear_after"):
+            if int(alerting.get(key, 1)) < 1:
+                raise RuleConfigError(f"'{key}' debe ser al menos 1")
+        for metric in alerting.get("hysteresis", {}):
+            if metric not in METRICS:
+                raise RuleConfigError(f"Métrica desconocida: {metric}")
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._checked < RELOAD_CHECK_SECONDS:
+            return
+        self._checked = now
+        try:
+            if os.path.getmtime(self.path) != self._mtime:
+                self.reload()
+        except (OSError, ValueError):
+            # Un fichero a medio escribir o inválido no tumba el servicio:
+            # se siguen usando las últimas reglas válidas
+            pass
+
+    def resolve(self, player_id: int, team: str, role: str) -> Dict[str, List[dict]]:
+        """Condiciones efectivas de un jugador: default < equipo < rol < jugador"""
+        config = self.config
+        resolved = dict(config.get("default", {}))
+        for overrides in (
+            config.get("teams", {}).get(team, {}),
+            config.get("roles", {}).get(role, {}),
+            config.get("players", {}).get(str(player_id), {}),
+        ):
+            resolved.update(overrides)
+        return resolved
+
+    def compile(self, players: Sequence) -> CompiledRules:
+        """players: objetos con id, team y role (p.ej. PlayerDB)"""
+        self.refresh()
+        config = self.config
+        levels = list(config["levels"])
+        resolved = {p.id: self.resolve(p.id, p.team, p.role) for p in players}
+
+        keys = sorted({
+            (levels.index(level) + 1, c["metric"], c["op"])
+            for rules in resolved.values()
+            for level, conditions in rules.items()
+            for c in conditions
+        })
+        column = {key: k for k, key in enumerate(keys)}
+        thresholds = np.array([[NEVER[op] for (_, _, op) in keys]] * len(resolved), dtype=float).reshape(len(resolved), len(keys))
+        rows = {}
+        for row, (player_id, rules) in enumerate(resolved.items()):
+            rows[player_id] = row
+            for level, conditions in rules.items():
+                for c in conditions:
+                    k = column[(levels.index(level) + 1, c["metric"], c["op"])]
+                    current = thresholds[row, k]
+                    value = float(c["value"])
+                    # Dos condiciones iguales en un nivel: gana la más sensible
+                    thresholds[row, k] = min(current, value) if OPERATORS[c["op"]][1] == "max" else max(current, value)
+
+        return CompiledRules(levels, keys, rows, thresholds, int(config.get("sudden_change_bpm", 20)))
+
+    def compile_player(self, player) -> CompiledRules:
+        """compile([player]) cacheado por versión de reglas, equipo y rol (ingesta)"""
+        self.refresh()
+        key = (self.version, player.id, player.team, player.role)
+        compiled = self._player_cache.get(key)
+        if compiled is None:
+            compiled = self._player_cache[key] = self.compile([player])
+        return compiled
+
+    def levels(self) -> List[str]:
+        return list(self.config["levels"])
+
+    def alerting(self) -> dict:
+        alerting = {**DEFAULT_ALERTING, **self.config.get("alerting", {})}
+        alerting["hysteresis"] = {**DEFAULT_ALERTING["hysteresis"], **alerting["hysteresis"]}
+        return alerting
+
+
+rules = RuleEngine()
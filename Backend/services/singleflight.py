@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from fastapi import BackgroundTasks, Request, Response, WebSocket
+from sqlalchemy.orm import Session
+
+# Parámetros de contexto que no forman parte de la identidad de la petición
+_CONTEXT_TYPES = (Session, Request, Response, WebSocket, BackgroundTasks)
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "expires")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.expires = 0.0
+
+
+class SingleFlight:
+    """Comparte un único cálculo en curso entre peticiones idénticas concurrentes"""
+
+    def __init__(self, ttl: float = 0.0, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, _Call] = {}
+        self._inflight_async: Dict[Hashable, asyncio.Future] = {}
+        # Resultados recientes, reutilizables durante ttl segundos
+        self._fresh: Dict[Hashable, _Call] = {}
+
+    def _lookup_fresh(self, key):
+        call = self._fresh.get(key)
+        if call is not None and call.expires > time.monotonic():
+            self.hits += 1
+            return call
+        return None
+
+    def _remember(self, key, result):
+        if self.ttl <= 0:
+            return
+        call = _Call()
+        call.result = result
+        call.expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._fresh[key] = call
+            if len(self._fresh) > self.max_entries:
+                now = time.monotonic()
+                for stale in [k for k, c in self._fresh.items() if c.expires <= now]:
+                    del self._fresh[stale]
+                while len(self._fresh) > self.max_entries:
+                    del self._fresh[next(iter(self._fresh))]
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Versión síncrona (handlers que FastAPI ejecuta en el threadpool)"""
+        with self._lock:
+            fresh = self._lookup_fresh(key)
+            if fresh is not None:
+                return fresh.result
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+        self._remember(key, call.result)
+        return call.result
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Versión asíncrona; fn devuelve una corrutina"""
+        with self._lock:
+            fresh = self._lookup_fresh(key)
+            if fresh is not None:
+                return fresh.result
+            future = self._inflight_async.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight_async[key] = asyncio.get_running_loop().create_future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            # shield: si este cliente se desconecta no se cancela el cálculo compartido
+            return await asyncio.shield(future)
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as error:
+            future.set_exception(error)
+            # Evita el aviso "exception was never retrieved" si nadie esperaba
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._inflight_async[key]
+        future.set_result(result)
+        self._remember(key, result)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "in_flight": len(self._inflight) + len(self._inflight_async),
+        }
+
+
+def request_key(name: str, arguments: dict) -> tuple:
+    """Clave normalizada: endpoint más parámetros ordenados, sin objetos de contexto"""
+    params = []
+    for param, value in sorted(arguments.items()):
+        if isinstance(value, _CONTEXT_TYPES):
+            continue
+        if isinstance(value, list):
+            value = tuple(value)
+        params.append((param, value))
+    return (name, tuple(params))
+
+
+def coalesce(flight: SingleFlight, name: Optional[str] = None):
+    """Decorador para endpoints síncronos o asíncronos"""
+    def decorator(fn):
+        endpoint = name or fn.__name__
+        signature = inspect.signature(fn)
+
+        def key(args, kwargs):
+            return request_key(endpoint, signature.bind_partial(*args, **kwargs).arguments)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                return await flight.do_async(key(args, kwargs), lambda: fn(*args, **kwargs))
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return flight.do(key(args, kwargs), lambda: fn(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+flight = SingleFlight(ttl=1.0)
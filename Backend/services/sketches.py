@@ -0,0 +1,258 @@
+"""Sketches de cuantiles (DDSketch) por jugador, métrica y hora.
+
+DDSketch reparte los valores en cubetas logarítmicas con error relativo
+acotado (RELATIVE_ACCURACY): el p90 devuelto está a menos de un 1% del real.
+Dos sketches se fusionan sumando sus contadores, así que los percentiles de
+un día, de un equipo o de todo el histórico salen de fusionar las cubetas
+horarias guardadas, sin volver a leer ni ordenar lecturas.
+
+Las horas en curso se mantienen en memoria y se vuelcan a quantile_sketches
+cada FLUSH_SECONDS, antes de cada consulta y al apagar; al arrancar se
+reconstruye desde MetricDB la ventana reciente.
+"""
+import json
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from database.db import MetricDB, PlayerDB, QuantileSketchDB
+from services.analytics import load_window
+
+RELATIVE_ACCURACY = 0.01
+BUCKET = timedelta(hours=1)
+FLUSH_SECONDS = 5.0
+METRICS = ("heart_rate", "oxygen_saturation")
+
+
+class DDSketch:
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0  # Valores <= 0, fuera de la escala logarítmica
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def add(self, value: float, weight: int = 1):
+        if value > 0:
+            key = self.key(value)
+            self.bins[key] = self.bins.get(key, 0) + weight
+        else:
+            self.zero_count += weight
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def add_many(self, values: np.ndarray):
+        """Versión vectorizada de add para un array de valores"""
+        if not len(values):
+            return
+        values = np.asarray(values, dtype=float)
+        positive = values[values > 0]
+        keys, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: "DDSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Solo se pueden fusionar sketches con la misma precisión")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantiles(self, qs: Sequence[float]) -> List[Optional[float]]:
+        """Cuantiles en un único recorrido de las cubetas ordenadas"""
+        if self.count == 0:
+            return [None] * len(qs)
+        order = sorted(range(len(qs)), key=lambda i: qs[i])
+        results: List[Optional[float]] = [None] * len(qs)
+        keys = sorted(self.bins)
+        cumulative = self.zero_count
+        position = 0
+        for i in order:
+            rank = qs[i] * (self.count - 1)
+            if rank < self.zero_count:
+                results[i] = min(0.0, self.max)
+                continue
+            while position < len(keys) and cumulative + self.bins[keys[position]] <= rank:
+                cumulative += self.bins[keys[position]]
+                position += 1
+            key = keys[min(position, len(keys) - 1)]
+            # Punto medio (relativo) de la cubeta, acotado por los extremos reales
+            value = 2 * self.gamma ** key / (self.gamma + 1)
+            results[i] = min(max(value, self.min), self.max)
+        return results
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "bins": {str(k): v for k, v in self.bins.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DDSketch":
+        sketch = cls(data.get("relative_accuracy", RELATIVE_ACCURACY))
+        sketch.bins = {int(k): v for k, v in data.get("bins", {}).items()}
+        sketch.zero_count = data.get("zero_count", 0)
+        sketch.count = data.get("count", 0)
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+def bucket_start(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+SketchKey = Tuple[int, str, datetime]
+
+
+class SketchStore:
+    """Sketches horarios por (jugador, métrica): abiertos en memoria, cerrados en la BD"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open: Dict[SketchKey, DDSketch] = {}
+        self._dirty: set = set()
+        self._flushed = time.monotonic()
+
+    def _load(self, db: Session, key: SketchKey) -> DDSketch:
+        player_id, metric, start = key
+        row = db.query(QuantileSketchDB.sketch).filter(
+            QuantileSketchDB.player_id == player_id,
+            QuantileSketchDB.metric == metric,
+            QuantileSketchDB.bucket_start == start
+        ).first()
+        return DDSketch.from_dict(json.loads(row[0])) if row is not None else DDSketch()
+
+    def add(self, db: Session, metric: MetricDB):
+        """Ingesta: O(1) por lectura; solo lee la BD la primera vez que se toca una hora"""
+        start = bucket_start(metric.timestamp)
+        values = {"heart_rate": metric.heart_rate, "oxygen_saturation": metric.oxygen_saturation}
+        for name in METRICS:
+            key = (metric.player_id, name, start)
+            loaded = None
+            while True:
+                # Búsqueda, suma y marca en una sola sección crítica: un backfill o
+                # la expulsión de horas cerradas pueden quitar la clave entre medias
+                with self._lock:
+                    sketch = self._open.get(key)
+                    if sketch is None and loaded is not None:
+                        sketch = self._open[key] = loaded
+                    if sketch is not None:
+                        sketch.add(values[name])
+                        self._dirty.add(key)
+                        break
+                loaded = self._load(db, key)
+
+    def flush(self, db: Session, max_age: Optional[float] = None) -> int:
+        """Volcar las horas modificadas; con max_age solo si ha pasado ese tiempo"""
+        with self._lock:
+            if max_age is not None and time.monotonic() - self._flushed < max_age:
+                return 0
+            self._flushed = time.monotonic()
+            dirty = [(key, json.dumps(self._open[key].to_dict()), self._open[key].count)
+                     for key in self._dirty if key in self._open]
+            self._dirty = set()
+            # Las horas ya cerradas no volverán a recibir lecturas (salvo atrasadas,
+            # que recargan su sketch de la BD)
+            current = bucket_start(datetime.utcnow()) - BUCKET
+            for key in [k for k in self._open if k[2] < current]:
+                del self._open[key]
+        if not dirty:
+            return 0
+        for (player_id, metric, start), sketch, count in dirty:
+            _upsert(db, player_id, metric, start, sketch, count)
+        db.commit()
+        return len(dirty)
+
+    def query(self, db: Session, player_ids: Iterable[int], metric: str, start_time: datetime,
+              end_time: datetime) -> List[Tuple[int, datetime, DDSketch]]:
+        """Sketches (jugador, hora) con la hora en [start_time, end_time)"""
+        self.flush(db)
+        rows = db.query(QuantileSketchDB.player_id, QuantileSketchDB.bucket_start, QuantileSketchDB.sketch).filter(
+            QuantileSketchDB.player_id.in_(list(player_ids)),
+            QuantileSketchDB.metric == metric,
+            QuantileSketchDB.bucket_start >= bucket_start(start_time),
+            QuantileSketchDB.bucket_start < end_time
+        ).order_by(QuantileSketchDB.bucket_start).all()
+        return [(player_id, start, DDSketch.from_dict(json.loads(sketch))) for player_id, start, sketch in rows]
+
+    def backfill(self, db: Session, players: Sequence[PlayerDB], start_time: datetime) -> int:
+        """Reconstruir desde MetricDB las horas a partir de start_time (vectorizado)"""
+        self.flush(db)
+        first_bucket = bucket_start(start_time)
+        player_ids = [p.id for p in players]
+        arrays = load_window(db, player_ids, first_bucket)
+
+        hours = arrays.timestamp.astype("datetime64[h]")
+        sketches: Dict[SketchKey, DDSketch] = {}
+        if len(arrays):
+            # Grupos contiguos (jugador, hora): load_window ya ordena por jugador y tiempo
+            change = np.r_[True, (arrays.player_id[1:] != arrays.player_id[:-1]) | (hours[1:] != hours[:-1])]
+            starts = np.flatnonzero(change)
+            ends = np.r_[starts[1:], len(arrays)]
+            for begin, end in zip(starts.tolist(), ends.tolist()):
+                start = hours[begin].astype(datetime)
+                for name, values in (("heart_rate", arrays.heart_rate), ("oxygen_saturation", arrays.oxygen)):
+                    sketch = sketches.setdefault((int(arrays.player_id[begin]), name, start), DDSketch())
+                    sketch.add_many(values[begin:end])
+
+        db.query(QuantileSketchDB).filter(
+            QuantileSketchDB.player_id.in_(player_ids),
+            QuantileSketchDB.bucket_start >= first_bucket
+        ).delete(synchronize_session=False)
+        db.add_all(
+            QuantileSketchDB(player_id=player_id, metric=metric, bucket_start=start,
+                             sketch=json.dumps(sketch.to_dict()), count=sketch.count)
+            for (player_id, metric, start), sketch in sketches.items()
+        )
+        db.commit()
+
+        with self._lock:
+            for key in [k for k in self._open if k[0] in set(player_ids) and k[2] >= first_bucket]:
+                del self._open[key]
+            self._dirty = {k for k in self._dirty if k in self._open}
+        return len(sketches)
+
+
+def _upsert(db: Session, player_id: int, metric: str, start: datetime, sketch: str, count: int):
+    updated = db.query(QuantileSketchDB).filter(
+        QuantileSketchDB.player_id == player_id,
+        QuantileSketchDB.metric == metric,
+        QuantileSketchDB.bucket_start == start
+    ).update({"sketch": sketch, "count": count}, synchronize_session=False)
+    if not updated:
+        db.add(QuantileSketchDB(player_id=player_id, metric=metric, bucket_start=start, sketch=sketch, count=count))
+
+
+def merge(sketches: Iterable[DDSketch]) -> DDSketch:
+    merged = DDSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
+
+
+sketches = SketchStore()
@@ -0,0 +1,90 @@
+"""Sincronía fisiológica del equipo: correlación cruzada con desfase entre las HR de sus jugadores.
+
+Cada serie se remuestrea sobre una rejilla común de paso step (mismo
+muestreo que services.events: interpolación entre lecturas a menos de
+max_gap); los huecos quedan enmascarados. Las correlaciones de todos los
+pares y todos los desfases salen de una sola FFT por jugador: el numerador
+y las energías de cada par son productos de espectros, O(p² · n log n) en
+lugar de O(p² · n · lags) con bucles de desfases.
+
+Con desfase positivo k, el jugador j va k segundos por detrás del i:
+corr_ij(k) compara x_i[t] con x_j[t + k].
+"""
+from datetime import datetime
+from typing import Dict, Sequence
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from services.events import MAX_GAP_SECONDS, sample_traces
+
+MAX_POINTS = 50000
+MIN_OVERLAP = 30  # Muestras comunes mínimas para dar una correlación
+
+
+def resample(db: Session, player_ids: Sequence[int], start_time: datetime, end_time: datetime,
+             step: float, max_gap: float = MAX_GAP_SECONDS) -> np.ndarray:
+    """Matriz (jugadores × rejilla) de HR en start_time + k·step; NaN en los huecos"""
+    points = int((end_time - start_time).total_seconds() // step) + 1
+    if points > MAX_POINTS:
+        raise ValueError(f"La rejilla tiene más de {MAX_POINTS} puntos; aumenta step")
+    grid = np.arange(points) * step
+    starts = np.full(len(player_ids), np.datetime64(start_time, "us"))
+    return sample_traces(db, np.asarray(player_ids, dtype=np.int64), starts, grid, max_gap)
+
+
+def cross_correlation(series: np.ndarray, max_lag: int) -> Dict[str, np.ndarray]:
+    """Correlación normalizada de todos los pares para desfases -max_lag..max_lag (en muestras)"""
+    n = series.shape[1]
+    mask = ~np.isnan(series)
+    counts = mask.sum(axis=1)
+    means = np.where(counts > 0, np.nansum(series, axis=1) / np.maximum(counts, 1), 0.0)
+    centered = np.where(mask, series - means[:, None], 0.0)
+
+    size = 1 << int(np.ceil(np.log2(max(2 * n, 2))))  # Sin solape circular
+    spectra = np.fft.rfft(centered, size)
+    energy = np.fft.rfft(centered ** 2, size)
+    presence = np.fft.rfft(mask.astype(float), size)
+
+    def correlate(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        # (p, p, size): sum_t a_i[t] · b_j[t + k]
+        return np.fft.irfft(np.conj(a)[:, None, :] * b[None, :, :], size)
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    columns = lags % size
+    numerator = correlate(spectra, spectra)[:, :, columns]
+    energy_i = correlate(energy, presence)[:, :, columns]
+    energy_j = correlate(presence, energy)[:, :, columns]
+    overlap = np.rint(correlate(presence, presence)[:, :, columns])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = numerator / np.sqrt(energy_i * energy_j)
+    correlation[(overlap < MIN_OVERLAP) | ~np.isfinite(correlation)] = np.nan
+    return {"lags": lags, "correlation": np.clip(correlation, -1, 1)}
+
+
+def synchrony(series: np.ndarray, step: float, max_lag_seconds: float) -> dict:
+    """Matriz de máxima correlación, su desfase y la correlación sin desfase"""
+    players = series.shape[0]
+    max_lag = min(int(max_lag_seconds // step), max(series.shape[1] - 1, 0))
+    result = cross_correlation(series, max_lag)
+    correlation, lags = result["correlation"], result["lags"]
+
+    valid = ~np.isnan(correlation).all(axis=2)
+    best = np.argmax(np.where(np.isnan(correlation), -np.inf, correlation), axis=2)
+    peak = np.where(valid, np.take_along_axis(correlation, best[:, :, None], axis=2)[:, :, 0], np.nan)
+    best_lag = np.where(valid, lags[best] * step, np.nan)
+    zero_lag = correlation[:, :, max_lag]
+
+    off_diagonal = ~np.eye(players, dtype=bool) & valid
+    return {
+        "synchrony": float(peak[off_diagonal].mean()) if off_diagonal.any() else None,
+        "correlation": _matrix(peak),
+        "best_lag": _matrix(best_lag),
+        "zero_lag": _matrix(zero_lag),
+        "coverage": np.round((~np.isnan(series)).mean(axis=1), 4).tolist() if series.shape[1] else [0.0] * players,
+    }
+
+
+def _matrix(values: np.ndarray):
+    return [[None if np.isnan(v) else round(float(v), 4) for v in row] for row in values]
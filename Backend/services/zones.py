@@ -0,0 +1,91 @@
+"""Tiempo en zona: minutos de cada jugador en cada zona de HR y banda de SpO2.
+
+Cada lectura representa el intervalo hasta la siguiente del mismo jugador,
+acotado a MAX_SAMPLE_SECONDS (un hueco mayor es falta de datos, no tiempo en
+zona); la última de la ventana llega como mucho hasta su fin. Las zonas se
+asignan con np.digitize y los segundos se suman con np.bincount ponderado por
+esas duraciones, para todos los jugadores en una sola pasada.
+
+Las zonas se definen por sus bordes: con bordes [a, b] hay tres zonas,
+"<a", "a-b" (a <= x < b) y ">=b".
+"""
+import os
+from datetime import datetime
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from services.analytics import MetricArrays
+
+HEART_RATE_EDGES = [80, 100, 110, 120]
+OXYGEN_EDGES = [90, 94, 97]
+MAX_SAMPLE_SECONDS = float(os.getenv("ZONE_MAX_SAMPLE_SECONDS", "900"))
+
+
+def validate_edges(edges: Sequence[float]) -> List[float]:
+    edges = [float(e) for e in edges]
+    if not edges or any(b <= a for a, b in zip(edges, edges[1:])):
+        raise ValueError("Los bordes de zona deben ser estrictamente crecientes")
+    return edges
+
+
+def zone_labels(edges: Sequence[float]) -> List[dict]:
+    fmt = lambda value: f"{value:g}"
+    bounds = [None] + list(edges) + [None]
+    labels = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        if lower is None:
+            name = f"<{fmt(upper)}"
+        elif upper is None:
+            name = f">={fmt(lower)}"
+        else:
+            name = f"{fmt(lower)}-{fmt(upper)}"
+        labels.append({"zone": name, "lower": lower, "upper": upper})
+    return labels
+
+
+def sample_durations(arrays: MetricArrays, end_time: datetime,
+                     max_seconds: float = MAX_SAMPLE_SECONDS) -> np.ndarray:
+    """Segundos que representa cada lectura (arrays ordenados por jugador y tiempo)"""
+    if not len(arrays):
+        return np.zeros(0)
+    seconds = (arrays.timestamp - arrays.timestamp[0]) / np.timedelta64(1, "s")
+    end = (np.datetime64(end_time, "us") - arrays.timestamp[0]) / np.timedelta64(1, "s")
+    same_player = np.r_[arrays.player_id[1:] == arrays.player_id[:-1], False]
+    following = np.where(same_player, np.r_[seconds[1:], end], end)
+    return np.clip(following - seconds, 0, max_seconds)
+
+
+def zone_histograms(arrays: MetricArrays, player_ids: Sequence[int], end_time: datetime,
+                    edges: Dict[str, Sequence[float]]) -> Dict[int, Dict[str, dict]]:
+    """Segundos y lecturas por zona de cada jugador y métrica"""
+    durations = sample_durations(arrays, end_time)
+    # Fila de cada lectura en el orden de player_ids
+    rows = np.searchsorted(np.sort(player_ids), arrays.player_id)
+    order = np.argsort(player_ids)
+    values = {"heart_rate": arrays.heart_rate, "oxygen_saturation": arrays.oxygen}
+
+    result: Dict[int, Dict[str, dict]] = {pid: {} for pid in player_ids}
+    for metric, metric_edges in edges.items():
+        n_zones = len(metric_edges) + 1
+        index = rows * n_zones + np.digitize(values[metric], metric_edges)
+        size = len(player_ids) * n_zones
+        seconds = np.bincount(index, weights=durations, minlength=size).reshape(-1, n_zones)
+        readings = np.bincount(index, minlength=size).reshape(-1, n_zones)
+        for row, position in enumerate(order.tolist()):
+            result[player_ids[position]][metric] = {"seconds": seconds[row], "readings": readings[row]}
+    return result
+
+
+def histogram_response(metric: str, edges: Sequence[float], seconds: np.ndarray, readings: np.ndarray) -> dict:
+    total = float(seconds.sum())
+    return {
+        "metric": metric,
+        "edges": list(edges),
+        "covered_minutes": round(total / 60, 2),
+        "zones": [
+            {**label, "minutes": round(float(s) / 60, 2), "fraction": round(float(s) / total, 4) if total else 0.0,
+             "readings": int(r)}
+            for label, s, r in zip(zone_labels(edges), seconds.tolist(), readings.tolist())
+        ],
+    }